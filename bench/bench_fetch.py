@@ -0,0 +1,147 @@
+"""
+Offline benchmark of the update pipeline (update_task and get_user_activities) against the local RuneScape stand-in.
+
+Starts bench/fake_rsapi.py in a subprocess (or uses --url to reuse one that's already running), points rsapi at it, runs
+a number of update cycles against a throwaway database and reports per cycle and overall:
+- users scanned per minute
+- seconds spent waiting on 429 penalties
+- time from a cap appearing in an alog to it being stored in cap_events
+- CPU seconds and peak Python memory allocated per cycle (on top of what was already allocated)
+
+Usage: python bench/bench_fetch.py [--cycles 10] [--loop-seconds 30] [--roster-size 200] [--rate-limit 0.5] ...
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+import multiprocessing
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "capbot"))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_rsapi
+
+def wait_for_server(url:str, timeout:float=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(f"{url}/bench/stats").read()
+            return
+        except Exception:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+def get_json(url:str):
+    with urllib.request.urlopen(url) as response:
+        return json.loads(response.read())
+
+def percentile(values:list[float], fraction:float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def run_cycles(args, url:str):
+    import rsapi
+    import scanner
+    import db
+    from clans import ClanConfig
+
+    rsapi.CLAN_HISCORES_URL = f"{url}/m=clan-hiscores"
+    rsapi.RUNEMETRICS_URL = f"{url}/runemetrics"
+    rsapi.rate_limiter.state_file = None
+    rsapi.rate_limiter.rate = args.initial_rate
+    clans = [ClanConfig(name="Bench Clan", guild_id=0)]
+    scanner.UPDATE_LOOP_MINUTES = args.loop_seconds / 60
+    database = db.get_database()
+
+    seen_caps = set()
+    lags = []
+    total_scanned = 0
+    start_time = time.time()
+    print(f"{'cycle':>5} {'seconds':>8} {'scanned':>8} {'429 wait':>9} {'new caps':>9} {'cpu s':>7} {'peak KB':>8} {'req/min':>8}")
+    for cycle in range(args.cycles):
+        cycle_start = time.time()
+        cpu_start = time.process_time()
+        limiter_start = rsapi.rate_limiter.stats()
+        tracemalloc.reset_peak()
+        memory_start = tracemalloc.get_traced_memory()[0]
+
+        await scanner.update_task(clans)
+
+        cycle_end = time.time()
+        cpu = time.process_time() - cpu_start
+        peak = tracemalloc.get_traced_memory()[1] - memory_start
+        limiter_end = rsapi.rate_limiter.stats()
+        scanned = (await database.fetch_one("SELECT COUNT(*) FROM user_activity WHERE last_query_timestamp >= ?", (cycle_start,)))[0]
+        total_scanned += scanned
+
+        # Everything stored this cycle was committed at the end of it.
+        appeared = {(rsn, cap_timestamp): when for rsn, cap_timestamp, when in get_json(f"{url}/bench/caps")}
+        new_caps = 0
+        for rsn, cap_timestamp in await database.fetch_all("SELECT rsn, cap_timestamp FROM cap_events"):
+            key = (rsn, float(cap_timestamp))
+            if key in seen_caps:
+                continue
+            seen_caps.add(key)
+            if key in appeared:
+                lags.append(cycle_end - appeared[key])
+                new_caps += 1
+
+        print(f"{cycle + 1:>5} {cycle_end - cycle_start:>8.1f} {scanned:>8} {limiter_end.penalty_wait_seconds - limiter_start.penalty_wait_seconds:>9.1f} "
+              f"{new_caps:>9} {cpu:>7.3f} {peak / 1024:>8.0f} {rsapi.rate_limiter.budget().requests_per_minute:>8.1f}")
+
+        if cycle + 1 < args.cycles:
+            await asyncio.sleep(max(0.0, cycle_start + args.loop_seconds - time.time()))
+
+    elapsed = time.time() - start_time
+    limiter = rsapi.rate_limiter.stats()
+    server = get_json(f"{url}/bench/stats")
+    print()
+    print(f"Users scanned per minute: {total_scanned / elapsed * 60:.1f}")
+    print(f"Requests: {limiter.requests}, 429s: {limiter.throttled} (server saw {server['throttled']}), time waiting on 429s: {limiter.penalty_wait_seconds:.1f}s")
+    if lags:
+        print(f"Cap detection lag over {len(lags)} caps: mean {statistics.mean(lags):.1f}s, p50 {percentile(lags, 0.5):.1f}s, "
+              f"p95 {percentile(lags, 0.95):.1f}s, max {max(lags):.1f}s")
+    else:
+        print("No caps were detected from the stand-in during the run.")
+    await rsapi.close_session()
+    db.close_db()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark update_task against a local RuneScape api stand-in.")
+    parser.add_argument("--cycles", type=int, default=10)
+    parser.add_argument("--loop-seconds", type=float, default=30, help="Seconds between the start of each update cycle.")
+    parser.add_argument("--initial-rate", type=float, default=0.25, help="Starting requests/second for the rate limiter.")
+    parser.add_argument("--url", help="Use an already running stand-in instead of starting one.")
+    parser.add_argument("--port", type=int, default=8765)
+    fake_rsapi.add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server = multiprocessing.Process(target=fake_rsapi.serve, args=(fake_rsapi.config_from_arguments(args), "127.0.0.1", args.port), daemon=True)
+        server.start()
+        url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        wait_for_server(url)
+        with tempfile.TemporaryDirectory() as work_dir:
+            # The database, rate limiter state and logs are all relative to the working directory.
+            os.chdir(work_dir)
+            tracemalloc.start()
+            asyncio.run(run_cycles(args, url))
+            os.chdir(BENCH_DIR)
+    finally:
+        if server is not None:
+            server.terminate()
+
+if __name__ == "__main__":
+    main()
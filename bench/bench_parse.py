@@ -0,0 +1,62 @@
+"""
+Micro-benchmark comparing the original alog parsing path against rsapi.parse_alog on the sample payloads in bench/samples.
+
+Usage: python bench/bench_parse.py [--iterations N]
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "capbot"))
+from rsapi import parse_user_activities, parse_alog, alog_date_to_timestamp, PrivateProfileException, CAP_TEXT
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples")
+
+def legacy_parse(rsn:str, content:str):
+    """ The original update_task path: decode everything, build an Activity per entry, then strptime the dates we use. """
+    activities = parse_user_activities(rsn, json.loads(content))
+    caps = [datetime.strptime(a.date, "%d-%b-%Y %H:%M").replace(tzinfo=timezone.utc).timestamp() for a in activities if a.text == CAP_TEXT]
+    newest = datetime.strptime(activities[0].date, "%d-%b-%Y %H:%M").replace(tzinfo=timezone.utc).timestamp() if activities else None
+    return newest, caps
+
+def fast_parse(rsn:str, content:str, watermark=None):
+    alog = parse_alog(rsn, content, watermark)
+    return (alog.newest.timestamp if alog.newest else None), [cap.timestamp for cap in alog.caps]
+
+def ignore_private(func, *args):
+    try:
+        return func(*args)
+    except PrivateProfileException:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    for filename in sorted(os.listdir(SAMPLES_DIR)):
+        with open(os.path.join(SAMPLES_DIR, filename), "r", encoding="utf-8") as f:
+            content = f.read()
+
+        # A watermark a few entries down, as if we'd polled this user recently.
+        activities = json.loads(content).get("activities") or []
+        watermark = (activities[3]["date"], activities[3]["text"]) if len(activities) > 3 else None
+
+        if activities:
+            assert legacy_parse("bench", content) == fast_parse("bench", content), f"Parsers disagree on {filename}"
+
+        alog_date_to_timestamp.cache_clear()
+        results = {
+            "legacy": timeit.timeit(lambda: ignore_private(legacy_parse, "bench", content), number=args.iterations),
+            "fast": timeit.timeit(lambda: ignore_private(fast_parse, "bench", content), number=args.iterations),
+            "fast+watermark": timeit.timeit(lambda: ignore_private(fast_parse, "bench", content, watermark), number=args.iterations),
+        }
+        print(f"{filename} ({len(content)} bytes, {len(activities)} activities)")
+        for name, seconds in results.items():
+            print(f"    {name:<16} {seconds / args.iterations * 1e6:8.2f} us/call  ({results['legacy'] / seconds:5.2f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark of run.py --worker scaling against the local RuneScape stand-in.
+
+For each worker count, starts a fresh bench/fake_rsapi.py and that many worker processes sharing a throwaway database,
+lets them run for --duration seconds, then stops them and reports alogs fetched per minute. The stand-in throttles each
+client address separately like runemetrics does, so each worker is given its own loopback address (127.0.0.2, 127.0.0.3, ...)
+with CAPBOT_LOCAL_ADDRESS.
+
+With --kill-one, the first worker is killed without warning halfway through each run to check its leased users get
+picked up by the others once the leases expire.
+
+Usage: python bench/bench_workers.py [--workers 1,2,4] [--duration 120] [--loop-seconds 30] [--roster-size 1000] ...
+"""
+import os
+import sys
+import json
+import time
+import signal
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CAPBOT_DIR = os.path.join(BENCH_DIR, "..", "capbot")
+sys.path.insert(0, BENCH_DIR)
+
+import fake_rsapi
+from bench_fetch import wait_for_server, get_json
+
+def start_worker(index:int, work_dir:str, url:str, args) -> subprocess.Popen:
+    worker_id = f"bench-{index}"
+    # Each worker gets its own directory for its log and rate limiter state, the database is shared through CAPBOT_DB_PATH.
+    worker_dir = os.path.join(work_dir, worker_id)
+    os.makedirs(worker_dir)
+    with open(os.path.join(worker_dir, f"ratelimit-{worker_id}.json"), "w", encoding="utf-8") as f:
+        json.dump({"rate": args.initial_rate, "ceiling": None}, f)
+    env = dict(os.environ,
+               CAPBOT_CLANS="Bench Clan=0",
+               CAPBOT_DB_PATH=os.path.join(work_dir, "capdata.db"),
+               CAPBOT_CLAN_HISCORES_URL=f"{url}/m=clan-hiscores",
+               CAPBOT_RUNEMETRICS_URL=f"{url}/runemetrics",
+               CAPBOT_LOCAL_ADDRESS=f"127.0.0.{index + 2}")
+    return subprocess.Popen([sys.executable, os.path.join(CAPBOT_DIR, "run.py"), "--worker", "--worker-id", worker_id, "--loop-seconds", str(args.loop_seconds)],
+                            cwd=worker_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def run(num_workers:int, args) -> dict:
+    server = multiprocessing.Process(target=fake_rsapi.serve, args=(fake_rsapi.config_from_arguments(args), "127.0.0.1", args.port), daemon=True)
+    server.start()
+    url = f"http://127.0.0.1:{args.port}"
+    workers = []
+    try:
+        wait_for_server(url)
+        with tempfile.TemporaryDirectory() as work_dir:
+            start_time = time.time()
+            workers = [start_worker(i, work_dir, url, args) for i in range(num_workers)]
+            if args.kill_one:
+                time.sleep(args.duration / 2)
+                workers[0].kill()
+                time.sleep(args.duration / 2)
+            else:
+                time.sleep(args.duration)
+            stats = get_json(f"{url}/bench/stats")
+            elapsed = time.time() - start_time
+
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.send_signal(signal.SIGINT)
+            for worker in workers:
+                worker.wait(timeout=30)
+
+            con = sqlite3.connect(os.path.join(work_dir, "capdata.db"))
+            scanned_users = con.execute("SELECT COUNT(*) FROM user_activity WHERE last_query_timestamp >= ?", (start_time,)).fetchone()[0]
+            caps = con.execute("SELECT COUNT(*) FROM cap_events").fetchone()[0]
+            con.close()
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.kill()
+        server.terminate()
+        server.join()
+
+    return {"workers": num_workers, "per_minute": stats["profiles_served"] / elapsed * 60, "throttled": stats["throttled"],
+            "scanned_users": scanned_users, "caps": caps}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scan throughput against the number of workers.")
+    parser.add_argument("--workers", default="1,2,4", help="Comma separated worker counts to try.")
+    parser.add_argument("--duration", type=float, default=120, help="Seconds to run each worker count for.")
+    parser.add_argument("--loop-seconds", type=float, default=30, help="Seconds between the start of each worker's scan cycles.")
+    parser.add_argument("--initial-rate", type=float, default=0.4, help="Starting requests/second for each worker's rate limiter.")
+    parser.add_argument("--kill-one", action="store_true", help="Kill the first worker halfway through each run.")
+    parser.add_argument("--port", type=int, default=8765)
+    fake_rsapi.add_config_arguments(parser)
+    parser.set_defaults(roster_size=1000)
+    args = parser.parse_args()
+
+    print(f"{'workers':>7} {'alogs/min':>10} {'per worker':>10} {'429s':>6} {'distinct users':>14} {'caps':>6}")
+    for num_workers in [int(count) for count in args.workers.split(",")]:
+        result = run(num_workers, args)
+        print(f"{result['workers']:>7} {result['per_minute']:>10.1f} {result['per_minute'] / num_workers:>10.1f} {result['throttled']:>6} "
+              f"{result['scanned_users']:>14} {result['caps']:>6}")
+
+if __name__ == "__main__":
+    main()
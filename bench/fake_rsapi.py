@@ -0,0 +1,188 @@
+"""
+Local stand-in for the RuneScape clan hiscores and runemetrics apis, for benchmarking without hitting Jagex.
+
+Serves /m=clan-hiscores/members_lite.ws and /runemetrics/profile/profile in the same formats as the real apis, backed by
+a simulated clan whose alogs grow in real time. Throttling is modelled on what we see from runemetrics: a token bucket
+per client, and once it's empty every request gets a 429 until a penalty window has passed. Requests made during the
+penalty window extend it.
+
+Point the bot at it with:
+    CAPBOT_CLAN_HISCORES_URL=http://127.0.0.1:8765/m=clan-hiscores
+    CAPBOT_RUNEMETRICS_URL=http://127.0.0.1:8765/runemetrics
+
+Usage: python bench/fake_rsapi.py [--port 8765] [--roster-size 200] [--rate-limit 0.5] ...
+"""
+import time
+import random
+import asyncio
+import argparse
+from collections import deque
+from dataclasses import dataclass, asdict, fields
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+CAP_TEXT = "Capped at my Clan Citadel."
+ACTIVITY_TEXTS = ["I killed 8 Vorago.", "Levelled up Invention.", "Visited my Clan Citadel.", "I killed 4 Telos, the Warden.",
+                  "Quest complete: Desperate Times", "I found some Orthenglass", "Clue scroll (elite) completed."]
+MAX_ACTIVITIES = 20
+
+@dataclass
+class StandInConfig:
+    roster_size:int = 200
+    private_fraction:float = 0.05
+    active_fraction:float = 0.3 # fraction of members generating alog entries
+    activities_per_hour:float = 6.0 # per active member
+    caps_per_hour:float = 0.5 # per active member; far higher than real so short runs see caps
+    latency:float = 0.05 # seconds added to every response
+    latency_jitter:float = 0.05
+    rate_limit:float = 0.5 # sustained requests/second before we start returning 429s
+    burst:float = 5
+    penalty:float = 10.0 # seconds of 429s after the bucket runs dry
+    seed:int = 1
+
+def format_date(timestamp:float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%d-%b-%Y %H:%M")
+
+class Throttle:
+    def __init__(self, config:StandInConfig):
+        self.config = config
+        self.tokens = config.burst
+        self.last_refill = time.monotonic()
+        self.penalty_until = 0.0
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if now < self.penalty_until:
+            self.penalty_until = now + self.config.penalty
+            return False
+        self.tokens = min(self.config.burst, self.tokens + (now - self.last_refill) * self.config.rate_limit)
+        self.last_refill = now
+        if self.tokens < 1:
+            self.penalty_until = now + self.config.penalty
+            return False
+        self.tokens -= 1
+        return True
+
+class RuneScapeStandIn:
+    def __init__(self, config:StandInConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.members = [f"Bench Player {i:04d}" for i in range(config.roster_size)]
+        self.private = set(self.random.sample(self.members, int(config.roster_size * config.private_fraction)))
+        self.active = set(self.random.sample(self.members, int(config.roster_size * config.active_fraction)))
+        self.alogs:dict[str, deque] = {}
+        self.next_activity:dict[str, float] = {}
+        self.next_cap:dict[str, float] = {}
+        # (rsn, cap timestamp as it appears in the alog) -> wall clock time the cap appeared
+        self.cap_appeared:dict[tuple[str, float], float] = {}
+        self.throttles:dict[str, Throttle] = {}
+        self.stats = {"roster_requests": 0, "profile_requests": 0, "profiles_served": 0, "throttled": 0}
+
+        now = time.time()
+        for rsn in self.members:
+            # Some history a few days back so the first poll has something to read.
+            alog = deque(maxlen=MAX_ACTIVITIES)
+            timestamp = now - self.random.uniform(1, 30) * 24 * 60 * 60
+            for _ in range(MAX_ACTIVITIES):
+                alog.appendleft((timestamp, self.random.choice(ACTIVITY_TEXTS)))
+                timestamp += self.random.uniform(60, 3600)
+                if timestamp >= now:
+                    break
+            self.alogs[rsn] = alog
+            if rsn in self.active:
+                self.next_activity[rsn] = now + self.random.expovariate(config.activities_per_hour / 3600)
+                self.next_cap[rsn] = now + self.random.expovariate(config.caps_per_hour / 3600)
+
+    def advance(self, now:float):
+        """ Adds any alog entries the active members have generated up to now. """
+        for rsn in self.active:
+            while True:
+                next_time = min(self.next_activity[rsn], self.next_cap[rsn])
+                if next_time > now:
+                    break
+                if self.next_cap[rsn] <= self.next_activity[rsn]:
+                    self.alogs[rsn].appendleft((next_time, CAP_TEXT))
+                    # The bot only knows the minute a cap happened, so that's what we key the appearance time on.
+                    self.cap_appeared.setdefault((rsn, float(int(next_time) // 60 * 60)), next_time)
+                    self.next_cap[rsn] = next_time + self.random.expovariate(self.config.caps_per_hour / 3600)
+                else:
+                    self.alogs[rsn].appendleft((next_time, self.random.choice(ACTIVITY_TEXTS)))
+                    self.next_activity[rsn] = next_time + self.random.expovariate(self.config.activities_per_hour / 3600)
+
+    async def respond(self, request:web.Request) -> bool:
+        """ Applies latency and throttling. Returns False if the request should get a 429. """
+        await asyncio.sleep(max(0.0, self.random.gauss(self.config.latency, self.config.latency_jitter)))
+        throttle = self.throttles.setdefault(request.remote or "", Throttle(self.config))
+        if not throttle.allow():
+            self.stats["throttled"] += 1
+            return False
+        self.advance(time.time())
+        return True
+
+    async def members_lite(self, request:web.Request) -> web.Response:
+        self.stats["roster_requests"] += 1
+        if not await self.respond(request):
+            return web.Response(status=429)
+        rows = ["Clanmate, Clan Rank, Total XP, Kills"]
+        for i, rsn in enumerate(self.members):
+            # The real api uses non-breaking spaces in names.
+            name = rsn.replace(" ", "\xa0")
+            rows.append(f"{name},{'Owner' if i == 0 else 'Recruit'},{1000000 + i * 1000},0")
+        return web.Response(text="\n".join(rows) + "\n", content_type="text/csv")
+
+    async def profile(self, request:web.Request) -> web.Response:
+        self.stats["profile_requests"] += 1
+        if not await self.respond(request):
+            return web.Response(status=429)
+        self.stats["profiles_served"] += 1
+        rsn = request.query.get("user", "")
+        if rsn not in self.alogs:
+            return web.json_response({"error": "NO_PROFILE", "loggedIn": "false"})
+        if rsn in self.private:
+            return web.json_response({"error": "PROFILE_PRIVATE", "loggedIn": "false"})
+
+        count = min(int(request.query.get("activities", MAX_ACTIVITIES)), MAX_ACTIVITIES)
+        activities = [{"date": format_date(timestamp), "details": f"{text} (details)", "text": text}
+                      for timestamp, text in list(self.alogs[rsn])[:count]]
+        skills = [{"level": 99, "xp": 130344310, "rank": 100000 + i, "id": i} for i in range(29)]
+        return web.json_response({"magic": 1434567, "questsstarted": 3, "totalskill": 2898, "questscomplete": 312,
+                                  "questsnotstarted": 12, "totalxp": 3845123456, "ranged": 2134567, "activities": activities,
+                                  "skillvalues": skills, "name": rsn, "rank": "12,345", "melee": 4312345, "combatlevel": 152,
+                                  "loggedIn": "false"})
+
+    async def bench_caps(self, request:web.Request) -> web.Response:
+        """ Not part of the real api: when each cap appeared, for measuring detection lag. """
+        return web.json_response([[rsn, cap_timestamp, appeared] for (rsn, cap_timestamp), appeared in self.cap_appeared.items()])
+
+    async def bench_stats(self, request:web.Request) -> web.Response:
+        """ Not part of the real api: request counters. """
+        return web.json_response(self.stats)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/m=clan-hiscores/members_lite.ws", self.members_lite)
+        app.router.add_get("/runemetrics/profile/profile", self.profile)
+        app.router.add_get("/bench/caps", self.bench_caps)
+        app.router.add_get("/bench/stats", self.bench_stats)
+        return app
+
+def add_config_arguments(parser:argparse.ArgumentParser):
+    for config_field in fields(StandInConfig):
+        parser.add_argument(f"--{config_field.name.replace('_', '-')}", type=config_field.type, default=config_field.default)
+
+def config_from_arguments(args:argparse.Namespace) -> StandInConfig:
+    return StandInConfig(**{config_field.name: getattr(args, config_field.name) for config_field in fields(StandInConfig)})
+
+def serve(config:StandInConfig, host:str="127.0.0.1", port:int=8765):
+    web.run_app(RuneScapeStandIn(config).make_app(), host=host, port=port, print=None)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the RuneScape apis.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    config = config_from_arguments(args)
+    print(f"Serving RuneScape stand-in on http://{args.host}:{args.port} with {asdict(config)}")
+    serve(config, args.host, args.port)
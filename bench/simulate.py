@@ -0,0 +1,380 @@
+"""
+Discrete-event simulator for comparing polling policies over simulated weeks, in virtual time.
+
+Models each clan member's play sessions, alog entries and weekly citadel caps, then replays a polling policy against a
+runemetrics rate-limit model. A cap is detected the first time we poll its member while it's still within the 20 entry
+alog window; if 20 newer entries arrive first it's missed. Reports the distribution of cap detection delay, missed caps
+and requests spent.
+
+The population is synthetic by default, or seeded from the statistics in an existing capdata.db with --db.
+Policies are pluggable: subclass Policy and add it to POLICIES.
+
+Usage: python bench/simulate.py [--days 30] [--policy oldest-first --policy adaptive] [--db capdata.db]
+"""
+import os
+import sys
+import time
+import heapq
+import random
+import sqlite3
+import argparse
+import statistics
+from bisect import bisect_right
+from dataclasses import dataclass, field
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "capbot"))
+from rsapi import RateLimiter
+from scheduler import estimate_cap_weight, allocate_poll_intervals, get_max_interval, update_activity_rate, MAX_ACTIVITIES
+
+DAY = 24 * 60 * 60
+WEEK = 7 * DAY
+
+@dataclass
+class MemberModel:
+    rsn:str
+    private:bool
+    sessions_per_day:float
+    session_hours:float
+    entries_per_hour:float # while playing
+    cap_probability:float # chance of capping in any given week
+
+@dataclass
+class RateLimitModel:
+    """ Same shape as the stand-in in fake_rsapi.py: a token bucket, then a penalty window that retries extend. """
+    rate:float = 0.3 # requests/second
+    burst:float = 5
+    penalty:float = 10.0
+    latency:float = 0.5 # seconds per request
+
+@dataclass
+class MemberWorld:
+    entry_times:list[float] = field(default_factory=list)
+    cap_times:list[float] = field(default_factory=list)
+
+@dataclass
+class MemberView:
+    """ What the bot knows about a member, built up from its own polls. """
+    last_query:float = 0.0
+    last_activity:float = 0.0
+    private:bool = False
+    cap_times:list[float] = field(default_factory=list)
+    activity_rate:float|None = None
+    interval:float = 0.0
+    next_poll:float = 0.0
+
+def synthetic_population(size:int, rng:random.Random, private_fraction:float=0.05) -> list[MemberModel]:
+    archetypes = [
+        # weight, sessions/day, session hours, entries/hour, weekly cap probability
+        (0.3, 1.5, 2.0, 8.0, 0.8), # daily players
+        (0.3, 0.3, 1.5, 6.0, 0.5), # weekly players
+        (0.4, 0.01, 1.0, 4.0, 0.05), # dormant
+    ]
+    members = []
+    for i in range(size):
+        _, sessions, hours, entries, cap_probability = rng.choices(archetypes, weights=[a[0] for a in archetypes])[0]
+        members.append(MemberModel(rsn=f"Sim Player {i:04d}", private=rng.random() < private_fraction, sessions_per_day=sessions,
+                                   session_hours=hours, entries_per_hour=entries, cap_probability=cap_probability))
+    return members
+
+def population_from_db(path:str, weeks:int=8) -> list[MemberModel]:
+    """ Builds a population from a capdata.db: cap frequency from cap_events, activity from user_activity/activity_watermarks. """
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    now = time.time()
+    rows = con.execute("""
+        SELECT ua.rsn, ua.private, ua.last_activity_timestamp,
+               (SELECT COUNT(*) FROM cap_events ce WHERE ce.rsn = ua.rsn AND ce.cap_timestamp >= ?)
+        FROM user_activity ua
+        """, (now - weeks * WEEK,)).fetchall()
+    rates = {}
+    try:
+        rates = dict(con.execute("SELECT rsn, activity_rate FROM activity_watermarks").fetchall())
+    except sqlite3.OperationalError:
+        pass
+    con.close()
+
+    members = []
+    for rsn, private, last_activity, recent_caps in rows:
+        age_days = (now - last_activity) / DAY
+        sessions = 1.5 if age_days <= 1 else 0.3 if age_days <= 7 else 0.05 if age_days <= 30 else 0.01
+        entries_per_hour = max(2.0, (rates.get(rsn) or 0) * 3600 / max(sessions * 2 / 24, 0.01))
+        members.append(MemberModel(rsn=rsn, private=private == 1, sessions_per_day=sessions, session_hours=2.0,
+                                   entries_per_hour=min(entries_per_hour, 60.0), cap_probability=min(1.0, (recent_caps + 0.5) / (weeks + 1))))
+    return members
+
+def generate_world(member:MemberModel, duration:float, rng:random.Random) -> MemberWorld:
+    """ Generates a member's alog for the whole run. Caps fall inside a play session, at most once per citadel week. """
+    world = MemberWorld()
+    sessions = []
+    t = rng.expovariate(member.sessions_per_day / DAY)
+    while t < duration:
+        length = rng.expovariate(1 / (member.session_hours * 3600))
+        sessions.append((t, t + length))
+        entry = t + rng.expovariate(member.entries_per_hour / 3600)
+        while entry < t + length:
+            world.entry_times.append(entry)
+            entry += rng.expovariate(member.entries_per_hour / 3600)
+        t += length + rng.expovariate(member.sessions_per_day / DAY)
+
+    for week_start in range(0, int(duration), WEEK):
+        week_sessions = [s for s in sessions if week_start <= s[0] < week_start + WEEK]
+        if week_sessions and rng.random() < member.cap_probability:
+            start, end = rng.choice(week_sessions)
+            world.cap_times.append(rng.uniform(start, end))
+    world.entry_times = sorted(world.entry_times + world.cap_times)
+    return world
+
+class Policy:
+    """
+    Decides which members to poll each update cycle and how the requests are paced.
+    before_request returns seconds to wait before sending; after_throttled returns seconds to wait before retrying a 429,
+    or None to give up on the rest of the cycle.
+    """
+    name = "base"
+    loop_minutes:float = 2
+
+    def select(self, views:list[MemberView], now:float) -> list[int]:
+        raise NotImplementedError
+
+    def before_request(self, now:float) -> float:
+        return 0.0
+
+    def after_success(self, now:float):
+        pass
+
+    def after_throttled(self, now:float) -> float|None:
+        return None
+
+    def observe(self, views:list[MemberView], index:int, now:float):
+        """ Called after a member has been polled and their view updated. """
+        pass
+
+class OldestFirstPolicy(Policy):
+    """ The original scanner: the 15 members with the oldest last query, sent back to back with a doubling 429 backoff. """
+    name = "oldest-first"
+    queries_per_cycle:int = 15
+
+    def __init__(self):
+        self.backoff = 10.0
+
+    def select(self, views:list[MemberView], now:float) -> list[int]:
+        return heapq.nsmallest(self.queries_per_cycle, range(len(views)), key=lambda i: views[i].last_query)
+
+    def after_success(self, now:float):
+        self.backoff = 10.0
+
+    def after_throttled(self, now:float) -> float|None:
+        wait = self.backoff
+        self.backoff *= 2
+        return wait if self.backoff <= 100 else None
+
+class AdaptivePolicy(Policy):
+    """
+    The current scanner: scheduler.py's weighting and interval allocation, with requests paced by rsapi's AIMD rate
+    limiter running on the virtual clock. The schedule is refreshed every refresh_minutes of virtual time rather than
+    every cycle to keep a simulated month quick.
+    """
+    name = "adaptive"
+    refresh_minutes:float = 30
+    max_throttles:int = 5
+
+    def __init__(self):
+        self.now = 0.0
+        self.limiter = RateLimiter(clock=lambda: self.now)
+        self.last_refresh = None
+        self.throttles = 0
+
+    def query_budget(self) -> int:
+        # Same headroom as scanner.get_query_budget.
+        return max(1, int(self.limiter.budget().rate * self.loop_minutes * 60 * 0.8) - 1)
+
+    def refresh(self, views:list[MemberView], now:float):
+        weights = []
+        for view in views:
+            recent_caps = [t for t in view.cap_times if t >= now - 8 * WEEK]
+            weights.append(estimate_cap_weight(now, view.last_activity, len(recent_caps), recent_caps[-1] if recent_caps else None, view.private))
+        max_intervals = [get_max_interval(view.activity_rate) for view in views]
+        capacity = self.limiter.budget().rate * 0.8
+        intervals = allocate_poll_intervals(weights, capacity, self.loop_minutes * 60, max_intervals)
+        for view, interval in zip(views, intervals):
+            view.interval = interval
+            view.next_poll = view.last_query + interval
+        self.last_refresh = now
+
+    def select(self, views:list[MemberView], now:float) -> list[int]:
+        self.now = now
+        self.throttles = 0
+        if self.last_refresh is None or now - self.last_refresh >= self.refresh_minutes * 60:
+            self.refresh(views, now)
+        return heapq.nsmallest(self.query_budget(), range(len(views)), key=lambda i: views[i].next_poll)
+
+    def before_request(self, now:float) -> float:
+        self.now = now
+        return self.limiter.reserve()
+
+    def after_success(self, now:float):
+        self.now = now
+        self.throttles = 0
+        self.limiter.on_success()
+
+    def after_throttled(self, now:float) -> float|None:
+        # The limiter makes the next reserve() wait out the penalty.
+        self.now = now
+        self.limiter.on_throttled()
+        self.throttles += 1
+        return 0.0 if self.throttles < self.max_throttles else None
+
+    def observe(self, views:list[MemberView], index:int, now:float):
+        # Between refreshes just push the polled member back by its allocated interval.
+        view = views[index]
+        view.next_poll = now + max(view.interval, self.loop_minutes * 60)
+
+POLICIES = {policy.name: policy for policy in [OldestFirstPolicy, AdaptivePolicy]}
+
+@dataclass
+class SimResult:
+    policy:str
+    caps:int
+    detected:int
+    missed:int
+    undetected:int # still sitting undetected in an alog at the end of the run
+    hidden:int # on private alogs, so never visible
+    requests:int
+    throttled:int
+    skipped_cycles:int
+    delays:list[float]
+
+class Throttle:
+    def __init__(self, model:RateLimitModel):
+        self.model = model
+        self.tokens = model.burst
+        self.last = 0.0
+        self.penalty_until = -1.0
+
+    def allow(self, now:float) -> bool:
+        if now < self.penalty_until:
+            self.penalty_until = now + self.model.penalty
+            return False
+        self.tokens = min(self.model.burst, self.tokens + (now - self.last) * self.model.rate)
+        self.last = now
+        if self.tokens < 1:
+            self.penalty_until = now + self.model.penalty
+            return False
+        self.tokens -= 1
+        return True
+
+def simulate(members:list[MemberModel], policy:Policy, days:float, rate_limit:RateLimitModel, seed:int=1) -> SimResult:
+    rng = random.Random(seed)
+    duration = days * DAY
+    worlds = [generate_world(member, duration, rng) for member in members]
+    views = [MemberView() for _ in members]
+    next_cap = [0] * len(members) # index of the first cap per member we haven't detected or missed yet
+    delays = []
+    missed = 0
+    requests = 0
+    throttled = 0
+    skipped = 0
+    throttle = Throttle(rate_limit)
+
+    def poll(index:int, now:float):
+        nonlocal missed
+        member, world, view = members[index], worlds[index], views[index]
+        newest = bisect_right(world.entry_times, now)
+        if member.private:
+            view.private = True
+        else:
+            window_start = world.entry_times[newest - MAX_ACTIVITIES] if newest >= MAX_ACTIVITIES else float("-inf")
+            caps = world.cap_times
+            while next_cap[index] < len(caps) and caps[next_cap[index]] <= now:
+                cap = caps[next_cap[index]]
+                if cap >= window_start:
+                    delays.append(now - cap)
+                    view.cap_times.append(cap)
+                else:
+                    missed += 1
+                next_cap[index] += 1
+            if newest > 0:
+                previous = bisect_right(world.entry_times, view.last_query)
+                if view.last_query > 0:
+                    view.activity_rate = update_activity_rate(view.activity_rate, newest - previous, now - view.last_query)
+                view.last_activity = world.entry_times[newest - 1]
+        view.last_query = now
+        policy.observe(views, index, now)
+
+    # If a cycle overruns into the next tick that tick is skipped, as with the old "thread is still alive" check.
+    loop_seconds = policy.loop_minutes * 60
+    busy_until = 0.0
+    tick = 0.0
+    while tick < duration:
+        if busy_until > tick:
+            skipped += 1
+            tick += loop_seconds
+            continue
+        now = tick
+        for index in policy.select(views, now):
+            wait = 0.0
+            while wait is not None:
+                now += policy.before_request(now)
+                requests += 1
+                now += rate_limit.latency
+                if throttle.allow(now):
+                    policy.after_success(now)
+                    poll(index, now)
+                    break
+                throttled += 1
+                wait = policy.after_throttled(now)
+                if wait is not None:
+                    now += wait
+            if wait is None:
+                break
+        busy_until = now
+        tick += loop_seconds
+
+    total_caps = sum(len(world.cap_times) for world in worlds)
+    hidden = sum(len(world.cap_times) for member, world in zip(members, worlds) if member.private)
+    undetected = total_caps - hidden - len(delays) - missed
+    return SimResult(policy=policy.name, caps=total_caps, detected=len(delays), missed=missed, undetected=undetected, hidden=hidden,
+                     requests=requests, throttled=throttled, skipped_cycles=skipped, delays=delays)
+
+def percentile(values:list[float], fraction:float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+def print_result(result:SimResult, elapsed:float):
+    hours = [d / 3600 for d in result.delays]
+    print(f"{result.policy}: simulated in {elapsed:.1f}s")
+    print(f"    caps {result.caps}, detected {result.detected}, missed (window rolled over) {result.missed}, pending at end {result.undetected}, private {result.hidden}")
+    print(f"    requests {result.requests}, 429s {result.throttled}, skipped cycles {result.skipped_cycles}")
+    if hours:
+        print(f"    detection delay hours: mean {statistics.mean(hours):.2f}, p50 {percentile(hours, 0.5):.2f}, "
+              f"p90 {percentile(hours, 0.9):.2f}, p99 {percentile(hours, 0.99):.2f}, max {max(hours):.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate polling policies over virtual weeks.")
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--policy", action="append", choices=sorted(POLICIES.keys()), help="Policies to compare. Defaults to all.")
+    parser.add_argument("--db", help="Seed the population from an existing capdata.db.")
+    parser.add_argument("--members", type=int, default=400, help="Size of the synthetic population when --db isn't given.")
+    parser.add_argument("--loop-minutes", type=float, default=2)
+    parser.add_argument("--queries-per-cycle", type=int, default=OldestFirstPolicy.queries_per_cycle, help="For oldest-first; adaptive sizes cycles from its rate limiter.")
+    parser.add_argument("--rate-limit", type=float, default=RateLimitModel.rate)
+    parser.add_argument("--burst", type=float, default=RateLimitModel.burst)
+    parser.add_argument("--penalty", type=float, default=RateLimitModel.penalty)
+    parser.add_argument("--latency", type=float, default=RateLimitModel.latency)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    members = population_from_db(args.db) if args.db else synthetic_population(args.members, random.Random(args.seed))
+    rate_limit = RateLimitModel(rate=args.rate_limit, burst=args.burst, penalty=args.penalty, latency=args.latency)
+    print(f"{len(members)} members over {args.days} days, an update every {args.loop_minutes} minutes")
+    for name in args.policy or sorted(POLICIES.keys()):
+        policy = POLICIES[name]()
+        policy.loop_minutes = args.loop_minutes
+        if isinstance(policy, OldestFirstPolicy):
+            policy.queries_per_cycle = args.queries_per_cycle
+        start = time.time()
+        # Same seed for every policy so they all see the same world.
+        result = simulate(members, policy, args.days, rate_limit, args.seed)
+        print_result(result, time.time() - start)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+from dataclasses import dataclass
+
+from rollups import get_week_start, WEEK_SECONDS, CITADEL_RESET_OFFSET
+
+@dataclass
+class AttendanceRow:
+    rsn:str
+    weeks_capped:int
+    eligible_weeks:int # weeks in the window since they joined
+    current_streak:int
+    longest_streak:int
+    last_cap_week:int|None # week index
+
+    @property
+    def attendance(self) -> float:
+        return self.weeks_capped / self.eligible_weeks if self.eligible_weeks else 0.0
+
+@dataclass
+class AttendanceReport:
+    weeks:int
+    rows:list[AttendanceRow]
+    perfect:list[str] # capped every eligible week in the window
+    missed:list[str] # didn't cap in any of the last missed_weeks weeks
+
+def get_week_index(timestamp:float) -> int:
+    """ Citadel weeks since CITADEL_RESET_OFFSET. Bit n of a member's bitset is week n. """
+    return (get_week_start(timestamp) - CITADEL_RESET_OFFSET) // WEEK_SECONDS
+
+def get_week_index_start(week:int) -> int:
+    return CITADEL_RESET_OFFSET + week * WEEK_SECONDS
+
+def encode_bits(bits:int) -> tuple[int, bytes]:
+    """ Stores a bitset as the index of its lowest week and the bits from there up, so each member only takes a few bytes. """
+    if bits == 0:
+        return 0, b""
+    first_week = (bits & -bits).bit_length() - 1
+    bits >>= first_week
+    return first_week, bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+
+def decode_bits(first_week:int, data:bytes) -> int:
+    return int.from_bytes(data, "little") << first_week
+
+def get_cap_members(caps:list[tuple]) -> set[tuple[str, str]]:
+    """ The (clan_name, rsn) of each (rsn, cap_timestamp, source, clan_name) cap_events row, for update_week_bits. """
+    return {(clan_name or "", rsn) for rsn, _, _, clan_name in caps}
+
+def update_week_bits(dbcon, members:set[tuple[str, str]]):
+    """
+    Recomputes the bitsets of the given (clan_name, rsn) members from cap_weekly_rollups, which the cap_events triggers
+    keep up to date. Call it after inserting or deleting any of their cap_events rows, in the same transaction.
+    """
+    for clan_name, rsn in members:
+        bits = 0
+        for week_start, in dbcon.execute("""
+                SELECT week_start FROM cap_weekly_rollups
+                WHERE clan_name = ? AND rsn = ? AND cap_count + compacted_count > 0
+                """, (clan_name, rsn)):
+            bits |= 1 << get_week_index(week_start)
+        if bits:
+            dbcon.execute("INSERT OR REPLACE INTO cap_week_bits(clan_name, rsn, first_week, bits) VALUES(?,?,?,?)", (clan_name, rsn, *encode_bits(bits)))
+        else:
+            dbcon.execute("DELETE FROM cap_week_bits WHERE clan_name = ? AND rsn = ?", (clan_name, rsn))
+
+def rebuild_week_bits(dbcon):
+    """ Recomputes every bitset from cap_weekly_rollups, which still has the weeks of caps the retention policy compacted. """
+    bitsets:dict[tuple[str, str], int] = {}
+    cur = dbcon.execute("SELECT clan_name, rsn, week_start FROM cap_weekly_rollups WHERE cap_count + compacted_count > 0")
+    for clan_name, rsn, week_start in cur:
+        key = (clan_name, rsn)
+        bitsets[key] = bitsets.get(key, 0) | (1 << get_week_index(week_start))
+    dbcon.execute("DELETE FROM cap_week_bits")
+    dbcon.executemany("INSERT INTO cap_week_bits(clan_name, rsn, first_week, bits) VALUES(?,?,?,?)",
+                      [(clan_name, rsn, *encode_bits(bits)) for (clan_name, rsn), bits in bitsets.items()])
+
+def longest_run(bits:int) -> int:
+    """ Length of the longest run of set bits. Each pass shortens every run by one, so it takes as many passes as the longest run. """
+    length = 0
+    while bits:
+        bits &= bits << 1
+        length += 1
+    return length
+
+def run_ending_at(bits:int, week:int) -> int:
+    """ Number of consecutive set bits going back from bit week. """
+    mask = (1 << (week + 1)) - 1
+    gaps = ~bits & mask
+    return week - (gaps.bit_length() - 1)
+
+def build_report(dbcon, clan_name:str, now:float, weeks:int, missed_weeks:int) -> AttendanceReport:
+    """
+    Attendance over the last `weeks` completed citadel weeks for the clan's current members.
+    The current week counts towards streaks if they've already capped in it, but never counts against anyone.
+    """
+    current_week = get_week_index(now)
+    last_week = current_week - 1
+    window_start = last_week - weeks + 1
+    window = ((1 << weeks) - 1) << window_start
+    missed_window = ((1 << missed_weeks) - 1) << (last_week - missed_weeks + 1)
+
+    members = dbcon.execute("""
+        SELECT cm.rsn, cm.joined_timestamp, wb.first_week, wb.bits
+        FROM clan_members cm
+        LEFT JOIN cap_week_bits wb ON wb.clan_name = cm.clan_name AND wb.rsn = cm.rsn
+        WHERE cm.clan_name = ? AND cm.departed_timestamp IS NULL
+        """, (clan_name,)).fetchall()
+
+    rows = []
+    perfect = []
+    missed = []
+    for rsn, joined_timestamp, first_week, data in members:
+        bits = decode_bits(first_week, data) if data is not None else 0
+        # Weeks up to the one they joined in don't count against them, but do count if they capped in them anyway.
+        # (Members already in the clan when the bot was set up have that as their join date.)
+        after_joining = ~((1 << (get_week_index(joined_timestamp) + 1)) - 1)
+        capped = bits & window
+        eligible = (window & after_joining) | capped
+        streak_end = current_week if bits >> current_week & 1 else last_week
+        rows.append(AttendanceRow(
+            rsn=rsn,
+            weeks_capped=capped.bit_count(),
+            eligible_weeks=eligible.bit_count(),
+            current_streak=run_ending_at(bits, streak_end),
+            longest_streak=longest_run(bits),
+            last_cap_week=bits.bit_length() - 1 if bits else None))
+        if eligible and capped == eligible:
+            perfect.append(rsn)
+        if bits & missed_window == 0 and missed_window & after_joining == missed_window:
+            missed.append(rsn)
+
+    rows.sort(key=lambda row: (-row.attendance, -row.current_streak, row.rsn.lower()))
+    return AttendanceReport(weeks=weeks, rows=rows, perfect=sorted(perfect, key=str.lower), missed=sorted(missed, key=str.lower))
@@ -0,0 +1,160 @@
+import time
+import asyncio
+import logging
+
+from log import FETCHER_LOG
+from db import init_db, get_database, close_db, get_state, bump_data_generation, SCANNER_HEARTBEAT_KEY
+from clans import load_clan_configs
+from roster import refresh_roster
+from scheduler import MAX_ACTIVITIES
+from attendance import update_week_bits, get_cap_members
+from rsapi import fetch_user_alog_async, close_session, rate_limiter, ActivityLog, PrivateProfileException, TooManyRequestsException
+
+# Members per write transaction. Progress is checkpointed in the same transaction so a resumed run never repeats or skips anyone.
+BATCH_SIZE = 50
+# The live scanner counts as running if it's touched its heartbeat this recently.
+SCANNER_ALIVE_SECONDS = 10 * 60
+# Fraction of our learnt rate we use while the live scanner is running. The scanner doesn't know about us and keeps
+# using its full rate, so this is extra load on top of it and should stay small.
+SHARE_WITH_SCANNER = 0.25
+MAX_CONSECUTIVE_THROTTLES = 5
+# How long to back off after MAX_CONSECUTIVE_THROTTLES. Unlike update_task we don't give up, we have all day.
+THROTTLE_COOLDOWN_SECONDS = 5 * 60
+BACKFILL_RATE_LIMIT_STATE_FILE = "ratelimit-backfill.json"
+
+def start_or_resume_run(dbcon, clan_name:str, now:float, restart:bool) -> int:
+    """ Returns the id of the unfinished backfill run for the clan, starting a new one if there isn't one. """
+    if restart:
+        dbcon.execute("UPDATE backfill_runs SET finished_timestamp = ? WHERE clan_name = ? AND finished_timestamp IS NULL", (now, clan_name))
+    row = dbcon.execute("SELECT id FROM backfill_runs WHERE clan_name = ? AND finished_timestamp IS NULL ORDER BY id DESC LIMIT 1", (clan_name,)).fetchone()
+    if row is not None:
+        return row[0]
+    return dbcon.execute("INSERT INTO backfill_runs(clan_name, started_timestamp) VALUES(?,?)", (clan_name, now)).lastrowid
+
+def get_remaining_members(dbcon, clan_name:str, run_id:int) -> tuple[list[str], int]:
+    """ Returns the current members not yet done in this run, in a stable order, and the total number of members. """
+    members = [row[0] for row in dbcon.execute("""
+        SELECT rsn FROM clan_members
+        WHERE clan_name = ? AND departed_timestamp IS NULL
+        ORDER BY rsn
+        """, (clan_name,)).fetchall()]
+    done = {row[0] for row in dbcon.execute("SELECT rsn FROM backfill_progress WHERE run_id = ?", (run_id,)).fetchall()}
+    return [rsn for rsn in members if rsn not in done], len(members)
+
+def is_scanner_alive(dbcon, now:float) -> bool:
+    state = get_state(dbcon, SCANNER_HEARTBEAT_KEY)
+    return state is not None and now - state[1] < SCANNER_ALIVE_SECONDS
+
+def store_batch(dbcon, run_id:int, clan_name:str, results:dict[str, ActivityLog], now:float) -> int:
+    """ Writes a batch of backfilled alogs and checkpoints them. Returns the number of new caps. """
+    cap_rows = [(rsn, cap.timestamp, "backfill", clan_name) for rsn, activity_log in results.items() for cap in activity_log.caps]
+    # One at a time so we know which caps are new, as store_scan does.
+    new_caps = [row for row in cap_rows
+                if dbcon.execute("INSERT OR IGNORE INTO cap_events(rsn, cap_timestamp, source, clan_name) VALUES(?,?,?,?)", row).rowcount > 0]
+    if new_caps:
+        update_week_bits(dbcon, get_cap_members(new_caps))
+        # So a bot running alongside stops serving cached command results from before these caps.
+        bump_data_generation(dbcon, now)
+
+    # Don't move the live scanner's state backwards if it's scanned someone since we did.
+    activity_rows = [(activity_log.newest.timestamp, now, rsn) for rsn, activity_log in results.items() if activity_log.newest is not None]
+    dbcon.executemany("""
+        UPDATE user_activity SET
+            last_activity_timestamp = MAX(last_activity_timestamp, ?),
+            last_query_timestamp = MAX(last_query_timestamp, ?),
+            private = 0
+        WHERE rsn = ?
+        """, activity_rows)
+    dbcon.executemany("UPDATE user_activity SET private = 1 WHERE rsn = ?", [(rsn,) for rsn, activity_log in results.items() if activity_log.private])
+    # Give members the scanner has never seen a high-water mark, so its first scan of them only parses newer entries.
+    dbcon.executemany("INSERT OR IGNORE INTO activity_watermarks(rsn, activity_date, activity_text, activity_rate) VALUES(?,?,?,NULL)",
+                      [(rsn, activity_log.newest.date, activity_log.newest.text) for rsn, activity_log in results.items() if activity_log.newest is not None])
+
+    dbcon.executemany("INSERT OR REPLACE INTO backfill_progress(run_id, rsn, completed_timestamp, caps_found) VALUES(?,?,?,?)",
+                      [(run_id, rsn, now, len(activity_log.caps)) for rsn, activity_log in results.items()])
+    return len(new_caps)
+
+async def backfill(clan_name:str, restart:bool=False):
+    """
+    Sweeps the whole clan roster once, fetching the full alog window for every member and storing any caps in it.
+    Meant for seeding a new install or catching up after downtime. Can run alongside the bot, in which case it slows
+    down to SHARE_WITH_SCANNER of its learnt rate, on top of the bot's own requests.
+    """
+    log = logging.getLogger(FETCHER_LOG)
+    database = get_database()
+    try:
+        await refresh_roster(clan_name, force=True)
+    except Exception as ex:
+        log.exception("Failed to refresh clan members for %s, backfilling the cached roster: %s", clan_name, ex)
+
+    run_id = await database.write(start_or_resume_run, clan_name, time.time(), restart)
+    remaining, total = await database.read(get_remaining_members, clan_name, run_id)
+    log.info("Backfill run %d for %s: %d/%d members already done, %d to go.", run_id, clan_name, total - len(remaining), total, len(remaining))
+
+    start_time = time.time()
+    done = 0
+    total_caps = 0
+    failed = []
+    batch:dict[str, ActivityLog] = {}
+    throttles = 0
+    index = 0
+    while index < len(remaining):
+        rsn = remaining[index]
+        if await database.read(is_scanner_alive, time.time()):
+            # The rate limiter paces us at its full rate, so wait out the rest of the scanner's share on top.
+            await asyncio.sleep((1 / SHARE_WITH_SCANNER - 1) / rate_limiter.budget().rate)
+
+        try:
+            batch[rsn] = await fetch_user_alog_async(rsn, MAX_ACTIVITIES)
+            throttles = 0
+        except PrivateProfileException:
+            batch[rsn] = ActivityLog(private=True)
+        except TooManyRequestsException:
+            throttles += 1
+            if throttles >= MAX_CONSECUTIVE_THROTTLES:
+                log.warning("Backfill throttled %d times in a row, pausing for %d seconds.", throttles, THROTTLE_COOLDOWN_SECONDS)
+                await asyncio.sleep(THROTTLE_COOLDOWN_SECONDS)
+                throttles = 0
+            continue # retry the same member
+        except Exception as ex:
+            # Left without a checkpoint so a resumed run tries them again.
+            log.exception("Failed to backfill %s: %s", rsn, ex)
+            failed.append(rsn)
+        index += 1
+
+        if len(batch) >= BATCH_SIZE or (index == len(remaining) and batch):
+            new_caps = await database.write(store_batch, run_id, clan_name, batch, time.time())
+            await rate_limiter.save_async()
+            done += len(batch)
+            total_caps += new_caps
+            batch = {}
+            elapsed = time.time() - start_time
+            eta = elapsed / index * (len(remaining) - index)
+            log.info("Backfilled %d/%d members, %d new caps. %.1f requests/minute, about %.0f minutes left.",
+                     total - len(remaining) + done, total, total_caps, rate_limiter.budget().requests_per_minute, eta / 60)
+
+    if failed:
+        log.warning("Backfill run %d couldn't fetch %d members, run it again to retry them: %s", run_id, len(failed), failed)
+    else:
+        await database.write(lambda dbcon: dbcon.execute("UPDATE backfill_runs SET finished_timestamp = ? WHERE id = ?", (time.time(), run_id)))
+        log.info("Backfill run %d finished in %.1f minutes, %d new caps.", run_id, (time.time() - start_time) / 60, total_caps)
+
+def run_backfill(restart:bool=False):
+    """ Entry point for run.py --backfill. Runs in the foreground until every clan's roster has been swept. """
+    clans = load_clan_configs()
+    init_db()
+    # Its own state file, so a bot running alongside doesn't overwrite the rate we learnt on exit or vice versa.
+    rate_limiter.state_file = BACKFILL_RATE_LIMIT_STATE_FILE
+    rate_limiter.load()
+
+    async def main():
+        try:
+            for clan in clans:
+                await backfill(clan.name, restart)
+        finally:
+            await close_session()
+    try:
+        asyncio.run(main())
+    finally:
+        rate_limiter.save()
+        close_db()
@@ -0,0 +1,87 @@
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from metrics import Counter, Gauge
+
+@dataclass
+class CacheStats:
+    generation:int
+    entries:int
+    hits:int
+    misses:int
+
+class ResultCache:
+    """
+    LRU cache for slash command responses, keyed by command name and arguments.
+
+    The update pipeline bumps the data generation whenever it writes new cap_events or user_activity rows; entries from an
+    older generation are treated as misses. Entries also expire after max_age seconds since windows like "last 7 days"
+    slide forward even when no new data arrives.
+
+    When scanning is done by worker processes they can't reach this cache, so they bump a generation counter in the
+    database instead and sync_external_generation picks it up.
+    """
+    def __init__(self, max_entries:int=64, max_age:float=5 * 60):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries:OrderedDict[tuple, tuple[int, float, object]] = OrderedDict()
+        self.generation = 0
+        self.external_generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def bump_generation(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def sync_external_generation(self, generation:int):
+        """ Drops everything if the database's data generation has moved on since we last looked. """
+        with self.lock:
+            changed = self.external_generation is not None and generation != self.external_generation
+            self.external_generation = generation
+        if changed:
+            self.bump_generation()
+
+    def get(self, key:tuple) -> object|None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != self.generation or time.monotonic() - entry[1] > self.max_age:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key:tuple, value:object, generation:int):
+        """ Stores a value computed from data at the given generation. Dropped if the data has changed since. """
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (generation, time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    async def get_or_compute(self, key:tuple, compute):
+        """ Returns the cached value for key, or awaits compute() and caches the result. """
+        value = self.get(key)
+        if value is not None:
+            return value
+        generation = self.generation
+        value = await compute()
+        self.put(key, value, generation)
+        return value
+
+    def stats(self) -> CacheStats:
+        with self.lock:
+            return CacheStats(generation=self.generation, entries=len(self.entries), hits=self.hits, misses=self.misses)
+
+result_cache = ResultCache()
+
+Counter("capbot_cache_hits_total", "Command responses served from the result cache.", func=lambda: result_cache.stats().hits)
+Counter("capbot_cache_misses_total", "Command responses that had to be computed.", func=lambda: result_cache.stats().misses)
+Gauge("capbot_cache_entries", "Entries in the result cache.", func=lambda: result_cache.stats().entries)
@@ -1,29 +1,35 @@
 import logging
 import os
 import time
-import threading
+import json
+import asyncio
+import hashlib
 import tempfile
+from typing import Literal
 from datetime import datetime, timezone, timedelta
-from requests import HTTPError
 
 import discord
 from discord import app_commands
 from discord.ext import tasks
 
-from log import init_log, LOG_NAME
-from db import init_db, get_db
+from log import init_log, set_log_level, get_log_levels, COMMANDS_LOG, SCHEDULER_LOG
+from db import init_db, get_database, close_db, get_data_generation, get_state, set_state
+from cache import result_cache
+from clans import ClanConfig, load_clan_configs, get_clan_for_guild, assign_unattributed_caps
+from metrics import start_metrics_server, update_cycle_seconds, update_failures, update_skipped_cycles, users_scanned, request_seconds, cap_detection_lag_seconds, roster_staleness, uptime
+from render import paginate_table, send_pages, table_to_bytes, make_file, MESSAGE_LIMIT
+from rollups import get_cap_totals
+from attendance import build_report, get_week_index_start
+from names import canonical_rsn, RsnIndex
+from export import ExportOptions, write_export, parse_export_date, parse_export_end_date, get_export_filename
+from scanner import update_task, UPDATE_LOOP_MINUTES
 from rsapi import *
 
-CLAN_NAME = "Unknown"
-MAX_FAILURES = 5
-MAX_USER_QUERIES = 15
-UPDATE_LOOP_MINUTES = 2
-
-def get_date_timestamp(date:str) -> float:
-    """ Parses the date from a date string (RS Alog format) and returns it as a timestamp. """
-    dt = datetime.strptime(date, "%d-%b-%Y %H:%M")
-    dt = dt.replace(tzinfo=timezone.utc)
-    return dt.timestamp()
+CLANS:list[ClanConfig] = []
+# Exports are built in memory up to this size, then spill to a temporary file.
+EXPORT_SPOOL_BYTES = 1024 * 1024
+# bot_state key prefix for the fingerprint of the commands last synced to each discord server.
+COMMAND_TREE_KEY_PREFIX = "command_tree:"
 
 def timestamp_to_date(timestamp) -> str:
     """ Converts a timestamp into a date string (RS Alog format). """
@@ -39,348 +45,373 @@ def get_offset_from_now_timestamp(delta:timedelta) -> int:
 def format_timestamp_for_discord(timestamp) -> str:
     return f"<t:{timestamp}:f>"
 
-def get_user_activities(users:list[str], cancel_event:threading.Event, num_activities:int=20) -> dict[str, ActivityLog]:
-    """
-    Fetches the adventure's log for each user in the list.
-    Handles Jamflex's extreme rate limiting.
-    Returns a dict of rsn -> ActivityLog.
-    """
-    log = logging.getLogger("CapBot")
-    log.debug(f"Fetching last {num_activities} activities for {len(users)} users.")
-
-    request_delay = 10
-    num_failures = 0
-    index = 0
-    activity_dict = {}
-    while index < len(users):
-        if cancel_event.is_set():
-            return activity_dict
-        
-        rsn = users[index]
-        try:
-            time.sleep(0) # delay between each request to reduce 429 errors
-
-            log.debug(f"Fetching alog for {rsn}")
-            activities = fetch_user_activites(rsn, num_activities)
-            activity_dict[rsn] = ActivityLog(private=False, activities=activities)
-
-            index += 1
-            request_delay = 10 # Reset as we had a success
-
-        except PrivateProfileException:
-            log.warning(f"Failed to fetch activities for {rsn}: runemetrics profile is private")
-            activity_dict[rsn] = ActivityLog(private=True, activities=[])
-            index += 1
-
-        except HTTPError as http_error:
-            if http_error.response.status_code == 429: # Too many requests
-                log.warning(f"Received 'Too many requests' response. Waiting {request_delay} seconds")
-                time.sleep(request_delay)
-                request_delay *= 2 # double each time
-                if request_delay > 100:
-                    log.error("Max request delay exceeded. Skipping further requests")
-                    break
-                # Don't increment index so we retry
-                continue
-            raise http_error # unhandled; fallback to below block
-        
-        except Exception as ex:
-            log.exception(f"Failed to fetch user activities for {rsn}: {ex}")
-            num_failures += 1
-            if num_failures > MAX_FAILURES:
-                log.error(f"Exceeded max failures for fetching user activites. Stopping further queries.")
-                return activity_dict
-            index += 1 # skip this user
-            continue
-    
-    return activity_dict
-
-def update_task(cancel_event:threading.Event):
-    """
-    Background task to update the activity database for all the clan members.
-
-    To avoid having a very large delay between someone capping and the bot detecting it, we have to do a fair amount of work due to the API limits.
-    The API only allows roughly 15-20 requests/minute and is very aggressive with 'Too many request' errors which force you to wait an additional 10-30 seconds.
-    To deal with this we only query 20 users each update and run the update more often.
-    We also only query users who have recent (1 week) activity to bias more active players, but we force an update for a player if we haven't checked in over a day.
-    If a users's alog is private we also only check once a day.
-    """
-    log = logging.getLogger(LOG_NAME)
-    start_time = time.time()
-    log.debug("Starting update_task...")
-
-    # Fetch all clan members from rs api so we always have up to date list.
-    try:
-        log.info(f"Fetching clan members for {CLAN_NAME}")
-        clan_members:list[ClanMember] = fetch_clan_members(CLAN_NAME)
-    except Exception as ex:
-        log.exception(f"Failed to fetch clan members for {CLAN_NAME}: {ex}")
-        return
-
-    with get_db() as dbcon:
-        # Insert any new rsns into the activity table. We default the timestamps to 0 to ensure they'll be queried in the next step.
-        rows = [(member.rsn,0,0) for member in clan_members]
-        cur = dbcon.executemany("INSERT OR IGNORE INTO user_activity(rsn, last_activity_timestamp, last_query_timestamp) VALUES(?,?,?)", rows)
-        log.debug(f"Added {cur.rowcount} new users into the user_activity table.")
-
-        # Get all users that have been active in the last week, or we haven't checked recently.
-        # Only query a few at a time as it's very slow due to Jagex rate limits.
-        cur = dbcon.execute(f"SELECT rsn FROM user_activity ORDER BY last_query_timestamp ASC LIMIT {MAX_USER_QUERIES}")
-        users_to_query = [row[0] for row in cur.fetchall()]
-
-    if len(users_to_query) == 0:
-        log.debug("No users to query.")
-        return
-
-    cap_events = []
-    latest_activities = []
-    private_profiles = set()
-
-    # Query the user alogs. 
-    user_activities:dict[str, ActivityLog] = get_user_activities(users_to_query, cancel_event)
-
-    for rsn, activity_log in user_activities.items():
-        if activity_log.private:
-            private_profiles.add(rsn)
-            continue
-
-        # Find any cap events
-        for activity in get_cap_events(activity_log.activities):
-            timestamp = get_date_timestamp(activity.date)
-            cap_events.append({"rsn": rsn, "cap_timestamp": timestamp})
-
-        # Get latest activity date, which is always the first activity in the list
-        if len(activity_log.activities) > 0:
-            timestamp = get_date_timestamp(activity_log.activities[0].date)
-            latest_activities.append({"rsn": rsn, "last_activity_timestamp": timestamp})
-
-    with get_db() as dbcon:
-        # Add new cap events
-        insert_rows = [(event["rsn"], event["cap_timestamp"], "auto") for event in cap_events]
-        cur = dbcon.executemany("INSERT OR IGNORE INTO cap_events(rsn, cap_timestamp, source) VALUES(?,?,?)", insert_rows)
-        log.debug(f"Inserted {cur.rowcount} new rows into cap_events. Rows = {insert_rows}")
-
-        # Update user_activity table with last activities/query time.
-        # Hard-coding private to false since it can't be true if we have activities.
-        now = datetime.now(timezone.utc).timestamp()
-        user_activity_rows = [(event["last_activity_timestamp"], now, event["rsn"]) for event in latest_activities]
-        cur = dbcon.executemany("UPDATE user_activity SET last_activity_timestamp = ?, last_query_timestamp = ?, private = 0 WHERE rsn = ?", user_activity_rows)
-        log.debug(f"Updated last_activity_timestamp for {cur.rowcount} rows in user_activity. Rows = {user_activity_rows}")
-
-        # Update query time for users we queried but got no activity data from. This may be due to private alogs.
-        no_activity_rows = [(now, (1 if rsn in private_profiles else 0), rsn) for rsn in users_to_query if rsn not in user_activities or len(user_activities[rsn].activities) == 0]
-        cur = dbcon.executemany("UPDATE user_activity SET last_query_timestamp = ?, private = ? WHERE rsn = ?", no_activity_rows)
-        log.debug(f"Updated last_query_timestamp for {cur.rowcount} in-active users in user_activity. Rows = {no_activity_rows}")
-
-    log.debug(f"update_task completed after {time.time() - start_time} seconds.")
+def format_duration(seconds:float|None) -> str:
+    """ Formats a number of seconds as e.g. "2d 4h", "1h 5m", "12m 30s" or "0.25s". """
+    if seconds is None or seconds != seconds: # None or NaN
+        return "n/a"
+    if seconds < 60:
+        return f"{seconds:.2f}s" if seconds < 10 else f"{seconds:.0f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f"{days}d {hours}h"
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m {seconds}s"
 
 class DiscordClient(discord.Client):
     def __init__(self, intents:discord.Intents):
         super().__init__(intents=intents)
         self.tree = app_commands.CommandTree(self)
-        self.logger = logging.getLogger(LOG_NAME)
-        self.guild_id = discord.Object(id=os.getenv("GUILD_ID"))
-        self.task_thread = None
-        self.task_cancel_event = threading.Event()
+        self.logger = logging.getLogger(COMMANDS_LOG)
+        self.metrics_runner = None
+
+    def get_command_tree_fingerprint(self, guild:discord.Object) -> str:
+        """ Hash of the command definitions discord would be sent for this server. """
+        commands = sorted((command.to_dict(self.tree) for command in self.tree.get_commands(guild=guild)), key=lambda command: command["name"])
+        return hashlib.sha256(json.dumps(commands, sort_keys=True).encode("utf-8")).hexdigest()
+
+    async def sync_commands(self):
+        """
+        Copies our slash commands to each discord server we're running in. Syncing is a rate limited round trip per
+        server, so it's skipped if the commands haven't changed since the last sync. Set CAPBOT_FORCE_SYNC to always sync.
+        """
+        database = get_database()
+        force = bool(os.getenv("CAPBOT_FORCE_SYNC"))
+        for guild_id in sorted({clan.guild_id for clan in CLANS}):
+            guild = discord.Object(id=guild_id)
+            self.tree.copy_global_to(guild=guild)
+            key = f"{COMMAND_TREE_KEY_PREFIX}{self.application_id}:{guild_id}"
+            fingerprint = self.get_command_tree_fingerprint(guild)
+            state = await database.read(get_state, key)
+            if not force and state is not None and state[0] == fingerprint:
+                self.logger.debug("Commands for guild %d are unchanged, skipping sync.", guild_id)
+                continue
+            await self.tree.sync(guild=guild)
+            await database.write(set_state, key, fingerprint, time.time())
+            self.logger.info("Synced commands to guild %d.", guild_id)
 
     async def setup_hook(self):
-        # Copy our slash commands to the discord server we're running in.
-        self.tree.copy_global_to(guild=self.guild_id)
-        await self.tree.sync(guild=self.guild_id)
-
-    async def on_ready(self):
-        self.logger.debug(f'Logged on as {self.user}!')
+        # We've logged in by now, so start scanning straight away rather than waiting for the gateway to be ready.
+        # The schedule and the rate limiter's learnt rate and any penalty are all restored from disk, so this is safe.
         if not os.getenv("CAPBOT_DISABLE_SCAN_TASK", False):
-            # Kick off the update task. We could do this earlier but this way we don't have to wait on it if login fails.
             self.logger.debug("Starting update_database_task.")
             self.update_database_task.start()
         else:
             self.logger.info("Not starting update_database_task due to 'CAPBOT_DISABLE_SCAN_TASK' being set.")
 
+        await self.sync_commands()
+
+        # Only serve metrics if asked to. It's bound to localhost for a local Prometheus to scrape.
+        metrics_port = os.getenv("CAPBOT_METRICS_PORT")
+        if metrics_port:
+            self.metrics_runner = await start_metrics_server(int(metrics_port))
+            self.logger.info("Serving metrics on http://127.0.0.1:%s/metrics", metrics_port)
+
+    async def on_ready(self):
+        self.logger.debug("Logged on as %s!", self.user)
+
     async def close(self):
-        # Kill the update thread before shutting down.
-        self.logger.debug("Waiting for update_task thread to exit...")
-        if self.task_thread and self.task_thread.is_alive():
-            self.task_cancel_event.set()
-            self.task_thread.join(timeout=30)
-            if self.task_thread.is_alive():
-                self.logger.error("Timed out waiting for update_task thread to join.")
+        # Cancel the update task before shutting down. It only ever waits on the event loop so this is immediate.
+        self.logger.debug("Cancelling update_database_task...")
+        self.update_database_task.cancel()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        # It's otherwise only saved after each update, so keep what it's learnt since then for the next start.
+        rate_limiter.save()
+        await close_session()
+        close_db()
         await super().close()
 
     @tasks.loop(minutes=UPDATE_LOOP_MINUTES)
     async def update_database_task(self):
-        """ Scheduled looping update to run the background update. """
-        if self.task_thread and self.task_thread.is_alive():
-            self.logger.error("update_task thread is still alive. Skipping update")
-            return
+        """ Scheduled looping update to run the background update. The loop won't start the next update until this one finishes. """
+        log = logging.getLogger(SCHEDULER_LOG)
+        log.debug("Starting update_task")
+        start_time = time.time()
+        try:
+            await update_task(CLANS)
+        except asyncio.CancelledError:
+            log.debug("update_task cancelled.")
+            raise
+        except Exception as ex:
+            update_failures.inc()
+            log.exception("update_task failed: %s", ex)
 
-        self.logger.debug("Starting update_task thread")
-        self.task_thread = threading.Thread(target=update_task, args=(self.task_cancel_event,))
-        self.task_thread.start()
+        # So a crash doesn't lose what the rate limiter learnt, or a penalty we're still waiting out.
+        await rate_limiter.save_async()
+
+        duration = time.time() - start_time
+        update_cycle_seconds.observe(duration)
+        skipped = int(duration // (UPDATE_LOOP_MINUTES * 60))
+        if skipped > 0:
+            update_skipped_cycles.inc(skipped)
+            log.warning("update_task took %.0f seconds, skipping %d update(s).", duration, skipped)
 
 
 intents = discord.Intents.default()
 discord_client = DiscordClient(intents)
 
-def create_table(column_names:list[str], rows:list[list[str]], newline:str='\n'):
-    # Find longest strings in each column so we can pad out the rest to match.
-    column_widths:list[int] = [0] * len(column_names)
-    for row in rows + [column_names]:
-        for i in range(len(column_names)):
-            column_widths[i] = max(column_widths[i], len(str(row[i])))
-
-    # Compute table size
-    vertical_bars = len(column_names) + 1
-    padding = len(column_names) * 2
-    table_width = sum(column_widths) + vertical_bars + padding
-
-    def horizontal_line():
-        return ('-' * table_width) + newline
-    
-    table = horizontal_line()
-    table += "|" + "|".join([f" {column_names[i]:<{column_widths[i]}} " for i in range(len(column_widths))]) + "|" + newline
-    table += horizontal_line()
-
-    for row in rows:
-        table += "|" + "|".join([f" {row[i]:<{column_widths[i]}} " for i in range(len(column_widths))]) + "|" + newline
-    table += horizontal_line()
-    return table
+async def get_cached(key:tuple, render):
+    """ result_cache.get_or_compute, after checking whether a worker process has stored new data since we last looked. """
+    result_cache.sync_external_generation(await get_database().read(get_data_generation))
+    return await result_cache.get_or_compute(key, render)
+
+async def get_interaction_clan(interaction:discord.Interaction) -> ClanConfig|None:
+    """ Returns the clan linked to the server a command was used in. Replies with an error and returns None if there isn't one. """
+    clan = get_clan_for_guild(CLANS, interaction.guild_id)
+    if clan is None:
+        await interaction.response.send_message("This server isn't linked to a clan.", ephemeral=True)
+    return clan
+
+# Each clan's autocomplete index and the result_cache generation it was built at. Kept out of result_cache itself so
+# autocomplete keystrokes don't push out command results or count towards its hit rate.
+_rsn_indexes:dict[str, tuple[int, RsnIndex]] = {}
+
+async def get_rsn_index(clan:ClanConfig) -> RsnIndex:
+    """ Everyone who's been in the clan, for autocompleting rsn parameters. Rebuilt when the data changes. """
+    result_cache.sync_external_generation(await get_database().read(get_data_generation))
+    generation = result_cache.generation
+    cached = _rsn_indexes.get(clan.name)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    rows = await get_database().fetch_all("""
+        SELECT ua.rsn FROM user_activity ua
+        WHERE ua.canonical_rsn IS NOT NULL AND EXISTS (SELECT 1 FROM clan_members cm WHERE cm.rsn = ua.rsn AND cm.clan_name = ?)
+        """, (clan.name,))
+    index = RsnIndex([rsn for rsn, in rows])
+    _rsn_indexes[clan.name] = (generation, index)
+    return index
+
+async def autocomplete_rsn(interaction:discord.Interaction, current:str) -> list[app_commands.Choice[str]]:
+    clan = get_clan_for_guild(CLANS, interaction.guild_id)
+    if clan is None:
+        return []
+    index = await get_rsn_index(clan)
+    return [app_commands.Choice(name=rsn, value=rsn) for rsn in index.search(current)]
 
 @discord_client.tree.command(name="caplist", description="Get the list of users that have capped in the last N days.")
 async def caplist(interaction:discord.Interaction, days:int=7):
-    now = datetime.now(timezone.utc)
-    start_date = now - timedelta(days=days)
-    timestamp = int(start_date.timestamp()) # Truncate as we only care about seconds
-    with get_db() as db:
-        con = db.execute(f"SELECT rsn,cap_timestamp FROM cap_events WHERE cap_timestamp >= {timestamp}")
-        rows = [(row[0], row[1]) for row in con.fetchall()]
+    clan = await get_interaction_clan(interaction)
+    if clan is None:
+        return
+
+    async def render() -> list[str]:
+        timestamp = get_offset_from_now_timestamp(timedelta(days=days))
+        results = await get_database().fetch_all("SELECT rsn,cap_timestamp FROM cap_events WHERE clan_name = ? AND cap_timestamp >= ?", (clan.name, timestamp))
+        rows = [(row[0], row[1]) for row in results]
         rows.sort(key=lambda pair: pair[1], reverse=True) # sort by date
 
         column_headers = ["RSN", "Cap Date (Game Time)"]
         rows = [[rsn, timestamp_to_date(cap_timestamp)] for rsn, cap_timestamp in rows]
-        message = f"### Users that Capped in the last {days} days\n"
-        message += f"```\n{create_table(column_headers, rows)}```"
-    await interaction.response.send_message(message, ephemeral=True)
+        return paginate_table(f"### Users that Capped in the last {days} days", column_headers, rows)
+
+    pages = await get_cached(("caplist", clan.name, days), render)
+    await send_pages(interaction, pages)
 
 @discord_client.tree.command(name="captotal", description="Lists the total number of times each member has capped.")
 async def captotal(interaction:discord.Interaction, days:int=0):
-    now = datetime.now(timezone.utc)
-    start_date = now - timedelta(days=days) if days > 0 else datetime(year=1995, month=1, day=1)
-    timestamp = int(start_date.timestamp()) # Truncate as we only care about seconds
-    with get_db() as db:
-        con = db.execute(f"""
-            SELECT 
-                rsn,
-                COUNT(rsn) as cap_count 
-            FROM cap_events 
-            WHERE cap_timestamp >= {timestamp}
-            GROUP BY rsn
-            ORDER BY cap_count DESC""")
-        rows = [(row[0], row[1]) for row in con.fetchall()]
+    clan = await get_interaction_clan(interaction)
+    if clan is None:
+        return
+
+    async def render() -> tuple[str, bytes]:
+        timestamp = get_offset_from_now_timestamp(timedelta(days=days)) if days > 0 else None
+        rows = await get_database().read(get_cap_totals, clan.name, timestamp)
 
         column_headers = ["RSN", "Total Citadel Caps"]
         rows = [[rsn, cap_count] for rsn, cap_count in rows]
         message = f"### Total Citadel Caps per user"
         message += f" in the last {days} days" if days > 0 else ""
+        return message, table_to_bytes(column_headers, rows)
+
+    message, table = await get_cached(("captotal", clan.name, days), render)
+    await interaction.response.send_message(message, file=make_file(table, "captotal.txt"), ephemeral=True)
 
-        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
-            temp_filename = f.name
-            table = create_table(column_headers, rows)
-            f.write(table)
-            f.close()
-            try:
-                await interaction.response.send_message(message, file=discord.File(temp_filename), ephemeral=True)
-            finally:
-                os.remove(temp_filename)
+@discord_client.tree.command(name="cap-report", description="Cap attendance and streaks for the clan over the last N citadel weeks.")
+@app_commands.describe(weeks="Completed citadel weeks to report on (13 is a quarter)", missed="List members who haven't capped in this many weeks")
+async def cap_report(interaction:discord.Interaction, weeks:app_commands.Range[int, 1, 520]=13, missed:app_commands.Range[int, 1, 520]=4):
+    clan = await get_interaction_clan(interaction)
+    if clan is None:
+        return
+
+    async def render() -> tuple[str, bytes]:
+        report = await get_database().read(build_report, clan.name, time.time(), weeks, missed)
+        message = f"### Citadel attendance over the last {weeks} weeks\n"
+        message += f"Capped every week ({len(report.perfect)}): {', '.join(report.perfect) or 'Nobody'}\n"
+        message += f"Not capped in the last {missed} weeks ({len(report.missed)}): {', '.join(report.missed) or 'Nobody'}\n"
+        if len(message) > MESSAGE_LIMIT:
+            suffix = "...\n(see the attachment for everyone)"
+            message = message[:MESSAGE_LIMIT - len(suffix)] + suffix
+
+        column_headers = ["RSN", "Attendance", "Weeks Capped", "Current Streak", "Longest Streak", "Last Cap Week"]
+        rows = [[row.rsn,
+                 f"{row.attendance:.0%}" if row.eligible_weeks else "n/a",
+                 f"{row.weeks_capped}/{row.eligible_weeks}",
+                 row.current_streak,
+                 row.longest_streak,
+                 timestamp_to_date(get_week_index_start(row.last_cap_week)).split(" ")[0] if row.last_cap_week is not None else "Never"]
+                for row in report.rows]
+        return message, table_to_bytes(column_headers, rows)
+
+    message, table = await get_cached(("cap-report", clan.name, weeks, missed), render)
+    await interaction.response.send_message(message, file=make_file(table, "cap-report.txt"), ephemeral=True)
+
+@discord_client.tree.command(name="cap-export", description="Export cap history or member stats as a CSV or JSON Lines file.")
+@app_commands.describe(start="YYYY-MM-DD, inclusive", end="YYYY-MM-DD, inclusive", rsn="Only this member")
+async def cap_export(interaction:discord.Interaction, table:Literal["caps", "members"]="caps", format:Literal["csv", "jsonl"]="csv",
+                     start:str=None, end:str=None, rsn:str=None):
+    clan = await get_interaction_clan(interaction)
+    if clan is None:
+        return
+    try:
+        options = ExportOptions(clan_name=clan.name, table=table, format=format, rsn=rsn,
+                                start=parse_export_date(start) if start else None,
+                                end=parse_export_end_date(end) if end else None)
+    except ValueError:
+        await interaction.response.send_message("Dates need to be in YYYY-MM-DD format.", ephemeral=True)
+        return
+
+    # A big export can take a while, and discord only waits 3 seconds for a response.
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    limit = interaction.guild.filesize_limit if interaction.guild is not None else discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as out:
+        stats = await get_database().read(write_export, options, out)
+        if stats.bytes > limit:
+            await interaction.followup.send(f"The export is {stats.bytes / 1024 / 1024:.1f}MB, over discord's {limit / 1024 / 1024:.0f}MB limit. "
+                                            "Try a narrower date range, or use export.py on the bot's host.", ephemeral=True)
+            return
+        out.seek(0)
+        await interaction.followup.send(f"Exported {stats.rows} rows.", file=discord.File(out, filename=get_export_filename(options, stats.compressed)), ephemeral=True)
+
+cap_export.autocomplete("rsn")(autocomplete_rsn)
 
 @discord_client.tree.command(name="list-private-alogs", description="List any users that have their alog set to private")
 async def list_private_alogs(interaction:discord.Interaction):
-    with get_db() as db:
-        cur = db.execute("SELECT rsn FROM user_activity WHERE private=1")
-        results = cur.fetchall()
-        rsns = [f"- {row[0]}" for row in results]
-        message = "### Users with private Alogs:\n" + "\n".join(rsns)
-        if len(rsns) == 0:
-            message += "None"
-        await interaction.response.send_message(message, ephemeral=True)
+    clan = await get_interaction_clan(interaction)
+    if clan is None:
+        return
+
+    results = await get_database().fetch_all("""
+        SELECT ua.rsn FROM user_activity ua
+        JOIN clan_members cm ON cm.rsn = ua.rsn AND cm.clan_name = ? AND cm.departed_timestamp IS NULL
+        WHERE ua.private=1
+        """, (clan.name,))
+    rsns = [f"- {row[0]}" for row in results]
+    message = "### Users with private Alogs:\n" + "\n".join(rsns)
+    if len(rsns) == 0:
+        message += "None"
+    await interaction.response.send_message(message, ephemeral=True)
 
 @discord_client.tree.command(name="user-status", description="Print cap/scan information about a user. If no user is specified it will dump info for all users.")
 async def user_status(interaction:discord.Interaction, rsn:str=None):
-    with get_db() as db:
-        if rsn is not None:
-            cur = db.execute("""
-                SELECT
-                    ua.last_activity_timestamp,
-                    ua.last_query_timestamp,
-                    ua.private,
-                    (
-                        SELECT ce.cap_timestamp
-                        FROM cap_events ce
-                        WHERE ce.rsn = ua.rsn COLLATE NOCASE
-                        ORDER BY ce.cap_timestamp DESC
-                        LIMIT 1
-                    ) AS cap_timestamp
-                FROM user_activity ua
-                WHERE ua.rsn = ? COLLATE NOCASE;
-                """, (rsn,))
-            result = cur.fetchone()
-            if result:
-                message = f"### User Status For {rsn}:\n"
-                message += f"Last Activity Time: {format_timestamp_for_discord(int(result[0]))}\n"
-                message += f"Last Scan Time: {format_timestamp_for_discord(int(result[1]))}\n"
-                message += f"Last Cap Time: {format_timestamp_for_discord(int(result[3])) if result[3] else "Unknown"}\n"
-                message += f"Private ALog?: {'Yes' if result[2] == 1 else '`No`'}\n"
-                await interaction.response.send_message(message, ephemeral=True)
-            else:
-                await interaction.response.send_message(f"No matching rsn found.", ephemeral=True)
-        
-        else: # all users
-            cur = db.execute("""
-                SELECT
-                    ua.rsn,
-                    ua.last_activity_timestamp,
-                    ua.last_query_timestamp,
-                    ua.private,
-                    (
-                        SELECT ce.cap_timestamp
-                        FROM cap_events ce
-                        WHERE ce.rsn = ua.rsn COLLATE NOCASE
-                        ORDER BY ce.cap_timestamp DESC
-                        LIMIT 1
-                    ) AS cap_timestamp
-                FROM user_activity ua
-                ORDER BY ua.last_query_timestamp DESC
-                """)
-            results = cur.fetchall()
-            if not results:
-                await interaction.response.send_message("No records found.", ephemeral=True)
-                return
-
-            formatted_rows = [
-                [
-                    user_rsn,
-                    timestamp_to_date(int(last_activity)),
-                    timestamp_to_date(int(last_query)),
-                    timestamp_to_date(int(last_cap)) if last_cap else "Unknown",
-                    "Yes" if is_private == 1 else "No"
-                ]
-                for user_rsn, last_activity, last_query, is_private, last_cap in results
+    clan = await get_interaction_clan(interaction)
+    if clan is None:
+        return
+
+    # Only members, past or present, of this server's clan.
+    database = get_database()
+    if rsn is not None:
+        result = await database.fetch_one("""
+            SELECT
+                ua.rsn,
+                ua.last_activity_timestamp,
+                ua.last_query_timestamp,
+                ua.private,
+                s.last_cap_timestamp,
+                s.first_cap_timestamp,
+                s.cap_count
+            FROM user_activity ua
+            LEFT JOIN user_cap_summary s ON s.clan_name = ? AND s.rsn = ua.rsn
+            WHERE ua.canonical_rsn = ?
+                AND EXISTS (SELECT 1 FROM clan_members cm WHERE cm.rsn = ua.rsn AND cm.clan_name = ?);
+            """, (clan.name, canonical_rsn(rsn), clan.name))
+        if result:
+            message = f"### User Status For {result[0]}:\n"
+            message += f"Last Activity Time: {format_timestamp_for_discord(int(result[1]))}\n"
+            message += f"Last Scan Time: {format_timestamp_for_discord(int(result[2]))}\n"
+            message += f"Last Cap Time: {format_timestamp_for_discord(int(result[4])) if result[4] else 'Unknown'}\n"
+            message += f"First Cap Time: {format_timestamp_for_discord(int(result[5])) if result[5] else 'Unknown'}\n"
+            message += f"Total Caps: {result[6] or 0}\n"
+            message += f"Private ALog?: {'Yes' if result[3] == 1 else '`No`'}\n"
+            await interaction.response.send_message(message, ephemeral=True)
+        else:
+            await interaction.response.send_message(f"No matching rsn found.", ephemeral=True)
+    
+    else: # all users
+        results = await database.fetch_all("""
+            SELECT
+                ua.rsn,
+                ua.last_activity_timestamp,
+                ua.last_query_timestamp,
+                ua.private,
+                s.last_cap_timestamp,
+                s.cap_count
+            FROM user_activity ua
+            LEFT JOIN user_cap_summary s ON s.clan_name = ? AND s.rsn = ua.rsn
+            WHERE EXISTS (SELECT 1 FROM clan_members cm WHERE cm.rsn = ua.rsn AND cm.clan_name = ?)
+            ORDER BY ua.last_query_timestamp DESC
+            """, (clan.name, clan.name))
+        if not results:
+            await interaction.response.send_message("No records found.", ephemeral=True)
+            return
+
+        formatted_rows = [
+            [
+                user_rsn,
+                timestamp_to_date(int(last_activity)),
+                timestamp_to_date(int(last_query)),
+                timestamp_to_date(int(last_cap)) if last_cap else "Unknown",
+                cap_count or 0,
+                "Yes" if is_private == 1 else "No"
             ]
-            with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
-                temp_filename = f.name
-                table = create_table(["Rsn", "Last Activity Date", "Last Scan Date", "Last Cap Date", "Private ALog"], formatted_rows)
-                f.write(table)
-            try:
-                await interaction.response.send_message("Full user status summary:", file=discord.File(temp_filename), ephemeral=True)
-            finally:
-                os.remove(temp_filename)
+            for user_rsn, last_activity, last_query, is_private, last_cap, cap_count in results
+        ]
+        table = table_to_bytes(["Rsn", "Last Activity Date", "Last Scan Date", "Last Cap Date", "Total Caps", "Private ALog"], formatted_rows)
+        await interaction.response.send_message("Full user status summary:", file=make_file(table, "user-status.txt"), ephemeral=True)
+
+user_status.autocomplete("rsn")(autocomplete_rsn)
+
+@discord_client.tree.command(name="capbot-stats", description="Show how the background scanner, rate limiter and cache are performing.")
+async def capbot_stats(interaction:discord.Interaction):
+    limiter = rate_limiter.stats()
+    budget = rate_limiter.budget()
+    cache = result_cache.stats()
+    message = "### CapBot Stats\n"
+    message += f"Uptime: {format_duration(uptime.value)}\n"
+    message += (f"Update cycles: {update_cycle_seconds.count} ({int(update_failures.value)} failed, {int(update_skipped_cycles.value)} skipped). "
+                f"Last took {format_duration(update_cycle_seconds.last)}, p50 <= {format_duration(update_cycle_seconds.quantile(0.5))}, "
+                f"p95 <= {format_duration(update_cycle_seconds.quantile(0.95))}\n")
+    message += f"Users scanned: {int(users_scanned.sum)} total, {users_scanned.last if users_scanned.last is not None else 'n/a'} last cycle\n"
+    message += (f"Requests: {limiter.requests} sent, {limiter.throttled} got 429s, {format_duration(limiter.penalty_wait_seconds)} spent backing off. "
+                f"Latency p50 <= {format_duration(request_seconds.quantile(0.5))}, p95 <= {format_duration(request_seconds.quantile(0.95))}\n")
+    message += f"Rate limit: {budget.requests_per_minute:.1f} requests/minute\n"
+    message += f"Clan roster age: {format_duration(roster_staleness.value)}\n"
+    message += (f"Cap detection lag: {cap_detection_lag_seconds.count} caps, p50 <= {format_duration(cap_detection_lag_seconds.quantile(0.5))}, "
+                f"p90 <= {format_duration(cap_detection_lag_seconds.quantile(0.9))}, max {format_duration(cap_detection_lag_seconds.max)}\n")
+    message += f"Result cache: {cache.entries} entries, {cache.hits} hits, {cache.misses} misses\n"
+    await interaction.response.send_message(message, ephemeral=True)
+
+@discord_client.tree.command(name="capbot-log-level", description="Change how much CapBot logs, for one subsystem or all of them, until it restarts.")
+@app_commands.default_permissions(manage_guild=True)
+async def capbot_log_level(interaction:discord.Interaction, level:Literal["DEBUG", "INFO", "WARNING", "ERROR"],
+                           subsystem:Literal["all", "fetcher", "scheduler", "commands"]="all"):
+    # Logging is process wide, so this applies to every clan the bot serves.
+    set_log_level(subsystem, level)
+    discord_client.logger.info("Log level for %s set to %s by %s.", subsystem, level, interaction.user)
+    levels = ", ".join(f"{name} {effective}" for name, effective in get_log_levels().items())
+    await interaction.response.send_message(f"Log levels: {levels}", ephemeral=True)
 
 
 def run_bot():
-    global CLAN_NAME
-    CLAN_NAME = os.getenv("CAPBOT_CLAN_NAME")
+    global CLANS
+    CLANS = load_clan_configs()
 
-    init_db()
+    database = init_db()
+    if len(CLANS) == 1:
+        with database.transaction() as con:
+            assign_unattributed_caps(con, CLANS[0].name)
 
     token = os.getenv("CAPBOT_TOKEN")
     discord_client.run(token=token)
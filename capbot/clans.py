@@ -0,0 +1,68 @@
+import os
+import logging
+from dataclasses import dataclass
+
+from log import LOG_NAME
+from db import rebuild_cap_summary
+from attendance import rebuild_week_bits
+
+@dataclass
+class ClanConfig:
+    name:str
+    guild_id:int
+
+def parse_clan_configs(value:str) -> list[ClanConfig]:
+    """ Parses CAPBOT_CLANS, a comma separated list of clan_name=guild_id pairs. e.g. "My Clan=1234,Other Clan=5678" """
+    clans = []
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        name, _, guild_id = entry.rpartition("=")
+        if not name.strip():
+            raise ValueError(f"Expected clan_name=guild_id in CAPBOT_CLANS, got '{entry}'")
+        clans.append(ClanConfig(name=name.strip(), guild_id=int(guild_id)))
+    return clans
+
+def load_clan_configs() -> list[ClanConfig]:
+    """ Reads the clans to track from CAPBOT_CLANS, falling back to the single CAPBOT_CLAN_NAME/GUILD_ID pair. """
+    value = os.getenv("CAPBOT_CLANS")
+    if value:
+        clans = parse_clan_configs(value)
+    elif os.getenv("CAPBOT_CLAN_NAME"):
+        guild_id = os.getenv("GUILD_ID")
+        if not guild_id:
+            raise ValueError("CAPBOT_CLAN_NAME is set but GUILD_ID isn't. Set GUILD_ID to the discord server the clan uses, or use CAPBOT_CLANS.")
+        clans = [ClanConfig(name=os.getenv("CAPBOT_CLAN_NAME"), guild_id=int(guild_id))]
+    else:
+        clans = []
+    if not clans:
+        logging.getLogger(LOG_NAME).warning("No clans configured. Set CAPBOT_CLANS or CAPBOT_CLAN_NAME and GUILD_ID.")
+    return clans
+
+def get_clan_for_guild(clans:list[ClanConfig], guild_id:int|None) -> ClanConfig|None:
+    for clan in clans:
+        if clan.guild_id == guild_id:
+            return clan
+    return None
+
+def assign_unattributed_caps(dbcon, clan_name:str) -> int:
+    """
+    Gives cap_events rows with no clan to the given clan. Used when only one clan is configured, for caps recorded before
+    clans were tracked that the migration couldn't match to a roster.
+    """
+    assigned = dbcon.execute("UPDATE cap_events SET clan_name = ? WHERE clan_name IS NULL", (clan_name,)).rowcount
+    # The update trigger moves their weekly rollups, but not caps that have already been compacted.
+    moved = dbcon.execute("""
+        INSERT INTO cap_weekly_rollups(clan_name, rsn, week_start, compacted_count, first_compacted_timestamp, last_compacted_timestamp)
+        SELECT ?, rsn, week_start, compacted_count, first_compacted_timestamp, last_compacted_timestamp
+        FROM cap_weekly_rollups WHERE clan_name = '' AND compacted_count > 0
+        ON CONFLICT(clan_name, week_start, rsn) DO UPDATE SET
+            compacted_count = compacted_count + excluded.compacted_count,
+            first_compacted_timestamp = MIN(COALESCE(first_compacted_timestamp, excluded.first_compacted_timestamp), excluded.first_compacted_timestamp),
+            last_compacted_timestamp = MAX(COALESCE(last_compacted_timestamp, excluded.last_compacted_timestamp), excluded.last_compacted_timestamp)
+        """, (clan_name,)).rowcount
+    dbcon.execute("DELETE FROM cap_weekly_rollups WHERE clan_name = ''")
+    if assigned or moved:
+        rebuild_week_bits(dbcon)
+        rebuild_cap_summary(dbcon)
+    return assigned
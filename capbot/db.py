@@ -1,38 +1,522 @@
+import os
 import sqlite3
+import asyncio
 import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-def init_db():
-    con = sqlite3.connect("capdata.db")
-    with con:
-        cur = con.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS cap_events(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                rsn TEXT NOT NULL,
-                cap_timestamp INTEGER NOT NULL,
-                source TEXT,
-                manual_user TEXT,
-                
-                UNIQUE(rsn, cap_timestamp)
-            )
+from log import LOG_NAME
+
+DB_PATH = os.getenv("CAPBOT_DB_PATH", "capdata.db")
+# WAL needs shared memory, so it only works when every process using the database is on the same host.
+# Workers on other hosts sharing the database over a network filesystem need DELETE (or TRUNCATE) instead.
+JOURNAL_MODE = os.getenv("CAPBOT_DB_JOURNAL_MODE", "WAL")
+READ_POOL_SIZE = 2
+# bot_state key the live scanner touches every update, each time it rebuilds the poll schedule.
+SCANNER_HEARTBEAT_KEY = "scanner_heartbeat"
+# bot_state key touched whenever a clan roster gains or loses members, so workers know the schedule needs rebuilding.
+ROSTER_CHANGED_KEY = "roster_changed"
+# bot_state key counting changes to the data commands show, so processes can tell when their caches are stale.
+DATA_GENERATION_KEY = "data_generation"
+
+def create_schema(cur):
+    """ Creates any missing tables and indexes. Changes to existing tables go in MIGRATIONS instead. """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cap_events(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            rsn TEXT NOT NULL,
+            cap_timestamp INTEGER NOT NULL,
+            source TEXT,
+            manual_user TEXT,
+            
+            UNIQUE(rsn, cap_timestamp)
+        )
+    """)
+
+    # Index for primary query we do in /caplist
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_cap_query ON cap_events(rsn,cap_timestamp)")
+    # For time range scans across every clan, like retention compaction.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_cap_timestamp ON cap_events(cap_timestamp)")
+
+    # Caps per member per citadel week, so windowed totals only have to read whole weeks instead of every event.
+    # cap_count is maintained by triggers on cap_events (see rollups.py), compacted_count holds caps whose cap_events
+    # rows have been removed by the retention policy.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cap_weekly_rollups(
+            clan_name TEXT NOT NULL,
+            rsn TEXT NOT NULL,
+            week_start INTEGER NOT NULL,
+            cap_count INTEGER NOT NULL DEFAULT 0,
+            compacted_count INTEGER NOT NULL DEFAULT 0,
+            first_compacted_timestamp INTEGER,
+            last_compacted_timestamp INTEGER,
+
+            PRIMARY KEY(clan_name, week_start, rsn)
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_activity(
+            rsn TEXT PRIMARY KEY,
+            last_activity_timestamp INTEGER NOT NULL,
+            last_query_timestamp INTEGER NOT NULL,
+            private TINYINT DEFAULT 0
+        )
+    """)
+
+    # NOTE: likely won't need an index on user_activity as the table size is fixed to the number of clan members
+    # which cannot be more than a few hundred.
+
+    # Polling priority queue maintained by scheduler.py. Rebuilt every update so it never needs migrating.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS poll_schedule(
+            rsn TEXT PRIMARY KEY,
+            weight REAL NOT NULL,
+            poll_interval REAL NOT NULL,
+            next_poll_timestamp REAL NOT NULL
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_poll_schedule_next ON poll_schedule(next_poll_timestamp)")
+
+    # Cached clan roster. content_hash lets us skip re-processing members_lite.ws when it hasn't changed.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS clan_roster(
+            clan_name TEXT PRIMARY KEY,
+            content_hash TEXT,
+            last_refresh_timestamp REAL NOT NULL
+        )
+    """)
+
+    # Clan membership history. Departed members keep their row (and cap history) but are no longer scanned.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS clan_members(
+            clan_name TEXT NOT NULL,
+            rsn TEXT NOT NULL,
+            rank TEXT,
+            joined_timestamp REAL NOT NULL,
+            departed_timestamp REAL,
+
+            PRIMARY KEY(clan_name, rsn)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_clan_members_rsn ON clan_members(rsn)")
+
+    # Newest alog entry we've seen for each user so we only have to look at entries after it,
+    # and how many alog entries per second they generate so we know how many to ask for.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS activity_watermarks(
+            rsn TEXT PRIMARY KEY,
+            activity_date TEXT NOT NULL,
+            activity_text TEXT NOT NULL,
+            activity_rate REAL
+        )
+    """)
+
+    # One bit per citadel week each member capped in, per clan, for attendance and streak reports (see attendance.py).
+    # first_week is the week index of the lowest set bit and bits holds the rest little-endian, so it stays a few bytes.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cap_week_bits(
+            clan_name TEXT NOT NULL,
+            rsn TEXT NOT NULL,
+            first_week INTEGER NOT NULL,
+            bits BLOB NOT NULL,
+
+            PRIMARY KEY(clan_name, rsn)
+        )
+    """)
+
+    # Small key/value store for state shared between processes, such as the live scanner's heartbeat.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bot_state(
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_timestamp REAL NOT NULL
+        )
+    """)
+
+    # Leases held by worker.py processes on users they're scanning and on shared jobs like the schedule refresh.
+    # A lease that's past its expiry is free to take, so a crashed worker's work gets picked up by the others.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS scan_leases(
+            lease_key TEXT PRIMARY KEY,
+            worker_id TEXT NOT NULL,
+            expires_timestamp REAL NOT NULL
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_scan_leases_worker ON scan_leases(worker_id)")
+
+    # Checkpoints for backfill.py so an interrupted backfill carries on where it stopped.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_runs(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            clan_name TEXT NOT NULL,
+            started_timestamp REAL NOT NULL,
+            finished_timestamp REAL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_progress(
+            run_id INTEGER NOT NULL,
+            rsn TEXT NOT NULL,
+            completed_timestamp REAL NOT NULL,
+            caps_found INTEGER NOT NULL,
+
+            PRIMARY KEY(run_id, rsn)
+        )
+    """)
+
+def get_state(con, key:str) -> tuple[str, float]|None:
+    """ Returns (value, updated_timestamp) for a bot_state key, or None if it's never been set. """
+    return con.execute("SELECT value, updated_timestamp FROM bot_state WHERE key = ?", (key,)).fetchone()
+
+def set_state(con, key:str, value, now:float):
+    con.execute("INSERT OR REPLACE INTO bot_state(key, value, updated_timestamp) VALUES(?,?,?)", (key, None if value is None else str(value), now))
+
+def get_data_generation(con) -> int:
+    state = get_state(con, DATA_GENERATION_KEY)
+    return int(state[0]) if state is not None else 0
+
+def bump_data_generation(con, now:float):
+    con.execute("""
+        INSERT INTO bot_state(key, value, updated_timestamp) VALUES(?, '1', ?)
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1, updated_timestamp = excluded.updated_timestamp
+        """, (DATA_GENERATION_KEY, now))
+
+def add_column(con, table:str, column:str, definition:str):
+    """ Adds a column to an existing table if it isn't already there. """
+    columns = [row[1] for row in con.execute(f"PRAGMA table_info({table})").fetchall()]
+    if column not in columns:
+        con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def migrate_add_private(con):
+    # Databases created before the private column was added to user_activity.
+    add_column(con, "user_activity", "private", "TINYINT DEFAULT 0")
+
+def rebuild_cap_summary(con):
+    """
+    Recomputes user_cap_summary from cap_events and the caps compacted into cap_weekly_rollups.
+    Run this after deleting or editing cap_events rows by hand, or moving them to another clan.
+    """
+    con.execute("DELETE FROM user_cap_summary")
+    con.execute("""
+        INSERT INTO user_cap_summary(clan_name, rsn, first_cap_timestamp, last_cap_timestamp, cap_count)
+        SELECT clan_name, rsn, MIN(first_cap), MAX(last_cap), SUM(caps) FROM (
+            SELECT COALESCE(clan_name, '') AS clan_name, rsn, cap_timestamp AS first_cap, cap_timestamp AS last_cap, 1 AS caps FROM cap_events
+            UNION ALL
+            SELECT clan_name, rsn, first_compacted_timestamp, last_compacted_timestamp, compacted_count FROM cap_weekly_rollups
+            WHERE compacted_count > 0
+        )
+        GROUP BY clan_name, rsn
         """)
 
-        # Index for primary query we do in /caplist
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_cap_query ON cap_events(rsn,cap_timestamp)")
-
-        # TODO: support adding missing columns.
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS user_activity(
-                rsn TEXT PRIMARY KEY,
-                last_activity_timestamp INTEGER NOT NULL,
-                last_query_timestamp INTEGER NOT NULL,
-                private TINYINT DEFAULT 0
-            )
+def create_cap_summary_trigger(con):
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cap_summary_insert AFTER INSERT ON cap_events
+        BEGIN
+            INSERT INTO user_cap_summary(clan_name, rsn, first_cap_timestamp, last_cap_timestamp, cap_count)
+            VALUES(COALESCE(NEW.clan_name, ''), NEW.rsn, NEW.cap_timestamp, NEW.cap_timestamp, 1)
+            ON CONFLICT(clan_name, rsn) DO UPDATE SET
+                first_cap_timestamp = MIN(first_cap_timestamp, excluded.first_cap_timestamp),
+                last_cap_timestamp = MAX(last_cap_timestamp, excluded.last_cap_timestamp),
+                cap_count = cap_count + 1;
+        END
+    """)
+
+def migrate_add_cap_summary(con):
+    # Per-user cap summary so /user-status doesn't need a subquery over cap_events for every user.
+    # Kept up to date by a trigger on insert, so it's always consistent with cap_events in the same transaction.
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS user_cap_summary(
+            rsn TEXT PRIMARY KEY COLLATE NOCASE,
+            first_cap_timestamp INTEGER NOT NULL,
+            last_cap_timestamp INTEGER NOT NULL,
+            cap_count INTEGER NOT NULL
+        )
+    """)
+    # Replaced by the per clan version in migrate_cap_summary_by_clan. The table is filled there.
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cap_summary_insert AFTER INSERT ON cap_events
+        BEGIN
+            INSERT INTO user_cap_summary(rsn, first_cap_timestamp, last_cap_timestamp, cap_count)
+            VALUES(NEW.rsn, NEW.cap_timestamp, NEW.cap_timestamp, 1)
+            ON CONFLICT(rsn) DO UPDATE SET
+                first_cap_timestamp = MIN(first_cap_timestamp, excluded.first_cap_timestamp),
+                last_cap_timestamp = MAX(last_cap_timestamp, excluded.last_cap_timestamp),
+                cap_count = cap_count + 1;
+        END
+    """)
+
+def migrate_add_cap_clan(con):
+    # Caps belong to the clan the member was in, so each clan's queries only have to touch its own rows.
+    # Existing caps go to the clan the member most recently joined, preferring clans they're still in.
+    add_column(con, "cap_events", "clan_name", "TEXT")
+    con.execute("""
+        UPDATE cap_events SET clan_name = (
+            SELECT cm.clan_name FROM clan_members cm
+            WHERE cm.rsn = cap_events.rsn
+            ORDER BY cm.departed_timestamp IS NULL DESC, cm.joined_timestamp DESC
+            LIMIT 1)
         """)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_cap_clan ON cap_events(clan_name, cap_timestamp)")
+
+def migrate_add_cap_rollups(con):
+    # Needs cap_events.clan_name, so the triggers are created here rather than in create_schema.
+    from rollups import create_rollup_triggers, rebuild_cap_rollups
+    create_rollup_triggers(con)
+    rebuild_cap_rollups(con)
+
+def migrate_fill_week_bits(con):
+    from attendance import rebuild_week_bits
+    rebuild_week_bits(con)
+
+def migrate_add_canonical_rsn(con):
+    """
+    Adds user_activity.canonical_rsn so rsn lookups are exact hits on a unique index rather than COLLATE NOCASE scans.
+    If a player has rows under two spellings, the one scanned most recently keeps the canonical name and the other is
+    left without one. migrate_merge_rsn_spellings then folds the other into it.
+    """
+    from names import canonical_rsn
+    add_column(con, "user_activity", "canonical_rsn", "TEXT")
+    keep:dict[str, str] = {}
+    for rsn, in con.execute("SELECT rsn FROM user_activity ORDER BY last_query_timestamp ASC, rsn DESC").fetchall():
+        keep[canonical_rsn(rsn)] = rsn
+    con.executemany("UPDATE user_activity SET canonical_rsn = ? WHERE rsn = ?", keep.items())
+    con.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_activity_canonical ON user_activity(canonical_rsn)")
+
+def migrate_cap_summary_by_clan(con):
+    # The summary was per member across every clan, so /user-status disagreed with the clan's /captotal.
+    # Caps not attributed to a clan yet are summarised under clan '', like the rollups.
+    con.execute("DROP TRIGGER IF EXISTS trg_cap_summary_insert")
+    con.execute("DROP TABLE IF EXISTS user_cap_summary")
+    con.execute("""
+        CREATE TABLE user_cap_summary(
+            clan_name TEXT NOT NULL,
+            rsn TEXT NOT NULL,
+            first_cap_timestamp INTEGER NOT NULL,
+            last_cap_timestamp INTEGER NOT NULL,
+            cap_count INTEGER NOT NULL,
+
+            PRIMARY KEY(clan_name, rsn)
+        )
+    """)
+    create_cap_summary_trigger(con)
+    rebuild_cap_summary(con)
+
+def merge_rsn_spelling(con, old:str, kept:str):
+    """ Moves everything stored under one spelling of a player's name to another. Rebuild the derived tables after. """
+    # Rows that would collide with one the kept spelling already has are duplicates of it, e.g. a cap seen under both.
+    for table in ["cap_events", "activity_watermarks", "backfill_progress"]:
+        con.execute(f"UPDATE OR IGNORE {table} SET rsn = ? WHERE rsn = ?", (kept, old))
+        con.execute(f"DELETE FROM {table} WHERE rsn = ?", (old,))
+    # Membership of a clan under both spellings: earliest join, and still a member if either row is.
+    con.execute("""
+        UPDATE clan_members AS k SET
+            joined_timestamp = MIN(k.joined_timestamp, o.joined_timestamp),
+            departed_timestamp = CASE WHEN k.departed_timestamp IS NULL OR o.departed_timestamp IS NULL THEN NULL
+                ELSE MAX(k.departed_timestamp, o.departed_timestamp) END
+        FROM clan_members AS o
+        WHERE k.rsn = ? AND o.rsn = ? AND o.clan_name = k.clan_name
+        """, (kept, old))
+    con.execute("UPDATE OR IGNORE clan_members SET rsn = ? WHERE rsn = ?", (kept, old))
+    con.execute("DELETE FROM clan_members WHERE rsn = ?", (old,))
+    # Compacted caps only live in the rollups.
+    con.execute("""
+        INSERT INTO cap_weekly_rollups(clan_name, rsn, week_start, compacted_count, first_compacted_timestamp, last_compacted_timestamp)
+        SELECT clan_name, ?, week_start, compacted_count, first_compacted_timestamp, last_compacted_timestamp
+        FROM cap_weekly_rollups WHERE rsn = ? AND compacted_count > 0
+        ON CONFLICT(clan_name, week_start, rsn) DO UPDATE SET
+            compacted_count = compacted_count + excluded.compacted_count,
+            first_compacted_timestamp = MIN(COALESCE(first_compacted_timestamp, excluded.first_compacted_timestamp), excluded.first_compacted_timestamp),
+            last_compacted_timestamp = MAX(COALESCE(last_compacted_timestamp, excluded.last_compacted_timestamp), excluded.last_compacted_timestamp)
+        """, (kept, old))
+    con.execute("DELETE FROM cap_weekly_rollups WHERE rsn = ?", (old,))
+    con.execute("""
+        UPDATE user_activity AS k SET
+            last_activity_timestamp = MAX(k.last_activity_timestamp, o.last_activity_timestamp),
+            last_query_timestamp = MAX(k.last_query_timestamp, o.last_query_timestamp)
+        FROM user_activity AS o
+        WHERE k.rsn = ? AND o.rsn = ?
+        """, (kept, old))
+    con.execute("DELETE FROM user_activity WHERE rsn = ?", (old,))
+    con.execute("DELETE FROM poll_schedule WHERE rsn = ?", (old,))
+
+def migrate_merge_rsn_spellings(con):
+    # Players migrate_add_canonical_rsn found under two spellings: the one without a canonical name is merged into the
+    # one with it, so their caps are counted once under one name.
+    from names import canonical_rsn
+    from rollups import rebuild_cap_rollups
+    from attendance import rebuild_week_bits
+    kept = dict(con.execute("SELECT canonical_rsn, rsn FROM user_activity WHERE canonical_rsn IS NOT NULL").fetchall())
+    merged = 0
+    for old, in con.execute("SELECT rsn FROM user_activity WHERE canonical_rsn IS NULL").fetchall():
+        canonical = canonical_rsn(old)
+        if canonical in kept:
+            merge_rsn_spelling(con, old, kept[canonical])
+            merged += 1
+        else:
+            con.execute("UPDATE user_activity SET canonical_rsn = ? WHERE rsn = ?", (canonical, old))
+            kept[canonical] = old
+    if merged:
+        rebuild_cap_rollups(con)
+        rebuild_cap_summary(con)
+        rebuild_week_bits(con)
+
+# Schema migrations, applied in order. PRAGMA user_version records how many have been applied to a database.
+# To change the schema, append a function here; never edit or reorder ones that have shipped.
+MIGRATIONS = [
+    migrate_add_private,
+    migrate_add_cap_summary,
+    migrate_add_cap_clan,
+    migrate_add_cap_rollups,
+    migrate_fill_week_bits,
+    migrate_add_canonical_rsn,
+    migrate_cap_summary_by_clan,
+    migrate_merge_rsn_spellings,
+]
+
+def migrate(con):
+    log = logging.getLogger(LOG_NAME)
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    for i in range(version, len(MIGRATIONS)):
+        # IMMEDIATE so that if several workers start at once, one migrates and the others wait for it and skip.
+        con.execute("BEGIN IMMEDIATE")
+        if con.execute("PRAGMA user_version").fetchone()[0] > i:
+            con.execute("COMMIT")
+            continue
+        log.info("Applying database migration %d: %s", i + 1, MIGRATIONS[i].__name__)
+        try:
+            MIGRATIONS[i](con)
+            con.execute(f"PRAGMA user_version = {i + 1}")
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+def connect(path:str, readonly:bool=False) -> sqlite3.Connection:
+    """ Opens a long-lived connection with our tuned settings. Statements are cached per connection so keep these around. """
+    if readonly:
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False, cached_statements=256)
+    else:
+        con = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+    con.execute("PRAGMA busy_timeout = 5000")
+    # NORMAL is durable enough in WAL mode; we only risk losing the last transaction on power loss, not corruption.
+    con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA cache_size = -8000") # 8MB
+    con.execute("PRAGMA temp_store = MEMORY")
+    return con
+
+class Database:
+    """
+    One writer connection and a small pool of reader connections, each on their own executor so queries never run on the
+    discord event loop. WAL mode lets the readers keep serving commands while the writer is committing an update.
+    """
+    def __init__(self, path:str=DB_PATH, readers:int=READ_POOL_SIZE):
+        self.path = path
+        self.writer = connect(path)
+        self.writer.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}")
+        self.write_lock = threading.RLock()
+        self.write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self.local = threading.local()
+        self.readers:list[sqlite3.Connection] = []
+        self.readers_lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self):
+        """ Yields the writer connection inside a transaction that commits on success and rolls back on error. """
+        with self.write_lock:
+            with self.writer:
+                yield self.writer
+
+    def get_reader(self) -> sqlite3.Connection:
+        """ Returns this thread's reader connection, opening it on first use. """
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = connect(self.path, readonly=True)
+            self.local.con = con
+            with self.readers_lock:
+                self.readers.append(con)
+        return con
+
+    def _read(self, func, *args):
+        return func(self.get_reader(), *args)
+
+    def _write(self, func, *args):
+        with self.transaction() as con:
+            return func(con, *args)
+
+    async def read(self, func, *args):
+        """ Runs func(con, *args) on the read pool. """
+        return await asyncio.get_running_loop().run_in_executor(self.read_executor, self._read, func, *args)
+
+    async def write(self, func, *args):
+        """ Runs func(con, *args) inside a write transaction on the writer thread. """
+        return await asyncio.get_running_loop().run_in_executor(self.write_executor, self._write, func, *args)
+
+    async def fetch_all(self, sql:str, params=()) -> list[tuple]:
+        return await self.read(lambda con: con.execute(sql, params).fetchall())
+
+    async def fetch_one(self, sql:str, params=()) -> tuple|None:
+        return await self.read(lambda con: con.execute(sql, params).fetchone())
+
+    def close(self):
+        self.read_executor.shutdown(wait=True)
+        self.write_executor.shutdown(wait=True)
+        with self.readers_lock:
+            for con in self.readers:
+                con.close()
+            self.readers.clear()
+        with self.write_lock:
+            self.writer.close()
+
+_database:Database|None = None
+
+def init_db(path:str=DB_PATH) -> Database:
+    """ Creates/migrates the schema and opens the shared connections. """
+    global _database
+    con = sqlite3.connect(path)
+    try:
+        with con:
+            create_schema(con.cursor())
+        migrate(con)
+    finally:
+        con.close()
+
+    if _database is not None:
+        _database.close()
+    _database = Database(path)
+    return _database
+
+def get_database() -> Database:
+    if _database is None:
+        return init_db()
+    return _database
+
+def close_db():
+    global _database
+    if _database is not None:
+        _database.close()
+        _database = None
 
-        # NOTE: likely won't need an index on user_activity as the table size is fixed to the number of clan members
-        # which cannot be more than a few hundred.
-    con.close()
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="CapBot database maintenance.")
+    parser.add_argument("command", choices=["rebuild-cap-summary", "rebuild-week-bits"])
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
 
-def get_db():
-    return sqlite3.connect("capdata.db", check_same_thread=True)
+    database = init_db(args.db)
+    if args.command == "rebuild-cap-summary":
+        with database.transaction() as con:
+            rebuild_cap_summary(con)
+            count = con.execute("SELECT COUNT(*) FROM user_cap_summary").fetchone()[0]
+        print(f"Rebuilt user_cap_summary for {count} users.")
+    elif args.command == "rebuild-week-bits":
+        # After editing cap_events by hand. The rollups follow them by trigger, the bitsets don't.
+        from attendance import rebuild_week_bits
+        with database.transaction() as con:
+            rebuild_week_bits(con)
+            count = con.execute("SELECT COUNT(*) FROM cap_week_bits").fetchone()[0]
+        print(f"Rebuilt cap_week_bits for {count} users.")
+    close_db()
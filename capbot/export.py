@@ -0,0 +1,186 @@
+import io
+import csv
+import sys
+import gzip
+import json
+import argparse
+from dataclasses import dataclass
+from datetime import datetime, timezone, timedelta
+from typing import Iterator
+
+from db import connect, DB_PATH
+from names import canonical_rsn
+
+# Rows fetched from sqlite at a time. Memory use depends on this, not on how many rows are exported.
+CHUNK_ROWS = 500
+# Rough size of a row before compression, for deciding whether to compress.
+ESTIMATED_ROW_BYTES = 80
+# Exports bigger than this are gzipped unless compression is asked for either way. CSV of this sort compresses ~10x.
+COMPRESS_THRESHOLD_BYTES = 1024 * 1024
+
+EXPORT_TABLES = {
+    "caps": ["rsn", "cap_timestamp", "cap_date", "source"],
+    "members": ["rsn", "last_activity_timestamp", "last_query_timestamp", "private", "cap_count", "first_cap_timestamp", "last_cap_timestamp"],
+}
+EXPORT_FORMATS = ["csv", "jsonl"]
+
+@dataclass
+class ExportOptions:
+    clan_name:str
+    table:str = "caps"
+    format:str = "csv"
+    start:float|None = None # caps from, or members last active from
+    end:float|None = None # exclusive
+    rsn:str|None = None
+    compress:bool|None = None # None to decide from the size
+
+@dataclass
+class ExportStats:
+    rows:int
+    bytes:int # as written, after any compression
+    compressed:bool
+
+def parse_export_date(value:str) -> float:
+    """ Parses a YYYY-MM-DD date as midnight UTC. Raises ValueError if it's not in that format. """
+    return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+
+def parse_export_end_date(value:str) -> float:
+    """ End dates are inclusive, so the export runs up to midnight at the end of that day. """
+    return parse_export_date(value) + timedelta(days=1).total_seconds()
+
+def format_iso(timestamp) -> str|None:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def build_export_query(options:ExportOptions) -> tuple[str, list]:
+    """ Returns the sql and parameters for an export. Caps are read in time order along idx_cap_clan. """
+    if options.table == "caps":
+        sql = "SELECT rsn, cap_timestamp, source FROM cap_events WHERE clan_name = ?"
+        column = "cap_timestamp"
+    elif options.table == "members":
+        # Anyone who's been in the clan, not just current members, so their cap history isn't left out.
+        sql = """
+            SELECT ua.rsn, ua.last_activity_timestamp, ua.last_query_timestamp, ua.private,
+                s.cap_count, s.first_cap_timestamp, s.last_cap_timestamp
+            FROM user_activity ua
+            LEFT JOIN user_cap_summary s ON s.clan_name = ? AND s.rsn = ua.rsn
+            WHERE EXISTS (SELECT 1 FROM clan_members cm WHERE cm.rsn = ua.rsn AND cm.clan_name = ?)"""
+        column = "ua.last_activity_timestamp"
+    else:
+        raise ValueError(f"Unknown export table '{options.table}', expected one of {list(EXPORT_TABLES)}")
+
+    params:list = [options.clan_name] if options.table == "caps" else [options.clan_name, options.clan_name]
+    if options.start is not None:
+        sql += f" AND {column} >= ?"
+        params.append(options.start)
+    if options.end is not None:
+        sql += f" AND {column} < ?"
+        params.append(options.end)
+    if options.rsn is not None:
+        if options.table == "caps":
+            sql += " AND rsn = (SELECT rsn FROM user_activity WHERE canonical_rsn = ?)"
+        else:
+            sql += " AND ua.canonical_rsn = ?"
+        params.append(canonical_rsn(options.rsn))
+    sql += f" ORDER BY {column}, {'rsn' if options.table == 'caps' else 'ua.rsn'}"
+    return sql, params
+
+def count_export_rows(dbcon, options:ExportOptions) -> int:
+    sql, params = build_export_query(options)
+    return dbcon.execute(f"SELECT COUNT(*) FROM ({sql})", params).fetchone()[0]
+
+def iter_export_rows(dbcon, options:ExportOptions) -> Iterator[tuple]:
+    """ Yields the export's rows, only ever holding CHUNK_ROWS of them in memory. """
+    sql, params = build_export_query(options)
+    cur = dbcon.execute(sql, params)
+    while True:
+        rows = cur.fetchmany(CHUNK_ROWS)
+        if not rows:
+            break
+        for row in rows:
+            if options.table == "caps":
+                rsn, cap_timestamp, source = row
+                yield (rsn, cap_timestamp, format_iso(cap_timestamp), source)
+            else:
+                yield row
+
+def should_compress(dbcon, options:ExportOptions) -> bool:
+    if options.compress is not None:
+        return options.compress
+    return count_export_rows(dbcon, options) * ESTIMATED_ROW_BYTES > COMPRESS_THRESHOLD_BYTES
+
+def write_export(dbcon, options:ExportOptions, out) -> ExportStats:
+    """
+    Writes the export to a binary file object as it's read from the database, gzipped if options.compress says so or
+    if it's going to be large. Leaves out open.
+    """
+    if options.format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{options.format}', expected one of {EXPORT_FORMATS}")
+    columns = EXPORT_TABLES[options.table]
+    compressed = should_compress(dbcon, options)
+    start_position = out.tell() if out.seekable() else 0
+
+    raw = gzip.GzipFile(fileobj=out, mode="wb") if compressed else out
+    text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    num_rows = 0
+    try:
+        if options.format == "csv":
+            writer = csv.writer(text)
+            writer.writerow(columns)
+            for row in iter_export_rows(dbcon, options):
+                writer.writerow(row)
+                num_rows += 1
+        else:
+            for row in iter_export_rows(dbcon, options):
+                text.write(json.dumps(dict(zip(columns, row))) + "\n")
+                num_rows += 1
+    finally:
+        text.flush()
+        text.detach()
+        if compressed:
+            # Writes the gzip trailer. GzipFile doesn't close a file object it was given.
+            raw.close()
+
+    written = out.tell() - start_position if out.seekable() else 0
+    return ExportStats(rows=num_rows, bytes=written, compressed=compressed)
+
+def get_export_filename(options:ExportOptions, compressed:bool) -> str:
+    return f"cap-export-{options.table}.{options.format}" + (".gz" if compressed else "")
+
+def main():
+    parser = argparse.ArgumentParser(description="Export cap history as CSV or JSON Lines. Same as /cap-export, without the size limit.")
+    parser.add_argument("--clan", required=True, help="Clan name, as in CAPBOT_CLANS.")
+    parser.add_argument("--table", choices=list(EXPORT_TABLES), default="caps")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    parser.add_argument("--start", help="YYYY-MM-DD, inclusive.")
+    parser.add_argument("--end", help="YYYY-MM-DD, inclusive.")
+    parser.add_argument("--rsn", help="Only this member.")
+    parser.add_argument("--gzip", action=argparse.BooleanOptionalAction, default=None, help="Compress the output. Defaults to on for large exports.")
+    parser.add_argument("--output", help="File to write to. Defaults to stdout.")
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
+
+    options = ExportOptions(clan_name=args.clan, table=args.table, format=args.format,
+                            start=parse_export_date(args.start) if args.start else None,
+                            end=parse_export_end_date(args.end) if args.end else None,
+                            rsn=args.rsn, compress=args.gzip)
+    dbcon = connect(args.db, readonly=True)
+    try:
+        if args.output:
+            if options.compress is None and args.output.endswith(".gz"):
+                options.compress = True
+            with open(args.output, "wb") as f:
+                stats = write_export(dbcon, options, f)
+        else:
+            # Only compress stdout if asked to, it's usually piped somewhere that expects text.
+            if options.compress is None:
+                options.compress = False
+            stats = write_export(dbcon, options, sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+    finally:
+        dbcon.close()
+    print(f"Exported {stats.rows} rows.", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
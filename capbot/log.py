@@ -1,22 +1,117 @@
+import os
+import json
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 LOG_NAME = "CapBot"
+# Subsystems log to children of LOG_NAME so their levels can be set separately, with CAPBOT_LOG_LEVELS or /capbot-log-level.
+FETCHER_LOG = f"{LOG_NAME}.fetcher" # runemetrics and clan roster requests
+SCHEDULER_LOG = f"{LOG_NAME}.scheduler" # update cycles, poll scheduling and storing scans
+COMMANDS_LOG = f"{LOG_NAME}.commands" # the discord client and slash commands
+SUBSYSTEMS = {"fetcher": FETCHER_LOG, "scheduler": SCHEDULER_LOG, "commands": COMMANDS_LOG}
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+TEXT_FORMAT = "%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s"
+
+_listener:QueueListener|None = None
+_listener_pid:int|None = None
+
+class JsonLinesFormatter(logging.Formatter):
+    """ One compact JSON object per record. Anything passed as extra={"fields": {...}} is added to it as is. """
+    def format(self, record:logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread without formatting them. Only the message arguments are merged in here, as they
+    could change once the caller carries on. The timestamp, layout and any traceback are done on the listener thread.
+    """
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def parse_log_levels(value:str) -> dict[str, str]:
+    """ Parses CAPBOT_LOG_LEVELS, e.g. "fetcher=INFO,scheduler=DEBUG". """
+    levels = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        subsystem, _, level = item.partition("=")
+        subsystem, level = subsystem.strip().lower(), level.strip().upper()
+        if subsystem not in SUBSYSTEMS or level not in LOG_LEVELS:
+            raise ValueError(f"Invalid CAPBOT_LOG_LEVELS entry '{item}', expected <{'|'.join(SUBSYSTEMS)}>=<{'|'.join(LOG_LEVELS)}>")
+        levels[subsystem] = level
+    return levels
+
+def set_log_level(subsystem:str, level:str):
+    """ Sets a subsystem's level, or with "all" sets the overall level and clears the subsystem ones. Takes effect straight away. """
+    if subsystem == "all":
+        logging.getLogger(LOG_NAME).setLevel(level)
+        for name in SUBSYSTEMS.values():
+            logging.getLogger(name).setLevel(logging.NOTSET)
+    else:
+        logging.getLogger(SUBSYSTEMS[subsystem]).setLevel(level)
+
+def get_log_levels() -> dict[str, str]:
+    """ Effective level of each subsystem. """
+    return {subsystem: logging.getLevelName(logging.getLogger(name).getEffectiveLevel()) for subsystem, name in SUBSYSTEMS.items()}
+
+def stop_log():
+    """ Writes out anything still queued and stops the listener thread. """
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+    _listener = None
+    _listener_pid = None
 
 def init_log(mode="w"):
+    """
+    Log records are queued and written to the console and capbot.log by a background thread, so the thread doing the
+    logging, usually the event loop, never waits on the disk or terminal.
+    Set CAPBOT_LOG_FORMAT=json to write capbot.log as JSON lines, CAPBOT_LOG_LEVEL for the overall level (DEBUG by
+    default) and CAPBOT_LOG_LEVELS to override it for some subsystems.
+    """
+    global _listener, _listener_pid
     log = logging.getLogger(LOG_NAME)
-    log.setLevel(logging.DEBUG)
-    formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
+    # Called again after daemonizing, which closes the log file. A listener thread from before forking isn't running
+    # in this process, so it's just dropped.
+    stop_log()
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+
+    log.setLevel(os.getenv("CAPBOT_LOG_LEVEL", "DEBUG").upper())
+    for subsystem, level in parse_log_levels(os.getenv("CAPBOT_LOG_LEVELS", "")).items():
+        set_log_level(subsystem, level)
 
+    formatter = logging.Formatter(TEXT_FORMAT)
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-    console_handler.setLevel(logging.DEBUG)
-    log.addHandler(console_handler)
 
     file_handler = RotatingFileHandler("capbot.log", encoding="utf-8", mode=mode, maxBytes=1024*1024*10, backupCount=3)
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(logging.DEBUG)
-    log.addHandler(file_handler)
+    file_handler.setFormatter(JsonLinesFormatter() if os.getenv("CAPBOT_LOG_FORMAT", "").lower() == "json" else formatter)
+
+    log_queue = queue.SimpleQueue()
+    log.addHandler(DeferredQueueHandler(log_queue))
+    _listener = QueueListener(log_queue, console_handler, file_handler)
+    _listener_pid = os.getpid()
+    _listener.start()
 
     log.info("CapBot log opened.")
     return log
+
+atexit.register(stop_log)
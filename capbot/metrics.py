@@ -0,0 +1,159 @@
+import math
+import time
+import threading
+from typing import Callable
+
+class Metric:
+    type_name = "untyped"
+
+    def __init__(self, name:str, help:str, registry:"Registry|None"=None):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        (registry or default_registry).register(self)
+
+    def samples(self) -> list[tuple[str, float]]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    """ A value that only goes up. If func is given the value is read from it instead, for counts kept elsewhere. """
+    type_name = "counter"
+
+    def __init__(self, name:str, help:str, func:Callable[[], float]|None=None, registry:"Registry|None"=None):
+        super().__init__(name, help, registry)
+        self.func = func
+        self._value = 0.0
+
+    def inc(self, amount:float=1):
+        with self.lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        if self.func is not None:
+            return self.func()
+        return self._value
+
+    def samples(self) -> list[tuple[str, float]]:
+        return [(self.name, self.value)]
+
+class Gauge(Counter):
+    """ A value that can go up and down. """
+    type_name = "gauge"
+
+    def set(self, value:float):
+        with self.lock:
+            self._value = value
+
+class Histogram(Metric):
+    """ Counts observations into cumulative buckets, like a Prometheus histogram. Also remembers the last and largest value. """
+    type_name = "histogram"
+
+    def __init__(self, name:str, help:str, buckets:list[float], registry:"Registry|None"=None):
+        super().__init__(name, help, registry)
+        self.buckets = sorted(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.last = None
+        self.max = None
+
+    def observe(self, value:float):
+        with self.lock:
+            index = len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    index = i
+                    break
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.last = value
+            self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, fraction:float) -> float|None:
+        """ Upper bound of the bucket the quantile falls in, capped at the largest value seen. """
+        with self.lock:
+            if self.count == 0:
+                return None
+            rank = fraction * self.count
+            seen = 0
+            for bound, count in zip(self.buckets, self.bucket_counts):
+                seen += count
+                if seen >= rank:
+                    return min(bound, self.max)
+            return self.max
+
+    def samples(self) -> list[tuple[str, float]]:
+        with self.lock:
+            samples = []
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.bucket_counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket{{le="{format_value(bound)}"}}', cumulative))
+            samples.append((f'{self.name}_bucket{{le="+Inf"}}', self.count))
+            samples.append((f"{self.name}_sum", self.sum))
+            samples.append((f"{self.name}_count", self.count))
+            return samples
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics:dict[str, Metric] = {}
+
+    def register(self, metric:Metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """ Formats every metric in the Prometheus text exposition format. """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def format_value(value:float) -> str:
+    if value is None or math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+default_registry = Registry()
+
+START_TIME = time.time()
+
+# Seconds, from a minute up to a week.
+LAG_BUCKETS = [60, 300, 900, 1800, 3600, 2*3600, 4*3600, 8*3600, 12*3600, 24*3600, 2*24*3600, 7*24*3600]
+
+update_cycle_seconds = Histogram("capbot_update_cycle_seconds", "Time taken by each update_task run.", [1, 5, 10, 30, 60, 90, 120, 180, 300, 600])
+update_failures = Counter("capbot_update_failures_total", "update_task runs that raised an exception.")
+# The update loop never overlaps itself, so a cycle running past the loop interval delays the next one instead.
+update_skipped_cycles = Counter("capbot_update_skipped_cycles_total", "Update loop ticks missed because the previous cycle overran.")
+users_scanned = Histogram("capbot_users_scanned", "Alogs fetched per update cycle.", [0, 1, 2, 5, 10, 15, 20, 30, 50, 100])
+request_seconds = Histogram("capbot_request_seconds", "Latency of requests to the RS apis, not including rate limiter waits.", [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30])
+cap_detection_lag_seconds = Histogram("capbot_cap_detection_lag_seconds", "Time from a cap's alog timestamp to us storing it.", LAG_BUCKETS)
+roster_last_refresh = Gauge("capbot_roster_last_refresh_timestamp_seconds", "When the clan roster was last downloaded.")
+roster_staleness = Gauge("capbot_roster_staleness_seconds", "Seconds since the clan roster was last downloaded.",
+                         func=lambda: time.time() - roster_last_refresh.value if roster_last_refresh.value else math.nan)
+uptime = Gauge("capbot_uptime_seconds", "Seconds since the bot started.", func=lambda: time.time() - START_TIME)
+
+async def start_metrics_server(port:int, host:str="127.0.0.1", registry:Registry|None=None):
+    """ Serves /metrics in the Prometheus text format. Returns the runner, call cleanup() on it to stop. """
+    from aiohttp import web
+    registry = registry or default_registry
+
+    async def handle_metrics(request:web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
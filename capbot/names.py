@@ -0,0 +1,33 @@
+import re
+from bisect import bisect_left
+
+# RuneScape treats these as the same character in names, so "Foo_Bar", "foo-bar" and "FOO BAR" are one player.
+_SEPARATORS = re.compile(r"[\s_\-\xa0]+")
+# Discord shows at most this many autocomplete choices.
+MAX_CHOICES = 25
+
+def canonical_rsn(rsn:str) -> str:
+    """ The form user_activity.canonical_rsn is stored and looked up in. Apply it to any rsn a user or api gives us. """
+    return _SEPARATORS.sub(" ", rsn).strip().lower()
+
+class RsnIndex:
+    """
+    Sorted array of a clan's (canonical rsn, rsn) for autocomplete. Everything starting with a prefix is one contiguous
+    run, found with a binary search, so lookups take microseconds however big the roster is.
+    """
+    def __init__(self, rsns:list[str]):
+        self.entries = sorted((canonical_rsn(rsn), rsn) for rsn in rsns)
+        self.keys = [key for key, _ in self.entries]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def search(self, prefix:str, limit:int=MAX_CHOICES) -> list[str]:
+        """ Returns up to limit rsns whose canonical form starts with the prefix's, in alphabetical order. """
+        prefix = canonical_rsn(prefix)
+        matches = []
+        for i in range(bisect_left(self.keys, prefix), len(self.entries)):
+            if len(matches) >= limit or not self.keys[i].startswith(prefix):
+                break
+            matches.append(self.entries[i][1])
+        return matches
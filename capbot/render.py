@@ -0,0 +1,118 @@
+import io
+from typing import Iterator
+
+import discord
+
+# Discord rejects messages longer than this.
+MESSAGE_LIMIT = 2000
+# Room left on each page for the "(page x/y)" suffix.
+PAGE_SUFFIX_RESERVE = 24
+
+def iter_table_lines(column_names:list[str], rows:list[list], newline:str='\n') -> Iterator[str]:
+    """ Yields a text table one line at a time so it can be written out without building the whole string. """
+    # Find longest strings in each column so we can pad out the rest to match.
+    column_widths:list[int] = [len(str(name)) for name in column_names]
+    for row in rows:
+        for i in range(len(column_names)):
+            column_widths[i] = max(column_widths[i], len(str(row[i])))
+
+    # Compute table size
+    vertical_bars = len(column_names) + 1
+    padding = len(column_names) * 2
+    table_width = sum(column_widths) + vertical_bars + padding
+    horizontal_line = ('-' * table_width) + newline
+
+    def format_row(row) -> str:
+        return "|" + "|".join([f" {str(row[i]):<{column_widths[i]}} " for i in range(len(column_widths))]) + "|" + newline
+
+    yield horizontal_line
+    yield format_row(column_names)
+    yield horizontal_line
+    for row in rows:
+        yield format_row(row)
+    yield horizontal_line
+
+def table_to_bytes(column_names:list[str], rows:list[list]) -> bytes:
+    """ Renders a table into an in-memory buffer for uploading as an attachment. """
+    buffer = io.BytesIO()
+    for line in iter_table_lines(column_names, rows):
+        buffer.write(line.encode("utf-8"))
+    return buffer.getvalue()
+
+def make_file(content:bytes, filename:str) -> discord.File:
+    return discord.File(io.BytesIO(content), filename=filename)
+
+def paginate_table(title:str, column_names:list[str], rows:list[list], limit:int=MESSAGE_LIMIT) -> list[str]:
+    """
+    Splits a table into code-block messages that each fit within Discord's message limit.
+    Every page repeats the title and column headers.
+    """
+    lines = iter_table_lines(column_names, rows)
+    header = next(lines) + next(lines) + next(lines)
+    footer = header.split("\n", 1)[0] + "\n"
+    page_start = f"{title}\n```\n{header}"
+    page_end = f"{footer}```"
+    budget = limit - len(page_start) - len(page_end) - PAGE_SUFFIX_RESERVE
+
+    pages = []
+    body = []
+    body_length = 0
+    for line in lines:
+        if line == footer:
+            break
+        if body and body_length + len(line) > budget:
+            pages.append(body)
+            body = []
+            body_length = 0
+        body.append(line)
+        body_length += len(line)
+    if body or not pages:
+        pages.append(body)
+
+    if len(pages) == 1:
+        return [page_start + "".join(pages[0]) + page_end]
+    return [f"{title} (page {i + 1}/{len(pages)})\n```\n{header}" + "".join(body) + page_end for i, body in enumerate(pages)]
+
+class TablePaginator(discord.ui.View):
+    """ Previous/next buttons for flicking through the pages of a table in a single message. """
+    def __init__(self, pages:list[str], timeout:float=300):
+        super().__init__(timeout=timeout)
+        self.pages = pages
+        self.page = 0
+        # The interaction that sent the message, so the buttons can be disabled once they stop working.
+        self.interaction:discord.Interaction|None = None
+        self.update_buttons()
+
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        if self.interaction is not None:
+            try:
+                await self.interaction.edit_original_response(view=self)
+            except discord.HTTPException:
+                pass # e.g. the message was dismissed
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page == len(self.pages) - 1
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction:discord.Interaction, button:discord.ui.Button):
+        self.page = max(self.page - 1, 0)
+        self.update_buttons()
+        await interaction.response.edit_message(content=self.pages[self.page], view=self)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction:discord.Interaction, button:discord.ui.Button):
+        self.page = min(self.page + 1, len(self.pages) - 1)
+        self.update_buttons()
+        await interaction.response.edit_message(content=self.pages[self.page], view=self)
+
+async def send_pages(interaction:discord.Interaction, pages:list[str], ephemeral:bool=True):
+    """ Sends a single page as a plain message, or the first page with pagination buttons if there are several. """
+    if len(pages) == 1:
+        await interaction.response.send_message(pages[0], ephemeral=ephemeral)
+    else:
+        view = TablePaginator(pages)
+        view.interaction = interaction
+        await interaction.response.send_message(pages[0], view=view, ephemeral=ephemeral)
@@ -0,0 +1,152 @@
+import os
+import logging
+
+from log import SCHEDULER_LOG
+from db import get_state, set_state
+
+WEEK_SECONDS = 7 * 24 * 60 * 60
+# Citadel caps reset with the rest of the weekly content, at 00:00 UTC on Wednesday. The first one after the epoch.
+CITADEL_RESET_OFFSET = 6 * 24 * 60 * 60
+# Raw cap_events older than this many months are compacted into their weekly rollups. Unset or 0 keeps them forever.
+RETENTION_MONTHS = int(os.getenv("CAPBOT_RETENTION_MONTHS", "0"))
+# The scheduler reads the last CADENCE_WEEKS of raw caps, so never compact those.
+MIN_RETENTION_MONTHS = 3
+COMPACTION_INTERVAL_SECONDS = 24 * 60 * 60
+# bot_state key holding the week start raw cap_events have been compacted up to. Caps older than it are already counted
+# in the rollups, so cap_events ignores them if they're inserted again.
+COMPACTED_BEFORE_KEY = "caps_compacted_before"
+COMPACTION_RUN_KEY = "caps_compaction_run"
+
+def week_start_sql(column:str) -> str:
+    """ SQL version of get_week_start. """
+    return f"({CITADEL_RESET_OFFSET} + CAST(({column} - {CITADEL_RESET_OFFSET}) / {WEEK_SECONDS} AS INTEGER) * {WEEK_SECONDS})"
+
+def get_week_start(timestamp:float) -> int:
+    """ Returns the start of the citadel week the timestamp is in. """
+    return CITADEL_RESET_OFFSET + int((timestamp - CITADEL_RESET_OFFSET) // WEEK_SECONDS) * WEEK_SECONDS
+
+def get_compacted_before(dbcon) -> int|None:
+    state = get_state(dbcon, COMPACTED_BEFORE_KEY)
+    return int(state[0]) if state is not None else None
+
+def create_rollup_triggers(con):
+    """
+    Keeps cap_weekly_rollups' cap_count equal to the number of cap_events rows in each (clan, member, week) bucket as
+    rows are inserted, deleted or moved to another clan. Caps not attributed to a clan yet go in clan ''.
+    """
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_cap_rollup_insert AFTER INSERT ON cap_events
+        BEGIN
+            INSERT INTO cap_weekly_rollups(clan_name, rsn, week_start, cap_count) VALUES(COALESCE(NEW.clan_name, ''), NEW.rsn, {week_start_sql("NEW.cap_timestamp")}, 1)
+            ON CONFLICT(clan_name, week_start, rsn) DO UPDATE SET cap_count = cap_count + 1;
+        END
+    """)
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_cap_rollup_delete AFTER DELETE ON cap_events
+        BEGIN
+            UPDATE cap_weekly_rollups SET cap_count = cap_count - 1
+            WHERE clan_name = COALESCE(OLD.clan_name, '') AND week_start = {week_start_sql("OLD.cap_timestamp")} AND rsn = OLD.rsn;
+        END
+    """)
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_cap_rollup_update AFTER UPDATE OF clan_name, rsn, cap_timestamp ON cap_events
+        BEGIN
+            UPDATE cap_weekly_rollups SET cap_count = cap_count - 1
+            WHERE clan_name = COALESCE(OLD.clan_name, '') AND week_start = {week_start_sql("OLD.cap_timestamp")} AND rsn = OLD.rsn;
+            INSERT INTO cap_weekly_rollups(clan_name, rsn, week_start, cap_count) VALUES(COALESCE(NEW.clan_name, ''), NEW.rsn, {week_start_sql("NEW.cap_timestamp")}, 1)
+            ON CONFLICT(clan_name, week_start, rsn) DO UPDATE SET cap_count = cap_count + 1;
+        END
+    """)
+    # Caps from before the compaction horizon are already counted in the compacted totals, e.g. if a backfill finds them again.
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_cap_ignore_compacted BEFORE INSERT ON cap_events
+        WHEN NEW.cap_timestamp < COALESCE((SELECT CAST(value AS INTEGER) FROM bot_state WHERE key = '{COMPACTED_BEFORE_KEY}'), 0)
+        BEGIN
+            SELECT RAISE(IGNORE);
+        END
+    """)
+
+def rebuild_cap_rollups(con):
+    """ Recomputes cap_weekly_rollups' cap_count from cap_events, keeping the compacted counts. """
+    con.execute("UPDATE cap_weekly_rollups SET cap_count = 0")
+    con.execute(f"""
+        INSERT INTO cap_weekly_rollups(clan_name, rsn, week_start, cap_count)
+        SELECT COALESCE(clan_name, ''), rsn, {week_start_sql("cap_timestamp")}, COUNT(*)
+        FROM cap_events
+        GROUP BY 1, 2, 3
+        ON CONFLICT(clan_name, week_start, rsn) DO UPDATE SET cap_count = excluded.cap_count
+        """)
+    con.execute("DELETE FROM cap_weekly_rollups WHERE cap_count = 0 AND compacted_count = 0")
+
+def get_cap_totals(dbcon, clan_name:str, start:float|None=None) -> list[tuple[str, int]]:
+    """
+    Returns (rsn, caps) for each member of the clan with any caps since start (all time if None), most caps first.
+
+    Whole weeks are summed from cap_weekly_rollups so the cost doesn't grow with the number of raw events. Only the
+    first, partial, week is counted from cap_events. Once a week has been compacted its caps can't be split any more,
+    so a window starting part way through a compacted week only counts them if they were all after the start.
+    """
+    if start is None:
+        return dbcon.execute("""
+            SELECT rsn, SUM(cap_count + compacted_count) AS total
+            FROM cap_weekly_rollups
+            WHERE clan_name = ?
+            GROUP BY rsn
+            HAVING total > 0
+            ORDER BY total DESC
+            """, (clan_name,)).fetchall()
+
+    first_week = get_week_start(start)
+    first_full_week = first_week if first_week == start else first_week + WEEK_SECONDS
+    return dbcon.execute("""
+        SELECT rsn, SUM(caps) AS total FROM (
+            SELECT rsn, cap_count + compacted_count AS caps FROM cap_weekly_rollups
+            WHERE clan_name = ? AND week_start >= ?
+            UNION ALL
+            SELECT rsn, 1 FROM cap_events
+            WHERE clan_name = ? AND cap_timestamp >= ? AND cap_timestamp < ?
+            UNION ALL
+            SELECT rsn, compacted_count FROM cap_weekly_rollups
+            WHERE clan_name = ? AND week_start = ? AND compacted_count > 0 AND first_compacted_timestamp >= ?
+        )
+        GROUP BY rsn
+        HAVING total > 0
+        ORDER BY total DESC
+        """, (clan_name, first_full_week, clan_name, start, first_full_week, clan_name, first_week, start)).fetchall()
+
+def compact_cap_events(dbcon, before:float, now:float) -> int:
+    """
+    Folds cap_events older than the given week start into their weekly rollups' compacted counts and deletes them.
+    The delete trigger takes them off cap_count, so the rollup totals don't change. Returns the number of events compacted.
+    """
+    before = get_week_start(before)
+    dbcon.execute(f"""
+        INSERT INTO cap_weekly_rollups(clan_name, rsn, week_start, cap_count, compacted_count, first_compacted_timestamp, last_compacted_timestamp)
+        SELECT COALESCE(clan_name, ''), rsn, {week_start_sql("cap_timestamp")} AS week, 0, COUNT(*), MIN(cap_timestamp), MAX(cap_timestamp)
+        FROM cap_events
+        WHERE cap_timestamp < ?
+        GROUP BY 1, 2, 3
+        ON CONFLICT(clan_name, week_start, rsn) DO UPDATE SET
+            compacted_count = compacted_count + excluded.compacted_count,
+            first_compacted_timestamp = MIN(COALESCE(first_compacted_timestamp, excluded.first_compacted_timestamp), excluded.first_compacted_timestamp),
+            last_compacted_timestamp = MAX(COALESCE(last_compacted_timestamp, excluded.last_compacted_timestamp), excluded.last_compacted_timestamp)
+        """, (before,))
+    compacted = dbcon.execute("DELETE FROM cap_events WHERE cap_timestamp < ?", (before,)).rowcount
+    dbcon.execute("DELETE FROM cap_weekly_rollups WHERE cap_count = 0 AND compacted_count = 0")
+    set_state(dbcon, COMPACTED_BEFORE_KEY, max(before, get_compacted_before(dbcon) or 0), now)
+    return compacted
+
+def compact_if_due(dbcon, now:float, months:int=RETENTION_MONTHS) -> int|None:
+    """ Applies the retention policy at most once a day. Returns the number of events compacted, or None if it didn't run. """
+    if months <= 0:
+        return None
+    last_run = get_state(dbcon, COMPACTION_RUN_KEY)
+    if last_run is not None and now - last_run[1] < COMPACTION_INTERVAL_SECONDS:
+        return None
+    set_state(dbcon, COMPACTION_RUN_KEY, None, now)
+
+    months = max(months, MIN_RETENTION_MONTHS)
+    compacted = compact_cap_events(dbcon, now - months * 30 * 24 * 60 * 60, now)
+    if compacted:
+        logging.getLogger(SCHEDULER_LOG).info("Compacted %d cap events older than %d months into weekly rollups.", compacted, months)
+    return compacted
@@ -0,0 +1,119 @@
+import time
+import hashlib
+import logging
+from dataclasses import dataclass, field
+
+from log import FETCHER_LOG
+from db import get_database, bump_data_generation, set_state, ROSTER_CHANGED_KEY
+from cache import result_cache
+from metrics import roster_last_refresh
+from rsapi import fetch_clan_roster_async, parse_clan_members
+from names import canonical_rsn
+
+# The roster only changes a few times a week so there's no point downloading it every update.
+ROSTER_REFRESH_MINUTES = 60
+
+# A roster missing more than this fraction of the current members is more likely a bad response than a mass exodus.
+# It's only applied once the same roster has come back for a whole refresh interval.
+MAX_DEPARTED_FRACTION = 0.5
+# Members who drop off the roster and come back within this long keep their original join date.
+REJOIN_GRACE_SECONDS = 24 * 60 * 60
+
+# When each clan's roster was last downloaded. The staleness metric reports the oldest.
+_last_refresh:dict[str, float] = {}
+# (content hash, first seen) of a roster held back for dropping too many members, per clan.
+_held_rosters:dict[str, tuple[str, float]] = {}
+
+class SuspiciousRosterException(Exception):
+    """ The downloaded roster doesn't look like a real one. The cached roster is kept and the refresh retried. """
+    pass
+
+@dataclass
+class RosterDiff:
+    joined:list[str] = field(default_factory=list)
+    left:list[str] = field(default_factory=list)
+    unchanged:bool = False
+
+def get_last_roster_refresh(dbcon, clan_name:str) -> float|None:
+    cur = dbcon.execute("SELECT last_refresh_timestamp FROM clan_roster WHERE clan_name = ?", (clan_name,))
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+def is_roster_due(last_refresh:float|None, now:float) -> bool:
+    return last_refresh is None or now - last_refresh >= ROSTER_REFRESH_MINUTES * 60
+
+def apply_roster(dbcon, clan_name:str, content:str, now:float) -> RosterDiff:
+    """
+    Compares a freshly downloaded members_lite.ws against the cached roster and writes only the differences.
+    New members are added to user_activity so the scheduler picks them up; departed members are marked so it skips them.
+    Raises SuspiciousRosterException without writing anything if the roster is empty or has lost too many members at once.
+    """
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    cur = dbcon.execute("SELECT content_hash FROM clan_roster WHERE clan_name = ?", (clan_name,))
+    row = cur.fetchone()
+    if row is not None and row[0] == content_hash:
+        dbcon.execute("UPDATE clan_roster SET last_refresh_timestamp = ? WHERE clan_name = ?", (now, clan_name))
+        return RosterDiff(unchanged=True)
+
+    # Players we already know are kept under the spelling we first saw, even if the roster now has it differently.
+    known = dict(dbcon.execute("SELECT canonical_rsn, rsn FROM user_activity WHERE canonical_rsn IS NOT NULL").fetchall())
+    members = {known.get(canonical_rsn(member.rsn), member.rsn): member for member in parse_clan_members(content)}
+    cur = dbcon.execute("SELECT rsn FROM clan_members WHERE clan_name = ? AND departed_timestamp IS NULL", (clan_name,))
+    current = {row[0] for row in cur.fetchall()}
+
+    diff = RosterDiff(joined=sorted(members.keys() - current), left=sorted(current - members.keys()))
+    # e.g. an error page served with a 200, which would otherwise mark the whole clan as departed.
+    if not members:
+        raise SuspiciousRosterException(f"Roster for {clan_name} has no members ({len(content)} bytes).")
+    if len(diff.left) > MAX_DEPARTED_FRACTION * len(current):
+        held_hash, first_seen = _held_rosters.get(clan_name, (None, now))
+        if held_hash != content_hash:
+            _held_rosters[clan_name] = (content_hash, now)
+        if held_hash != content_hash or now - first_seen < ROSTER_REFRESH_MINUTES * 60:
+            raise SuspiciousRosterException(f"Roster for {clan_name} drops {len(diff.left)} of {len(current)} members, "
+                                            f"holding it back until it's been the same for {ROSTER_REFRESH_MINUTES} minutes.")
+    _held_rosters.pop(clan_name, None)
+
+    dbcon.execute("INSERT OR REPLACE INTO clan_roster(clan_name, content_hash, last_refresh_timestamp) VALUES(?,?,?)", (clan_name, content_hash, now))
+    dbcon.executemany("""
+        INSERT INTO clan_members(clan_name, rsn, rank, joined_timestamp, departed_timestamp) VALUES(?,?,?,?,NULL)
+        ON CONFLICT(clan_name, rsn) DO UPDATE SET
+            rank = excluded.rank,
+            joined_timestamp = CASE WHEN clan_members.departed_timestamp >= excluded.joined_timestamp - ?
+                THEN clan_members.joined_timestamp ELSE excluded.joined_timestamp END,
+            departed_timestamp = NULL
+        """, [(clan_name, rsn, members[rsn].rank, now, REJOIN_GRACE_SECONDS) for rsn in diff.joined])
+    # We default the timestamps to 0 to ensure they'll be queried soon.
+    dbcon.executemany("INSERT OR IGNORE INTO user_activity(rsn, canonical_rsn, last_activity_timestamp, last_query_timestamp) VALUES(?,?,?,?)",
+                      [(rsn, canonical_rsn(rsn), 0, 0) for rsn in diff.joined])
+    dbcon.executemany("UPDATE clan_members SET departed_timestamp = ? WHERE clan_name = ? AND rsn = ?", [(now, clan_name, rsn) for rsn in diff.left])
+    if diff.joined or diff.left:
+        bump_data_generation(dbcon, now)
+        set_state(dbcon, ROSTER_CHANGED_KEY, clan_name, now)
+    return diff
+
+async def refresh_roster(clan_name:str, force:bool=False) -> RosterDiff|None:
+    """ Re-downloads the clan roster if it's due. Returns None if it wasn't due. """
+    log = logging.getLogger(FETCHER_LOG)
+    now = time.time()
+    database = get_database()
+    last_refresh = await database.read(get_last_roster_refresh, clan_name)
+    if last_refresh is not None:
+        _last_refresh[clan_name] = last_refresh
+        roster_last_refresh.set(min(_last_refresh.values()))
+    if not force and not is_roster_due(last_refresh, now):
+        return None
+
+    log.info("Fetching clan members for %s", clan_name)
+    content = await fetch_clan_roster_async(clan_name)
+    diff = await database.write(apply_roster, clan_name, content, now)
+    _last_refresh[clan_name] = now
+    roster_last_refresh.set(min(_last_refresh.values()))
+
+    if diff.unchanged:
+        log.debug("Clan roster for %s is unchanged.", clan_name)
+    else:
+        log.info("Clan roster for %s updated: %d joined, %d left.", clan_name, len(diff.joined), len(diff.left))
+        if diff.joined or diff.left:
+            result_cache.bump_generation()
+    return diff
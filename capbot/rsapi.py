@@ -1,7 +1,207 @@
-import requests
-from dataclasses import dataclass
+import os
+import json
+import time
+import calendar
+import asyncio
+import logging
+import threading
+import aiohttp
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable
 from urllib.parse import quote
 
+from log import FETCHER_LOG
+from metrics import Counter, Gauge, request_seconds
+
+RATE_LIMIT_STATE_FILE = "ratelimit.json"
+# Overridable so the bot can be pointed at a local stand-in (see bench/fake_rsapi.py).
+CLAN_HISCORES_URL = os.getenv("CAPBOT_CLAN_HISCORES_URL", "https://secure.runescape.com/m=clan-hiscores")
+RUNEMETRICS_URL = os.getenv("CAPBOT_RUNEMETRICS_URL", "https://apps.runescape.com/runemetrics")
+# Source address for the async fetchers, so workers sharing a host can each use their own address (and rate limit).
+LOCAL_ADDRESS = os.getenv("CAPBOT_LOCAL_ADDRESS")
+CAP_TEXT = "Capped at my Clan Citadel."
+ACTIVITIES_KEY = '"activities":'
+
+class TooManyRequestsException(Exception):
+    pass
+
+@dataclass
+class RateLimiterBudget:
+    rate:float # requests per second we're currently allowing
+    ceiling:float|None # rate we were at when we last got throttled
+    tokens:float # requests that can be sent right now without waiting
+    penalty_remaining:float # seconds left on a penalty wait after a 429
+
+    @property
+    def requests_per_minute(self) -> float:
+        return self.rate * 60
+
+@dataclass
+class RateLimiterStats:
+    requests:int
+    throttled:int
+    wait_seconds:float # total time callers spent waiting for a token
+    penalty_wait_seconds:float # the part of wait_seconds caused by 429 penalties
+
+class RateLimiter:
+    """
+    Token bucket that every request to the RS apis goes through.
+
+    Jagex don't publish their limits so the refill rate is learnt with AIMD: each success nudges the rate up a little and
+    each 429 halves it and forces a penalty wait before the next request. The rate we were throttled at is remembered so
+    we creep back up towards it slowly instead of repeatedly tripping it. The learnt rate is saved to disk across restarts
+    by whoever owns the limiter, once per update cycle and on shutdown, never from the request path.
+    """
+    def __init__(self, rate:float=0.25, min_rate:float=0.02, max_rate:float=2.0, burst:float=3,
+                 increase:float=0.002, decrease:float=0.5, penalty:float=10, max_penalty:float=120, state_file:str|None=None,
+                 clock:Callable[[], float]=time.monotonic):
+        self.lock = threading.Lock()
+        # Swappable so the polling simulator can run the limiter in virtual time.
+        self.clock = clock
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.base_penalty = penalty
+        self.max_penalty = max_penalty
+        self.penalty = penalty
+        self.ceiling = None
+        self.state_file = state_file
+        self.tokens = burst
+        self.last_refill = clock()
+        self.blocked_until = 0.0
+        self.num_requests = 0
+        self.num_throttled = 0
+        self.wait_seconds = 0.0
+        self.penalty_wait_seconds = 0.0
+        self.load()
+
+    def load(self):
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            self.rate = min(max(float(state["rate"]), self.min_rate), self.max_rate)
+            self.ceiling = state.get("ceiling")
+            # Carry on waiting out a penalty we were given before a restart, or the first requests would just extend it.
+            self.penalty = min(max(float(state.get("penalty", self.base_penalty)), self.base_penalty), self.max_penalty)
+            blocked_for = float(state.get("blocked_until", 0)) - time.time()
+            if blocked_for > 0:
+                self.blocked_until = self.clock() + min(blocked_for, self.max_penalty)
+        except Exception as ex:
+            logging.getLogger(FETCHER_LOG).warning("Failed to load rate limiter state from %s: %s", self.state_file, ex)
+
+    def save(self):
+        if self.state_file is None:
+            return
+        with self.lock:
+            # blocked_until is saved as wall clock time as the monotonic clock doesn't survive a restart.
+            state = {"rate": self.rate, "ceiling": self.ceiling, "penalty": self.penalty,
+                     "blocked_until": time.time() + max(self.blocked_until - self.clock(), 0.0)}
+        try:
+            # Write then rename, so being killed part way through a save can't leave a truncated file.
+            temp_file = f"{self.state_file}.tmp"
+            with open(temp_file, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(temp_file, self.state_file)
+        except Exception as ex:
+            logging.getLogger(FETCHER_LOG).warning("Failed to save rate limiter state to %s: %s", self.state_file, ex)
+
+    async def save_async(self):
+        """ save, on a worker thread so the event loop doesn't wait on the disk. """
+        await asyncio.to_thread(self.save)
+
+    def _refill(self, now:float):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def reserve(self) -> float:
+        """ Takes a token and returns how many seconds the caller must wait before sending its request. """
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            penalty_wait = max(self.blocked_until - now, 0.0)
+            self.num_requests += 1
+            self.wait_seconds += max(wait, penalty_wait)
+            self.penalty_wait_seconds += penalty_wait
+            return max(wait, penalty_wait)
+
+    async def acquire_async(self):
+        await asyncio.sleep(self.reserve())
+
+    def on_success(self):
+        with self.lock:
+            # Back near the rate that got us throttled last time, so probe upwards more carefully.
+            step = self.increase if self.ceiling is None or self.rate < self.ceiling * 0.9 else self.increase / 4
+            self.rate = min(self.rate + step, self.max_rate)
+            self.penalty = self.base_penalty
+
+    def on_throttled(self):
+        with self.lock:
+            now = self.clock()
+            self.num_throttled += 1
+            self.ceiling = self.rate
+            self.rate = max(self.rate * self.decrease, self.min_rate)
+            self.tokens = 0
+            self.last_refill = now
+            self.blocked_until = now + self.penalty
+            self.penalty = min(self.penalty * 2, self.max_penalty)
+
+    def budget(self) -> RateLimiterBudget:
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            return RateLimiterBudget(rate=self.rate, ceiling=self.ceiling, tokens=max(self.tokens, 0.0), penalty_remaining=max(self.blocked_until - now, 0.0))
+
+    def stats(self) -> RateLimiterStats:
+        with self.lock:
+            return RateLimiterStats(requests=self.num_requests, throttled=self.num_throttled, wait_seconds=self.wait_seconds, penalty_wait_seconds=self.penalty_wait_seconds)
+
+rate_limiter = RateLimiter(state_file=RATE_LIMIT_STATE_FILE)
+
+Counter("capbot_requests_total", "Requests sent to the RS apis.", func=lambda: rate_limiter.stats().requests)
+Counter("capbot_throttled_requests_total", "Requests to the RS apis that got a 429.", func=lambda: rate_limiter.stats().throttled)
+Counter("capbot_rate_limit_wait_seconds_total", "Time spent waiting on the rate limiter.", func=lambda: rate_limiter.stats().wait_seconds)
+Counter("capbot_backoff_seconds_total", "Time spent waiting out 429 penalties.", func=lambda: rate_limiter.stats().penalty_wait_seconds)
+Gauge("capbot_rate_limit_requests_per_minute", "The rate limiter's current learnt rate.", func=lambda: rate_limiter.budget().requests_per_minute)
+
+_session:aiohttp.ClientSession|None = None
+
+def get_session() -> aiohttp.ClientSession:
+    """ Returns the pooled keep-alive session used by the async fetchers. Must be called from the running event loop. """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=4, keepalive_timeout=60, local_addr=(LOCAL_ADDRESS, 0) if LOCAL_ADDRESS else None)
+        _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+    return _session
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+async def _get_async(url:str) -> str:
+    """ Sends a GET request through the shared rate limiter. Returns the response body as text. """
+    await rate_limiter.acquire_async()
+    start_time = time.perf_counter()
+    async with get_session().get(url) as response:
+        if response.status == 429:
+            request_seconds.observe(time.perf_counter() - start_time)
+            rate_limiter.on_throttled()
+            raise TooManyRequestsException(f"Too many requests fetching {url}")
+        response.raise_for_status()
+        content = await response.text()
+    request_seconds.observe(time.perf_counter() - start_time)
+    rate_limiter.on_success()
+    return content
+
 @dataclass
 class ClanMember:
     rsn:str
@@ -9,12 +209,10 @@ class ClanMember:
     total_xp:int
     kills:int
 
-def fetch_clan_members(clan_name:str) -> list[ClanMember]:
-    url = f"https://secure.runescape.com/m=clan-hiscores/members_lite.ws?clanName={clan_name}"
-    response = requests.get(url)
-    response.raise_for_status()
-    content = response.text
+def get_clan_members_url(clan_name:str) -> str:
+    return f"{CLAN_HISCORES_URL}/members_lite.ws?clanName={clan_name}"
 
+def parse_clan_members(content:str) -> list[ClanMember]:
     clan_members:list[ClanMember] = []
     rows = content.split("\n")
     for row in rows[1:]:
@@ -30,16 +228,32 @@ def fetch_clan_members(clan_name:str) -> list[ClanMember]:
         ))
     return clan_members
 
+async def fetch_clan_roster_async(clan_name:str) -> str:
+    """ Returns the raw members_lite.ws csv so callers can tell if it's changed before parsing it. """
+    return await _get_async(get_clan_members_url(clan_name))
+
 @dataclass
 class Activity:
     date:str
     details:str
     text:str
 
-@dataclass
+@dataclass(slots=True)
+class AlogEntry:
+    date:str
+    text:str
+    timestamp:float
+
+@dataclass(slots=True)
 class ActivityLog:
+    """ What update_task needs from an alog: the newest entry, any new cap entries and how many entries were new. """
     private:bool
-    activities:list[Activity]
+    newest:AlogEntry|None = None
+    oldest_timestamp:float|None = None
+    caps:list[AlogEntry] = field(default_factory=list)
+    num_entries:int = 0
+    num_new:int = 0
+    found_watermark:bool = False
 
 class PrivateProfileException(Exception):
     pass
@@ -47,12 +261,11 @@ class PrivateProfileException(Exception):
 class RuneMetricsApiError(Exception):
     pass
 
-def fetch_user_activites(rsn:str, num_activities:int=20) -> list[Activity]:
+def get_user_activities_url(rsn:str, num_activities:int) -> str:
     encoded_rsn = quote(rsn)
-    url = f"https://apps.runescape.com/runemetrics/profile/profile?user={encoded_rsn}&activities={num_activities}"
-    response = requests.get(url)
-    response.raise_for_status()
-    jdata = response.json()
+    return f"{RUNEMETRICS_URL}/profile/profile?user={encoded_rsn}&activities={num_activities}"
+
+def parse_user_activities(rsn:str, jdata:dict) -> list[Activity]:
     if "error" in jdata:
         error_message = jdata['error']
         if error_message == "PROFILE_PRIVATE":
@@ -73,9 +286,58 @@ def fetch_user_activites(rsn:str, num_activities:int=20) -> list[Activity]:
         ))
     return activity_list
 
-def get_cap_events(activities:list[Activity]) -> list[Activity]:
-    cap_events = []
+MONTHS = {month: i + 1 for i, month in enumerate(["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])}
+
+@lru_cache(maxsize=8192)
+def alog_date_to_timestamp(date:str) -> float:
+    """ Converts an alog date ("18-Oct-2026 12:34", UTC) into a timestamp. Much cheaper than strptime and memoized as most dates repeat between polls. """
+    day, month, rest = date.split("-")
+    year, hour_minute = rest.split(" ")
+    hour, minute = hour_minute.split(":")
+    return float(calendar.timegm((int(year), MONTHS[month], int(day), int(hour), int(minute), 0)))
+
+_json_decoder = json.JSONDecoder()
+
+def parse_alog(rsn:str, content:str, watermark:tuple[str, str]|None=None) -> ActivityLog:
+    """
+    Fast path for update_task. Only decodes the "activities" array of a runemetrics profile response, skipping the
+    skill values and the rest of the profile. Entries are walked newest first and we stop at the watermark (date, text)
+    of the newest entry we saw last time. Only the newest entry and any new cap entries get a record.
+    """
+    key_index = content.find(ACTIVITIES_KEY)
+    if key_index == -1:
+        # Either an error response (they're tiny), a profile without an alog, or the key is formatted differently than
+        # we look for. Decode the lot; parse_user_activities raises for errors.
+        jdata = json.loads(content)
+        parse_user_activities(rsn, jdata)
+        return build_alog(jdata.get("activities") or [], watermark)
+
+    start = key_index + len(ACTIVITIES_KEY)
+    while content[start] in " \t\r\n":
+        start += 1
+    activities, _ = _json_decoder.raw_decode(content, start)
+    return build_alog(activities, watermark)
+
+def build_alog(activities:list[dict], watermark:tuple[str, str]|None) -> ActivityLog:
+    """ Walks the decoded alog entries for parse_alog. """
+    alog = ActivityLog(private=False, num_entries=len(activities))
+    if not activities:
+        return alog
+
+    newest = activities[0]
+    alog.newest = AlogEntry(date=newest["date"], text=newest["text"], timestamp=alog_date_to_timestamp(newest["date"]))
+    alog.oldest_timestamp = alog_date_to_timestamp(activities[-1]["date"])
     for activity in activities:
-        if activity.text == "Capped at my Clan Citadel.":
-            cap_events.append(activity)
-    return cap_events
\ No newline at end of file
+        text = activity["text"]
+        if watermark is not None and text == watermark[1] and activity["date"] == watermark[0]:
+            alog.found_watermark = True
+            break
+        alog.num_new += 1
+        if text == CAP_TEXT:
+            date = activity["date"]
+            alog.caps.append(AlogEntry(date=date, text=text, timestamp=alog_date_to_timestamp(date)))
+    return alog
+
+async def fetch_user_alog_async(rsn:str, num_activities:int=20, watermark:tuple[str, str]|None=None) -> ActivityLog:
+    content = await _get_async(get_user_activities_url(rsn, num_activities))
+    return parse_alog(rsn, content, watermark)
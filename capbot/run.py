@@ -1,7 +1,7 @@
 import os
+import argparse
 import platform
 import logging
-from capbot import run_bot
 from log import init_log
 
 def start_linux(log):
@@ -19,18 +19,35 @@ def start_linux(log):
         # The daemon context closes any open file descriptors. So re-open the long without truncating.
         log = init_log(mode="a")
         log.info("Starting bot daemon")
+        from capbot import run_bot
         run_bot()
 
 def start_windows(log):
     log.info("Starting bot on Windows")
+    from capbot import run_bot
     run_bot()
 
 if __name__ == "__main__":
-    log = init_log()
+    parser = argparse.ArgumentParser(description="Runs CapBot.")
+    parser.add_argument("--backfill", action="store_true", help="Sweep the whole clan's alogs once to seed cap history, then exit. Runs in the foreground and can run alongside the bot.")
+    parser.add_argument("--restart", action="store_true", help="With --backfill, start a new sweep instead of resuming the last unfinished one.")
+    parser.add_argument("--worker", action="store_true", help="Run a scan worker in the foreground instead of the bot. Several can share one database.")
+    parser.add_argument("--worker-id", help="With --worker, the name the worker leases users under. Defaults to host-pid.")
+    parser.add_argument("--loop-seconds", type=float, help="With --worker, seconds between the start of each scan cycle.")
+    args = parser.parse_args()
+
+    # A backfill or worker can run alongside the bot, so append to its log rather than truncating it.
+    log = init_log(mode="a" if args.backfill or args.worker else "w")
     try:
         log.info("Starting bot script")
 
-        if platform.system() == "Windows":
+        if args.backfill:
+            from backfill import run_backfill
+            run_backfill(restart=args.restart)
+        elif args.worker:
+            from worker import run_worker
+            run_worker(worker_id=args.worker_id, loop_seconds=args.loop_seconds)
+        elif platform.system() == "Windows":
             start_windows(log)
         else:
             start_linux(log)
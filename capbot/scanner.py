@@ -0,0 +1,297 @@
+import time
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+from log import FETCHER_LOG, SCHEDULER_LOG
+from db import get_database, set_state, bump_data_generation, SCANNER_HEARTBEAT_KEY
+from cache import result_cache
+from clans import ClanConfig
+from metrics import users_scanned, cap_detection_lag_seconds
+from roster import refresh_roster
+from rollups import compact_if_due
+from attendance import update_week_bits, get_cap_members
+from scheduler import refresh_schedule, get_next_users, choose_activity_count, update_activity_rate, ScheduleStats, MAX_ACTIVITIES
+from rsapi import fetch_user_alog_async, rate_limiter, ActivityLog, PrivateProfileException, TooManyRequestsException
+
+MAX_FAILURES = 5
+MAX_THROTTLES = 5
+UPDATE_LOOP_MINUTES = 2
+
+# (last query timestamp, high-water mark (date, text) or None, activity rate, poll interval) for each user being scanned.
+PollState = tuple[float, tuple[str, str]|None, float|None, float|None]
+
+@dataclass
+class ScanResult:
+    """ Everything a scan found, ready to be written by store_scan. """
+    users:list[str]
+    poll_state:dict[str, PollState]
+    activities:dict[str, ActivityLog]
+    now:float
+    cap_rows:list[tuple] = field(default_factory=list)
+    watermark_rows:list[tuple] = field(default_factory=list)
+    activity_rows:list[tuple] = field(default_factory=list)
+    no_activity_rows:list[tuple] = field(default_factory=list)
+
+async def get_user_activities(users:list[str], num_activities:dict[str, int]|None=None, watermarks:dict[str, tuple[str, str]]|None=None) -> dict[str, ActivityLog]:
+    """
+    Fetches the adventure's log for each user in the list, asking for num_activities[rsn] entries (20 if not given)
+    and only parsing entries newer than watermarks[rsn]. If fewer than MAX_ACTIVITIES entries didn't reach the
+    watermark the user is fetched again with MAX_ACTIVITIES, and num_activities[rsn] is updated to match.
+    Handles Jamflex's extreme rate limiting. Pacing and penalty waits are left to the shared rate limiter in rsapi.
+    Returns a dict of rsn -> ActivityLog.
+    """
+    log = logging.getLogger(FETCHER_LOG)
+    num_activities = num_activities if num_activities is not None else {}
+    watermarks = watermarks or {}
+    log.debug("Fetching activities for %d users.", len(users))
+
+    num_failures = 0
+    num_throttles = 0
+    index = 0
+    activity_dict = {}
+    while index < len(users):
+        rsn = users[index]
+        try:
+            count = num_activities.get(rsn, MAX_ACTIVITIES)
+            log.debug("Fetching last %d alog entries for %s", count, rsn)
+            activity_log = await fetch_user_alog_async(rsn, count, watermarks.get(rsn))
+            if rsn in watermarks and not activity_log.found_watermark and activity_log.num_entries >= count < MAX_ACTIVITIES:
+                # The short window didn't reach the entry we saw last time, so there could be caps further back.
+                # Fetch them again with the full window before anything is recorded or the watermark moves.
+                log.debug("Last seen alog entry for %s is older than the last %d entries, fetching %d.", rsn, count, MAX_ACTIVITIES)
+                num_activities[rsn] = MAX_ACTIVITIES
+                continue
+            activity_dict[rsn] = activity_log
+
+            index += 1
+            num_throttles = 0 # Reset as we had a success
+
+        except PrivateProfileException:
+            log.warning("Failed to fetch activities for %s: runemetrics profile is private", rsn)
+            activity_dict[rsn] = ActivityLog(private=True)
+            index += 1
+
+        except TooManyRequestsException:
+            num_throttles += 1
+            budget = rate_limiter.budget()
+            log.warning("Received 'Too many requests' response. Rate limited to %.1f requests/minute, waiting %.0f seconds", budget.requests_per_minute, budget.penalty_remaining)
+            if num_throttles > MAX_THROTTLES:
+                log.error("Max consecutive 'Too many requests' responses exceeded. Skipping further requests")
+                break
+            # Don't increment index so we retry
+            continue
+
+        except Exception as ex:
+            log.exception("Failed to fetch user activities for %s: %s", rsn, ex)
+            num_failures += 1
+            if num_failures > MAX_FAILURES:
+                log.error("Exceeded max failures for fetching user activites. Stopping further queries.")
+                return activity_dict
+            index += 1 # skip this user
+            continue
+
+    return activity_dict
+
+def get_query_budget(loop_seconds:float|None=None) -> int:
+    """ Returns how many alogs we can fetch in one update without the requests spilling into the next update. """
+    budget = rate_limiter.budget()
+    # Leave some headroom for the clan roster request and any penalty waits.
+    return max(1, int(budget.rate * (loop_seconds or UPDATE_LOOP_MINUTES * 60) * 0.8) - 1)
+
+async def refresh_rosters(clans:list[ClanConfig]):
+    """
+    Refreshes the clan rosters that are due. New members are added to user_activity and departed ones stop being scanned.
+    If a refresh fails we carry on with that clan's cached roster.
+    """
+    log = logging.getLogger(FETCHER_LOG)
+    for clan in clans:
+        try:
+            await refresh_roster(clan.name)
+        except Exception as ex:
+            log.exception("Failed to refresh clan members for %s: %s", clan.name, ex)
+
+def plan_schedule(dbcon, clans:list[ClanConfig], capacity:float, loop_seconds:float|None=None) -> ScheduleStats:
+    """
+    Re-scores every member and rebuilds poll_schedule for the given polling capacity (polls/second), with scan cycles
+    loop_seconds apart (UPDATE_LOOP_MINUTES if not given).
+    """
+    loop_seconds = loop_seconds or UPDATE_LOOP_MINUTES * 60
+    log = logging.getLogger(SCHEDULER_LOG)
+    # Lets a backfill running in another process know to leave most of the rate budget to us.
+    set_state(dbcon, SCANNER_HEARTBEAT_KEY, ",".join(clan.name for clan in clans), time.time())
+    # Capacity is shared fairly between the clans, and members of more than one clan are only polled once.
+    stats = refresh_schedule(dbcon, time.time(), capacity, min_interval=loop_seconds, clan_names=[clan.name for clan in clans])
+    log.debug("Poll schedule: %d users, %.0f queries per %.0f second cycle, max staleness %.0f seconds, expected detection lag %.0f seconds.",
+              stats.users, capacity * loop_seconds, loop_seconds, stats.max_staleness, stats.expected_detection_lag)
+    if len(stats.clan_shares) > 1 and log.isEnabledFor(logging.DEBUG):
+        log.debug("Polling capacity per clan: %s", ", ".join(f"{name} {share:.0%}" for name, share in stats.clan_shares.items()))
+    return stats
+
+def load_poll_state(dbcon, users:list[str]) -> tuple[dict[str, PollState], dict[str, str|None]]:
+    """
+    Loads the high-water mark for each user so we only parse alog entries we haven't seen before.
+    Also which clan any caps we find belong to: players can only be in one clan, so if they're on more than one
+    roster it's the one they joined most recently and the other roster just hasn't caught up yet.
+    """
+    placeholders = ",".join("?" * len(users))
+    cur = dbcon.execute(f"""
+        SELECT ua.rsn, ua.last_query_timestamp, aw.activity_date, aw.activity_text, aw.activity_rate, ps.poll_interval,
+            (SELECT cm.clan_name FROM clan_members cm
+             WHERE cm.rsn = ua.rsn AND cm.departed_timestamp IS NULL
+             ORDER BY cm.joined_timestamp DESC LIMIT 1)
+        FROM user_activity ua
+        LEFT JOIN activity_watermarks aw ON aw.rsn = ua.rsn
+        LEFT JOIN poll_schedule ps ON ps.rsn = ua.rsn
+        WHERE ua.rsn IN ({placeholders})
+        """, users)
+    poll_state = {}
+    user_clans = {}
+    for rsn, last_query, date, text, rate, interval, clan_name in cur.fetchall():
+        poll_state[rsn] = (last_query, (date, text) if date is not None else None, rate, interval)
+        user_clans[rsn] = clan_name
+    return poll_state, user_clans
+
+async def scan_users(users:list[str], poll_state:dict[str, PollState], user_clans:dict[str, str|None]) -> ScanResult:
+    """ Fetches the alogs for the given users and works out what needs writing back. """
+    log = logging.getLogger(FETCHER_LOG)
+
+    # Query the user alogs. Quiet users only need a few entries; busy ones get the full window.
+    num_activities = {rsn: choose_activity_count(rate, interval) if watermark else MAX_ACTIVITIES
+                      for rsn, (_, watermark, rate, interval) in poll_state.items()}
+    watermarks = {rsn: watermark for rsn, (_, watermark, _, _) in poll_state.items() if watermark is not None}
+    user_activities = await get_user_activities(users, num_activities, watermarks)
+    users_scanned.observe(len(user_activities))
+
+    now = datetime.now(timezone.utc).timestamp()
+    result = ScanResult(users=users, poll_state=poll_state, activities=user_activities, now=now)
+    private_profiles = set()
+    for rsn, activity_log in user_activities.items():
+        if activity_log.private:
+            private_profiles.add(rsn)
+            continue
+
+        newest = activity_log.newest
+        if newest is None:
+            continue
+
+        # The parser stopped at the entry we saw last time, so num_new and caps only cover entries we haven't seen.
+        last_query, watermark, old_rate, _ = poll_state[rsn]
+        if activity_log.found_watermark:
+            new_rate = update_activity_rate(old_rate, activity_log.num_new, now - last_query)
+        else:
+            if watermark is not None and activity_log.num_entries >= num_activities[rsn]:
+                log.warning("Last seen alog entry for %s has rolled out of the %d entry window. Caps may have been missed.", rsn, num_activities[rsn])
+            # Estimate the rate from the span of the entries we got back instead.
+            # Dates only have minute precision so treat the span as at least a minute.
+            span = max(newest.timestamp - activity_log.oldest_timestamp, 60)
+            new_rate = update_activity_rate(old_rate, activity_log.num_entries - 1, span)
+
+        # Record any cap events
+        for cap in activity_log.caps:
+            result.cap_rows.append((rsn, cap.timestamp, "auto", user_clans.get(rsn)))
+
+        # Get latest activity date, which is always the first activity in the list
+        result.activity_rows.append((newest.timestamp, now, rsn))
+        result.watermark_rows.append((rsn, newest.date, newest.text, new_rate))
+
+    # Users we queried but got no activity data from. This may be due to private alogs.
+    # Users we didn't get to (throttled, or the fetch failed) aren't in user_activities and are left as they were.
+    result.no_activity_rows = [(now, (1 if rsn in private_profiles else 0), rsn) for rsn, activity_log in user_activities.items()
+                               if activity_log.newest is None]
+    return result
+
+def store_scan(dbcon, result:ScanResult) -> list[tuple]:
+    """ Writes a scan's results. Returns the cap_events rows that were new. """
+    log = logging.getLogger(SCHEDULER_LOG)
+
+    # Add new cap events
+    # One at a time so we know which caps are new. There are only ever a handful.
+    new_caps = [row for row in result.cap_rows
+                if dbcon.execute("INSERT OR IGNORE INTO cap_events(rsn, cap_timestamp, source, clan_name) VALUES(?,?,?,?)", row).rowcount > 0]
+    log.debug("Inserted %d new rows into cap_events: %s", len(new_caps), new_caps)
+    if new_caps:
+        update_week_bits(dbcon, get_cap_members(new_caps))
+        result_cache.bump_generation()
+        # And for any other process serving commands from this database.
+        bump_data_generation(dbcon, result.now)
+
+    # Move each user's high-water mark up to the newest entry we've seen.
+    cur = dbcon.executemany("INSERT OR REPLACE INTO activity_watermarks(rsn, activity_date, activity_text, activity_rate) VALUES(?,?,?,?)", result.watermark_rows)
+    log.debug("Updated %d alog high-water marks.", cur.rowcount)
+
+    # Update user_activity table with last activities/query time.
+    # Hard-coding private to false since it can't be true if we have activities.
+    cur = dbcon.executemany("UPDATE user_activity SET last_activity_timestamp = ?, last_query_timestamp = ?, private = 0 WHERE rsn = ?", result.activity_rows)
+    log.debug("Updated last_activity_timestamp for %d rows in user_activity.", cur.rowcount)
+
+    # Update query time for users we queried but got no activity data from.
+    cur = dbcon.executemany("UPDATE user_activity SET last_query_timestamp = ?, private = ? WHERE rsn = ?", result.no_activity_rows)
+    log.debug("Updated last_query_timestamp for %d in-active users in user_activity.", cur.rowcount)
+
+    # Push the users we scanned back in the queue now rather than waiting for the next schedule refresh,
+    # which might be a while when the schedule is shared between workers. Ones we didn't get to stay due.
+    dbcon.executemany("UPDATE poll_schedule SET next_poll_timestamp = ? + poll_interval WHERE rsn = ?", [(result.now, rsn) for rsn in result.activities])
+    return new_caps
+
+def record_detection_lag(result:ScanResult, new_caps:list[tuple]):
+    for rsn, cap_timestamp, *_ in new_caps:
+        # A user's first scan turns up caps from before we were watching them, which would skew the lag.
+        if result.poll_state[rsn][1] is not None:
+            cap_detection_lag_seconds.observe(result.now - cap_timestamp)
+
+def log_cycle_summary(result:ScanResult|None, new_caps:list[tuple], start_time:float, worker_id:str|None=None):
+    """ One record per scan cycle, rather than the rows it wrote. JSON logs get the numbers as fields too. """
+    fields = {
+        "event": "scan_cycle",
+        "worker": worker_id,
+        "users": len(result.users) if result else 0,
+        "scanned": len(result.activities) if result else 0,
+        "private": sum(1 for activity_log in result.activities.values() if activity_log.private) if result else 0,
+        "new_caps": len(new_caps),
+        "seconds": round(time.time() - start_time, 2),
+        "requests_per_minute": round(rate_limiter.budget().requests_per_minute, 1),
+    }
+    logging.getLogger(SCHEDULER_LOG).info("Scan cycle%s: %d/%d users scanned (%d private), %d new caps in %.1f seconds at %.1f requests/minute.",
+                                          f" ({worker_id})" if worker_id else "", fields["scanned"], fields["users"], fields["private"],
+                                          fields["new_caps"], fields["seconds"], fields["requests_per_minute"], extra={"fields": fields})
+
+async def update_task(clans:list[ClanConfig]):
+    """
+    Background task to update the activity database for all the clan members.
+
+    To avoid having a very large delay between someone capping and the bot detecting it, we have to do a fair amount of work due to the API limits.
+    The API only allows roughly 15-20 requests/minute and is very aggressive with 'Too many request' errors which force you to wait an additional 10-30 seconds.
+    To deal with this we only query as many users each update as the shared rate limiter's learnt budget allows, and run the update more often.
+    Which users get queried is decided by scheduler.py: members are weighted by recent activity, how often they cap and
+    whether their alog is private, and the query budget is shared out so likely cappers are checked more often while
+    every member is still checked at least once a day.
+    """
+    log = logging.getLogger(SCHEDULER_LOG)
+    start_time = time.time()
+    log.debug("Starting update_task...")
+
+    await refresh_rosters(clans)
+
+    database = get_database()
+    num_queries = get_query_budget()
+
+    def plan_queries(dbcon):
+        # Re-score every member and pick the ones most overdue for a poll.
+        # Only query a few at a time as it's very slow due to Jagex rate limits.
+        plan_schedule(dbcon, clans, num_queries / (UPDATE_LOOP_MINUTES * 60))
+        compact_if_due(dbcon, time.time())
+        users_to_query = get_next_users(dbcon, num_queries)
+        return users_to_query, *load_poll_state(dbcon, users_to_query)
+
+    users_to_query, poll_state, user_clans = await database.write(plan_queries)
+    if len(users_to_query) == 0:
+        log.debug("No users to query.")
+        users_scanned.observe(0)
+        log_cycle_summary(None, [], start_time)
+        return
+
+    result = await scan_users(users_to_query, poll_state, user_clans)
+    new_caps = await database.write(store_scan, result)
+    record_detection_lag(result, new_caps)
+    log_cycle_summary(result, new_caps, start_time)
@@ -0,0 +1,214 @@
+import math
+import logging
+from dataclasses import dataclass, field
+
+from log import SCHEDULER_LOG
+
+# Every member is guaranteed to be polled at least this often, regardless of how inactive they are.
+MAX_STALENESS_SECONDS = 24 * 60 * 60
+# How far back we look in cap_events to work out how often a member caps.
+CADENCE_WEEKS = 8
+# A citadel can only be capped once per week, so a recent cap makes another one unlikely for a few days.
+RECENT_CAP_SECONDS = 5 * 24 * 60 * 60
+RECENT_CAP_DAMPING = 0.2
+# Runemetrics returns at most this many alog entries per request.
+MAX_ACTIVITIES = 20
+MIN_ACTIVITIES = 5
+# Poll very active members before their alog can fill this fraction of the runemetrics window, or we could miss a cap.
+WINDOW_SAFETY = 0.75
+ACTIVITY_RATE_SMOOTHING = 0.3
+# When tracking several clans, this fraction of the polling capacity is split by member count and the rest by how
+# likely each clan's members are to cap.
+CLAN_SHARE_BY_SIZE = 0.5
+# The capacity moves a little every cycle with the learnt rate. Poll intervals within this fraction of the stored one
+# are left alone rather than rewriting the whole schedule each time.
+INTERVAL_TOLERANCE = 0.05
+
+@dataclass
+class ScheduleStats:
+    users:int
+    capacity:float # polls per second we can afford
+    max_staleness:float # longest interval any member will wait between polls
+    expected_detection_lag:float # cap-weighted average seconds between a cap and us polling that user
+    clan_shares:dict[str, float] = field(default_factory=dict) # fraction of the capacity each clan got
+
+def estimate_cap_weight(now:float, last_activity:float, recent_caps:int, last_cap:float|None, private:bool) -> float:
+    """
+    Estimates how likely a member is to cap before their next poll, relative to other members.
+    Private alogs get no weight as polling them can't find caps; they're only polled for the staleness guarantee.
+    """
+    if private:
+        return 0.0
+
+    activity_age = now - last_activity
+    if activity_age <= 24 * 60 * 60:
+        activity_factor = 1.0
+    elif activity_age <= 7 * 24 * 60 * 60:
+        activity_factor = 0.5
+    elif activity_age <= 30 * 24 * 60 * 60:
+        activity_factor = 0.1
+    else:
+        activity_factor = 0.02
+
+    # Fraction of recent weeks the member capped in, smoothed so members with no history still get some weight.
+    cadence_factor = (recent_caps + 1) / (CADENCE_WEEKS + 1)
+
+    weight = activity_factor * min(cadence_factor, 1.0)
+    if last_cap is not None and now - last_cap < RECENT_CAP_SECONDS:
+        weight *= RECENT_CAP_DAMPING
+    return weight
+
+def get_max_interval(activity_rate:float|None) -> float:
+    """ Longest we can leave a member between polls, given how many alog entries per second they generate. """
+    if not activity_rate:
+        return MAX_STALENESS_SECONDS
+    return min(MAX_STALENESS_SECONDS, WINDOW_SAFETY * MAX_ACTIVITIES / activity_rate)
+
+def choose_activity_count(activity_rate:float|None, poll_interval:float|None) -> int:
+    """ Picks how many alog entries to request so the new entries since the last poll fit with some room to spare. """
+    if activity_rate is None or poll_interval is None:
+        return MAX_ACTIVITIES
+    expected = activity_rate * poll_interval
+    return min(MAX_ACTIVITIES, max(MIN_ACTIVITIES, math.ceil(expected * 2) + 2))
+
+def update_activity_rate(old_rate:float|None, new_entries:int, elapsed:float) -> float:
+    """ Folds the number of new alog entries seen over the last elapsed seconds into a moving average rate. """
+    observed = new_entries / elapsed if elapsed > 0 else 0.0
+    if old_rate is None:
+        return observed
+    return ACTIVITY_RATE_SMOOTHING * observed + (1 - ACTIVITY_RATE_SMOOTHING) * old_rate
+
+def allocate_poll_intervals(weights:list[float], capacity:float, min_interval:float, max_intervals:list[float]|None=None) -> list[float]:
+    """
+    Splits the polling capacity (polls/second) across members and returns the poll interval for each one.
+
+    Every member first gets enough polls to meet their max interval (MAX_STALENESS_SECONDS by default). The remaining
+    capacity is shared in proportion to the square root of each weight, which minimises the weighted average detection
+    lag. No member is polled more often than min_interval; any capacity they can't use is handed back to the others.
+    """
+    num_users = len(weights)
+    if num_users == 0:
+        return []
+
+    if max_intervals is None:
+        max_intervals = [MAX_STALENESS_SECONDS] * num_users
+    max_rate = 1 / min_interval
+    floor_rates = [min(1 / max(interval, min_interval), max_rate) for interval in max_intervals]
+    spare = capacity - sum(floor_rates)
+    if spare <= 0:
+        # Not enough capacity to meet the staleness guarantee, so fall back to a plain round robin.
+        return [num_users / capacity] * num_users
+
+    rates = list(floor_rates)
+    unclamped = [i for i in range(num_users) if weights[i] > 0]
+    while spare > 1e-12 and unclamped:
+        total = sum(math.sqrt(weights[i]) for i in unclamped)
+        share = {i: spare * math.sqrt(weights[i]) / total for i in unclamped}
+        clamped = {i for i in unclamped if rates[i] + share[i] >= max_rate}
+        if not clamped:
+            for i in unclamped:
+                rates[i] += share[i]
+            spare = 0
+            break
+        for i in clamped:
+            spare -= max_rate - rates[i]
+            rates[i] = max_rate
+        unclamped = [i for i in unclamped if i not in clamped]
+
+    return [1 / rate for rate in rates]
+
+def split_clan_capacity(sizes:dict[str, int], weights:dict[str, float]) -> dict[str, float]:
+    """ Returns the fraction of the polling capacity each clan gets, from its member count and the total weight of its members. """
+    total_size = sum(sizes.values())
+    total_weight = sum(weights.values())
+    shares = {}
+    for clan_name, size in sizes.items():
+        size_share = size / total_size if total_size > 0 else 0.0
+        weight_share = weights[clan_name] / total_weight if total_weight > 0 else size_share
+        shares[clan_name] = CLAN_SHARE_BY_SIZE * size_share + (1 - CLAN_SHARE_BY_SIZE) * weight_share
+    return shares
+
+def refresh_schedule(dbcon, now:float, capacity:float, min_interval:float, clan_names:list[str]|None=None) -> ScheduleStats:
+    """
+    Recomputes every current member's weight and poll interval and updates the poll_schedule table with any that changed.
+    The table acts as a persistent priority queue ordered by next_poll_timestamp. Departed members are removed.
+
+    With several clans the capacity is split between them first (see split_clan_capacity) and each clan's share is
+    allocated across its own members. Someone in more than one roster still only has one schedule entry, at the
+    shortest interval any of their clans gave them. If clan_names is given, members of any other clan aren't scheduled.
+    """
+    log = logging.getLogger(SCHEDULER_LOG)
+    cadence_start = now - CADENCE_WEEKS * 7 * 24 * 60 * 60
+    cur = dbcon.execute("""
+        SELECT
+            ua.rsn,
+            ua.last_activity_timestamp,
+            ua.last_query_timestamp,
+            ua.private,
+            COUNT(ce.cap_timestamp),
+            MAX(ce.cap_timestamp),
+            aw.activity_rate
+        FROM user_activity ua
+        LEFT JOIN cap_events ce ON ce.rsn = ua.rsn AND ce.cap_timestamp >= ?
+        LEFT JOIN activity_watermarks aw ON aw.rsn = ua.rsn
+        WHERE EXISTS (SELECT 1 FROM clan_members cm WHERE cm.rsn = ua.rsn AND cm.departed_timestamp IS NULL)
+        GROUP BY ua.rsn
+        """, (cadence_start,))
+    users = cur.fetchall()
+
+    weights = [estimate_cap_weight(now, last_activity, recent_caps, last_cap, private == 1)
+               for _, last_activity, _, private, recent_caps, last_cap, _ in users]
+    max_intervals = [get_max_interval(activity_rate) for *_, activity_rate in users]
+
+    user_index = {users[i][0]: i for i in range(len(users))}
+    clans:dict[str, list[int]] = {}
+    for clan_name, rsn in dbcon.execute("SELECT clan_name, rsn FROM clan_members WHERE departed_timestamp IS NULL ORDER BY clan_name"):
+        if rsn in user_index and (clan_names is None or clan_name in clan_names):
+            clans.setdefault(clan_name, []).append(user_index[rsn])
+    shares = split_clan_capacity({clan_name: len(members) for clan_name, members in clans.items()},
+                                 {clan_name: sum(weights[i] for i in members) for clan_name, members in clans.items()})
+
+    intervals = [math.inf] * len(users)
+    for clan_name, members in clans.items():
+        clan_intervals = allocate_poll_intervals([weights[i] for i in members], capacity * shares[clan_name], min_interval, [max_intervals[i] for i in members])
+        for i, interval in zip(members, clan_intervals):
+            intervals[i] = min(intervals[i], interval)
+    scheduled = [i for i in range(len(users)) if intervals[i] != math.inf]
+
+    # Only touch the entries whose interval or weight changed, so members keep their place in the queue. One whose
+    # interval got shorter is brought forward if it's now due sooner, but never pushed back.
+    existing = {rsn: (weight, interval) for rsn, weight, interval in dbcon.execute("SELECT rsn, weight, poll_interval FROM poll_schedule")}
+    def changed(rsn:str, weight:float, interval:float) -> bool:
+        if rsn not in existing:
+            return True
+        old_weight, old_interval = existing[rsn]
+        return weight != old_weight or abs(interval - old_interval) > INTERVAL_TOLERANCE * old_interval
+    rows = [(users[i][0], weights[i], intervals[i], users[i][2] + intervals[i]) for i in scheduled
+            if changed(users[i][0], weights[i], intervals[i])]
+    dbcon.executemany("""
+        INSERT INTO poll_schedule(rsn, weight, poll_interval, next_poll_timestamp) VALUES(?,?,?,?)
+        ON CONFLICT(rsn) DO UPDATE SET
+            weight = excluded.weight,
+            poll_interval = excluded.poll_interval,
+            next_poll_timestamp = MIN(next_poll_timestamp, excluded.next_poll_timestamp)
+        """, rows)
+    scheduled_rsns = {users[i][0] for i in scheduled}
+    dbcon.executemany("DELETE FROM poll_schedule WHERE rsn = ?", [(rsn,) for rsn in existing if rsn not in scheduled_rsns])
+    log.debug("Poll schedule: %d entries updated, %d removed.", len(rows), len(existing.keys() - scheduled_rsns))
+
+    total_weight = sum(weights[i] for i in scheduled)
+    if total_weight > 0:
+        # Caps happen at a random point within a poll interval so on average we find them half an interval later.
+        expected_lag = sum(weights[i] * intervals[i] / 2 for i in scheduled) / total_weight
+    else:
+        expected_lag = 0.0
+    max_staleness = max((intervals[i] for i in scheduled), default=0.0)
+    if max_staleness > MAX_STALENESS_SECONDS:
+        log.warning("Polling capacity is too low to check every member within %d seconds. Current max staleness is %.0f seconds.", MAX_STALENESS_SECONDS, max_staleness)
+
+    return ScheduleStats(users=len(scheduled), capacity=capacity, max_staleness=max_staleness, expected_detection_lag=expected_lag, clan_shares=shares)
+
+def get_next_users(dbcon, limit:int) -> list[str]:
+    """ Returns the members that are most overdue for a poll. """
+    cur = dbcon.execute("SELECT rsn FROM poll_schedule ORDER BY next_poll_timestamp ASC LIMIT ?", (limit,))
+    return [row[0] for row in cur.fetchall()]
@@ -0,0 +1,189 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+
+from log import FETCHER_LOG, SCHEDULER_LOG
+from db import init_db, get_database, close_db, get_state, set_state, SCANNER_HEARTBEAT_KEY, ROSTER_CHANGED_KEY
+from clans import ClanConfig, load_clan_configs
+from roster import refresh_roster
+from rollups import compact_if_due
+from scanner import plan_schedule, load_poll_state, scan_users, store_scan, record_detection_lag, log_cycle_summary, get_query_budget, UPDATE_LOOP_MINUTES
+from rsapi import close_session, rate_limiter
+from metrics import update_cycle_seconds, update_failures, users_scanned
+
+# How long a worker holds the users it has claimed. Needs to comfortably outlast a cycle's fetches; if the worker dies
+# the users go back in the pool once it expires.
+USER_LEASE_SECONDS = 5 * 60
+# The worker holding this lease rebuilds the shared poll schedule. It renews it every cycle, so it only moves on if that
+# worker stops.
+SCHEDULE_LEASE_KEY = "schedule"
+SCHEDULE_LEASE_SECONDS = 3 * UPDATE_LOOP_MINUTES * 60
+# Workers publish their learnt request rate under this bot_state prefix so the schedule can be sized for all of them.
+WORKER_STATE_PREFIX = "worker:"
+WORKER_ALIVE_SECONDS = 3 * UPDATE_LOOP_MINUTES * 60
+# Same headroom get_query_budget leaves for roster requests and penalty waits.
+CAPACITY_HEADROOM = 0.8
+# How soon a worker that found nothing to scan tries again, e.g. on a cold start while another worker is still loading
+# the roster. Much sooner than a whole cycle, but claiming is cheap.
+IDLE_RETRY_SECONDS = 5
+
+def get_default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def try_acquire_lease(dbcon, lease_key:str, worker_id:str, now:float, duration:float) -> bool:
+    """ Takes or renews a lease. Returns False if another worker holds it and it hasn't expired. """
+    cur = dbcon.execute("""
+        INSERT INTO scan_leases(lease_key, worker_id, expires_timestamp) VALUES(?,?,?)
+        ON CONFLICT(lease_key) DO UPDATE SET worker_id = excluded.worker_id, expires_timestamp = excluded.expires_timestamp
+        WHERE scan_leases.expires_timestamp < ? OR scan_leases.worker_id = excluded.worker_id
+        """, (lease_key, worker_id, now + duration, now))
+    return cur.rowcount > 0
+
+def release_leases(dbcon, worker_id:str, lease_keys:list[str]):
+    dbcon.executemany("DELETE FROM scan_leases WHERE lease_key = ? AND worker_id = ?", [(key, worker_id) for key in lease_keys])
+
+def get_user_lease_key(rsn:str) -> str:
+    return f"user:{rsn}"
+
+def claim_users(dbcon, worker_id:str, now:float, limit:int, duration:float=USER_LEASE_SECONDS) -> list[str]:
+    """
+    Leases up to limit of the most overdue users in poll_schedule that no other worker is scanning, skipping any whose
+    lease another worker took between us reading the schedule and trying to lease them.
+    """
+    candidates = dbcon.execute("""
+        SELECT ps.rsn FROM poll_schedule ps
+        LEFT JOIN scan_leases sl ON sl.lease_key = 'user:' || ps.rsn
+        WHERE sl.lease_key IS NULL OR sl.expires_timestamp < ? OR sl.worker_id = ?
+        ORDER BY ps.next_poll_timestamp ASC
+        LIMIT ?
+        """, (now, worker_id, limit)).fetchall()
+    return [rsn for rsn, in candidates if try_acquire_lease(dbcon, get_user_lease_key(rsn), worker_id, now, duration)]
+
+def get_worker_capacity(dbcon, now:float) -> float:
+    """ Polls/second all live workers can afford between them, from the rates they've published. """
+    rows = dbcon.execute("SELECT value FROM bot_state WHERE key LIKE ? AND updated_timestamp >= ?",
+                         (f"{WORKER_STATE_PREFIX}%", now - WORKER_ALIVE_SECONDS)).fetchall()
+    return CAPACITY_HEADROOM * sum(float(value) for value, in rows)
+
+def expire_leases(dbcon, now:float) -> int:
+    """ Deletes expired leases, e.g. from crashed workers. They're free to take anyway, this just keeps the table small. """
+    return dbcon.execute("DELETE FROM scan_leases WHERE expires_timestamp < ?", (now,)).rowcount
+
+def is_schedule_stale(dbcon) -> bool:
+    """
+    True if poll_schedule is empty or a roster has changed since it was last built. Whichever worker notices rebuilds it
+    straight away, rather than everyone idling until the lease holder's next cycle, e.g. on a cold start when the
+    schedule was built before another worker's roster refresh committed.
+    """
+    if dbcon.execute("SELECT 1 FROM poll_schedule LIMIT 1").fetchone() is None:
+        return True
+    planned = get_state(dbcon, SCANNER_HEARTBEAT_KEY)
+    roster_changed = get_state(dbcon, ROSTER_CHANGED_KEY)
+    return planned is None or (roster_changed is not None and roster_changed[1] >= planned[1])
+
+async def refresh_rosters_with_lease(clans:list[ClanConfig], worker_id:str):
+    """ Each clan's roster is refreshed by whichever worker gets its lease, so they don't all request it. """
+    log = logging.getLogger(FETCHER_LOG)
+    database = get_database()
+    for clan in clans:
+        if not await database.write(try_acquire_lease, f"roster:{clan.name}", worker_id, time.time(), USER_LEASE_SECONDS):
+            continue
+        try:
+            await refresh_roster(clan.name)
+        except Exception as ex:
+            log.exception("Failed to refresh clan members for %s: %s", clan.name, ex)
+
+async def worker_cycle(clans:list[ClanConfig], worker_id:str, loop_seconds:float) -> bool:
+    """
+    One scan cycle: publish our rate, help with the shared jobs, then claim, scan and store a batch of users.
+    Returns False if there was nothing to claim.
+    """
+    log = logging.getLogger(SCHEDULER_LOG)
+    database = get_database()
+    start_time = time.time()
+
+    await database.write(set_state, WORKER_STATE_PREFIX + worker_id, rate_limiter.budget().rate, time.time())
+    await refresh_rosters_with_lease(clans, worker_id)
+
+    def plan(dbcon):
+        now = time.time()
+        if not try_acquire_lease(dbcon, SCHEDULE_LEASE_KEY, worker_id, now, SCHEDULE_LEASE_SECONDS):
+            if not is_schedule_stale(dbcon):
+                return False
+            plan_schedule(dbcon, clans, get_worker_capacity(dbcon, now), loop_seconds)
+            return True
+        expire_leases(dbcon, now)
+        plan_schedule(dbcon, clans, get_worker_capacity(dbcon, now), loop_seconds)
+        compact_if_due(dbcon, now)
+        return True
+
+    if await database.write(plan):
+        log.debug("Worker %s refreshed the poll schedule.", worker_id)
+
+    def claim(dbcon):
+        users = claim_users(dbcon, worker_id, time.time(), get_query_budget(loop_seconds))
+        return users, *load_poll_state(dbcon, users)
+
+    users, poll_state, user_clans = await database.write(claim)
+    if not users:
+        log.debug("Worker %s found no users to scan.", worker_id)
+        users_scanned.observe(0)
+        log_cycle_summary(None, [], start_time, worker_id)
+        return False
+
+    result = await scan_users(users, poll_state, user_clans)
+
+    def store(dbcon):
+        new_caps = store_scan(dbcon, result)
+        # Users we didn't get to (e.g. we were throttled) are released too, so another worker can pick them up now.
+        release_leases(dbcon, worker_id, [get_user_lease_key(rsn) for rsn in users])
+        return new_caps
+
+    new_caps = await database.write(store)
+    record_detection_lag(result, new_caps)
+    log_cycle_summary(result, new_caps, start_time, worker_id)
+    return True
+
+async def worker_loop(clans:list[ClanConfig], worker_id:str, loop_seconds:float):
+    log = logging.getLogger(SCHEDULER_LOG)
+    log.info("Worker %s scanning %s every %.0f seconds.", worker_id, ", ".join(clan.name for clan in clans), loop_seconds)
+    try:
+        while True:
+            cycle_start = time.time()
+            cycle_seconds = loop_seconds
+            try:
+                if not await worker_cycle(clans, worker_id, loop_seconds):
+                    cycle_seconds = min(loop_seconds, IDLE_RETRY_SECONDS)
+            except Exception as ex:
+                update_failures.inc()
+                log.exception("Worker cycle failed: %s", ex)
+            update_cycle_seconds.observe(time.time() - cycle_start)
+            await rate_limiter.save_async()
+            await asyncio.sleep(max(0.0, cycle_start + cycle_seconds - time.time()))
+    finally:
+        # Let the others have our users and jobs straight away rather than waiting for the leases to expire.
+        await get_database().write(lambda dbcon: dbcon.execute("DELETE FROM scan_leases WHERE worker_id = ?", (worker_id,)))
+        await close_session()
+
+def run_worker(worker_id:str|None=None, loop_seconds:float|None=None):
+    """
+    Entry point for run.py --worker. Runs a crawler in the foreground that shares the scanning with any other workers
+    using the same database, which may be on other hosts (see CAPBOT_DB_JOURNAL_MODE). Run the discord bot with
+    CAPBOT_DISABLE_SCAN_TASK set alongside to serve commands.
+    """
+    worker_id = worker_id or get_default_worker_id()
+    clans = load_clan_configs()
+    init_db()
+    # Each worker learns its own rate, as workers with different source addresses are throttled separately.
+    rate_limiter.state_file = f"ratelimit-{worker_id}.json"
+    rate_limiter.load()
+
+    try:
+        asyncio.run(worker_loop(clans, worker_id, loop_seconds or UPDATE_LOOP_MINUTES * 60))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rate_limiter.save()
+        close_db()
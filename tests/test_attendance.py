@@ -0,0 +1,61 @@
+import sqlite3
+
+import pytest
+
+from db import create_schema, migrate, migrate_merge_rsn_spellings
+from rollups import compact_cap_events, get_week_start, WEEK_SECONDS
+from attendance import update_week_bits, get_cap_members, rebuild_week_bits
+
+NOW = 1_750_000_000.0
+WEEK = get_week_start(NOW)
+
+@pytest.fixture
+def dbcon(tmp_path):
+    con = sqlite3.connect(tmp_path / "capbot.db")
+    with con:
+        create_schema(con.cursor())
+    migrate(con)
+    yield con
+    con.close()
+
+def get_bits(dbcon) -> set[tuple]:
+    return set(dbcon.execute("SELECT clan_name, rsn, first_week, bits FROM cap_week_bits"))
+
+def get_rebuilt_bits(dbcon) -> set[tuple]:
+    dbcon.execute("SAVEPOINT rebuild")
+    rebuild_week_bits(dbcon)
+    bits = get_bits(dbcon)
+    dbcon.execute("ROLLBACK TO rebuild")
+    dbcon.execute("RELEASE rebuild")
+    return bits
+
+def insert_caps(dbcon, caps:list[tuple]):
+    for cap in caps:
+        dbcon.execute("INSERT INTO cap_events(rsn, cap_timestamp, source, clan_name) VALUES(?,?,?,?)", cap)
+    update_week_bits(dbcon, get_cap_members(caps))
+
+def test_insert_and_delete(dbcon):
+    caps = [("Alice", WEEK - 3 * WEEK_SECONDS + 60, "auto", "c"), ("Alice", WEEK + 60, "auto", "c"), ("Bob", WEEK + 60, "manual", None)]
+    insert_caps(dbcon, caps)
+    assert len(get_bits(dbcon)) == 2
+    assert get_bits(dbcon) == get_rebuilt_bits(dbcon)
+
+    dbcon.execute("DELETE FROM cap_events WHERE rsn = 'Alice' AND cap_timestamp = ?", (WEEK + 60,))
+    dbcon.execute("DELETE FROM cap_events WHERE rsn = 'Bob'")
+    update_week_bits(dbcon, {("c", "Alice"), ("", "Bob")})
+    assert get_bits(dbcon) == get_rebuilt_bits(dbcon)
+    assert [rsn for _, rsn, *_ in get_bits(dbcon)] == ["Alice"]
+
+def test_compaction_keeps_bits(dbcon):
+    insert_caps(dbcon, [("Alice", WEEK - 30 * WEEK_SECONDS + 60, "auto", "c"), ("Alice", WEEK + 60, "auto", "c")])
+    before = get_bits(dbcon)
+    assert compact_cap_events(dbcon, WEEK - 10 * WEEK_SECONDS, NOW) == 1
+    assert get_bits(dbcon) == before == get_rebuilt_bits(dbcon)
+
+def test_spelling_merge_rebuilds_bits(dbcon):
+    for rsn, canonical in [("Foo Bar", "foo bar"), ("foo_bar", None)]:
+        dbcon.execute("INSERT INTO user_activity(rsn, last_activity_timestamp, last_query_timestamp, canonical_rsn) VALUES(?,?,?,?)", (rsn, NOW, NOW, canonical))
+    insert_caps(dbcon, [("Foo Bar", WEEK + 60, "auto", "c"), ("foo_bar", WEEK - WEEK_SECONDS + 60, "auto", "c")])
+    migrate_merge_rsn_spellings(dbcon)
+    assert get_bits(dbcon) == get_rebuilt_bits(dbcon)
+    assert [rsn for _, rsn, *_ in get_bits(dbcon)] == ["Foo Bar"]
@@ -0,0 +1,44 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import scanner
+from db import create_schema, migrate
+from rsapi import ActivityLog, AlogEntry
+
+NOW = 1_700_000_000.0
+POLL_INTERVAL = 600.0
+USERS = ["Alice", "Bob", "Carol"]
+
+@pytest.fixture
+def dbcon(tmp_path):
+    con = sqlite3.connect(tmp_path / "capbot.db")
+    with con:
+        create_schema(con.cursor())
+    migrate(con)
+    with con:
+        for rsn in USERS:
+            con.execute("INSERT INTO user_activity(rsn, last_activity_timestamp, last_query_timestamp, private) VALUES(?,?,?,1)", (rsn, NOW - 5000, NOW - 1000))
+            con.execute("INSERT INTO poll_schedule(rsn, weight, poll_interval, next_poll_timestamp) VALUES(?,?,?,?)", (rsn, 1.0, POLL_INTERVAL, NOW - 100))
+    yield con
+    con.close()
+
+def test_unfetched_users_stay_due(dbcon, monkeypatch):
+    # Throttled after the first user, so get_user_activities only returns what it got before giving up.
+    async def throttled(users, num_activities=None, watermarks=None):
+        return {"Alice": ActivityLog(private=False, newest=AlogEntry("date", "text", NOW - 60), oldest_timestamp=NOW - 3600, num_entries=2)}
+    monkeypatch.setattr(scanner, "get_user_activities", throttled)
+
+    poll_state, user_clans = scanner.load_poll_state(dbcon, USERS)
+    result = asyncio.run(scanner.scan_users(USERS, poll_state, user_clans))
+    with dbcon:
+        scanner.store_scan(dbcon, result)
+
+    schedule = dict(dbcon.execute("SELECT rsn, next_poll_timestamp FROM poll_schedule"))
+    assert schedule["Alice"] == pytest.approx(result.now + POLL_INTERVAL)
+    assert schedule["Bob"] == schedule["Carol"] == NOW - 100
+
+    activity = {rsn: (last_query, private) for rsn, last_query, private in dbcon.execute("SELECT rsn, last_query_timestamp, private FROM user_activity")}
+    assert activity["Alice"] == (result.now, 0)
+    assert activity["Bob"] == activity["Carol"] == (NOW - 1000, 1)